@@ -36,11 +36,15 @@
 # 
 # ***** END LICENSE BLOCK *****
 
+import logging
 import os
 import sys
+import tempfile
+import threading
 
 from xpcom import components, ServerException, nsError
 from xpcom.server import WrapObject, UnwrapObject
+from xpcom._xpcom import PROXY_ALWAYS, PROXY_ASYNC, getProxyForObject
 
 
 rvb_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "pylib", "reviewboard")
@@ -48,6 +52,20 @@ if rvb_path not in sys.path:
     sys.path.append(rvb_path)
 os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
 
+# sbs_diff_helper keeps caches (file contents, lexers) for the whole
+# session. Setting SBSDIFF_RELOAD_HELPER in the environment reloads it for
+# every diff instead, so that changes to it can be tried out without
+# restarting Komodo. This throws the caches away, so it's for development
+# only.
+_reload_helper = bool(os.environ.get("SBSDIFF_RELOAD_HELPER"))
+
+# The resident process that diffs are rendered in, when the
+# extensions.sbsdiff.worker pref is set (see sbs_diff_worker). It's shared
+# by all the diffs of the session, and exits along with Komodo.
+_worker = None
+
+log = logging.getLogger("sbsDiff")
+
 
 class sbsDiff:
     _com_interfaces_ = [components.interfaces.sbsIDiff]
@@ -60,6 +78,16 @@ class sbsDiff:
         self.enable_syntax_highlighting = True
         self.cwd = None
         self.koDiff = None
+        # Set to cancel the generation running in the background, if any.
+        self._cancel_event = None
+        # Held while the cancel event is set, and while a generation checks
+        # it and moves its file into place.
+        self._file_lock = threading.Lock()
+        # The SideBySideDiff of the last diff generated, which renders the
+        # chunks it left out when they're expanded.
+        self._sbsdiff = None
+        # The HighlightCache, once it's first needed.
+        self._highlight_cache = None
 
     html_template = """
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN">
@@ -81,16 +109,206 @@ class sbsDiff:
 </html>
 """
 
-    def generateSbsDiff(self, koIDiff):
-        #diff_data = file("/tmp/fd.patch").read()
+    def _get_sbsdiff(self, koIDiff, is_cancelled=None):
         import sbs_diff_helper
-        reload(sbs_diff_helper)
+        if _reload_helper:
+            reload(sbs_diff_helper)
         self.koDiff = UnwrapObject(koIDiff)
-        sbsdiff = sbs_diff_helper.SideBySideDiff(self.koDiff,
-                                                 self.cwd,
-                                                 self.enable_syntax_highlighting)
+        return sbs_diff_helper.SideBySideDiff(self.koDiff,
+                                              self.cwd,
+                                              self.enable_syntax_highlighting,
+                                              is_cancelled=is_cancelled,
+                                              processes=self._get_processes(),
+                                              highlight_cache=self._get_highlight_cache(sbs_diff_helper),
+                                              worker=self._get_worker())
+
+    def _get_processes(self):
+        # Number of processes to render the files in, 0 meaning one per CPU.
+        prefs = components.classes["@mozilla.org/preferences-service;1"] \
+                  .getService(components.interfaces.nsIPrefBranch)
+        try:
+            return prefs.getIntPref("extensions.sbsdiff.processes")
+        except Exception:
+            return 1
+
+    def _get_worker(self):
+        global _worker
+        prefs = components.classes["@mozilla.org/preferences-service;1"] \
+                  .getService(components.interfaces.nsIPrefBranch)
+        python = None
+        try:
+            if prefs.getBoolPref("extensions.sbsdiff.worker"):
+                python = prefs.getCharPref("extensions.sbsdiff.worker.python")
+        except Exception:
+            pass
+        if python == "":
+            # sys.executable is Komodo itself, which can't run the worker.
+            log.warn("extensions.sbsdiff.worker is set but "
+                     "extensions.sbsdiff.worker.python isn't; rendering "
+                     "in Komodo")
+        processes = self._get_processes()
+        if _worker is not None and (_reload_helper or
+                                    _worker.python != python or
+                                    _worker.processes != processes):
+            # Start over with the changed helper, interpreter or number of
+            # processes, or stop the worker that's no longer wanted.
+            _worker.close()
+            _worker = None
+        if _worker is None and python:
+            import sbs_diff_worker
+            _worker = sbs_diff_worker.DiffWorker(processes=processes,
+                                                 python=python)
+        return _worker
+
+    def _get_highlight_cache(self, sbs_diff_helper):
+        # Highlighted files are kept in Komodo's cache directory, across
+        # sessions.
+        if self._highlight_cache is None or _reload_helper:
+            try:
+                koDirs = components.classes["@activestate.com/koDirs;1"] \
+                           .getService(components.interfaces.koIDirs)
+                directory = os.path.join(koDirs.userCacheDir, "sbsdiff",
+                                         "highlight")
+            except Exception:
+                log.exception("Can't find the cache directory")
+                return None
+            self._highlight_cache = sbs_diff_helper.HighlightCache(directory)
+        return self._highlight_cache
+
+    def generateSbsDiff(self, koIDiff):
+        #diff_data = file("/tmp/fd.patch").read()
+        sbsdiff = self._get_sbsdiff(koIDiff)
+        html = self.html_template % (sbsdiff.toHTML())
+        self._sbsdiff = sbsdiff
+        return html
+
+    def generateSbsDiffAsync(self, koIDiff, callback):
+        self._start_generation(koIDiff, callback, self._generate)
+
+    def generateSbsDiffToFile(self, koIDiff, path, callback):
+        # Write the page with an empty body straight away, so that it can be
+        # shown and filled in while the diff is generated. The generation in
+        # progress is stopped first, so that it can't replace it.
+        self.cancelSbsDiff()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        stream = open(path, "wb")
+        try:
+            stream.write(self.html_template % ("", ))
+        finally:
+            stream.close()
+        self._start_generation(koIDiff, callback, self._generate_to_file,
+                               path)
+
+    def _start_generation(self, koIDiff, callback, generate, *args):
+        self.cancelSbsDiff()
+        cancel_event = threading.Event()
+        sbsdiff = self._get_sbsdiff(koIDiff, is_cancelled=cancel_event.isSet)
+        # The callback is always run on the main thread (1 is
+        # NS_PROXY_TO_MAIN_THREAD).
+        callback = getProxyForObject(1, components.interfaces.sbsIDiffCallback,
+                                     callback, PROXY_ALWAYS | PROXY_ASYNC)
+        # The files are read through koFileEx, which has to be used on this
+        # (the main) thread. Only the diffing and rendering are left for
+        # the generation thread.
+        try:
+            sbsdiff.read_files()
+        except Exception, ex:
+            log.exception("Failed to read the files of the side-by-side "
+                          "diff")
+            callback.onDiffGenerated(
+                components.interfaces.sbsIDiffCallback.RESULT_ERROR, str(ex))
+            return
+        thread = threading.Thread(target=self._run_generation,
+                                  name="sbsDiff generation",
+                                  args=(sbsdiff, callback, cancel_event,
+                                        generate) + args)
+        thread.setDaemon(True)
+        self._cancel_event = cancel_event
+        # The page can show the files generated so far, and the chunks they
+        # left out are rendered from here.
+        self._sbsdiff = sbsdiff
+        thread.start()
+
+    def _run_generation(self, sbsdiff, callback, cancel_event, generate,
+                        *args):
+        try:
+            data = generate(cancel_event, sbsdiff, callback, *args)
+            result = components.interfaces.sbsIDiffCallback.RESULT_SUCCESS
+        except Exception, ex:
+            if cancel_event.isSet():
+                # Stopped with DiffCancelled, and nobody is waiting for
+                # the result anyway.
+                return
+            log.exception("Failed to generate the side-by-side diff")
+            data = str(ex)
+            result = components.interfaces.sbsIDiffCallback.RESULT_ERROR
+        if not cancel_event.isSet():
+            callback.onDiffGenerated(result, data)
+
+    def _generate(self, cancel_event, sbsdiff, callback):
         return self.html_template % (sbsdiff.toHTML())
 
+    def _generate_to_file(self, cancel_event, sbsdiff, callback, path):
+        # Write to a file of our own and only move it into place once it's
+        # complete, so that a cancelled generation that is still finishing
+        # its current file can't write into the new one. The page already
+        # shown is told how many files are done as they're rendered, and is
+        # loaded from the file once it's complete; the HTML itself is too
+        # big to pass through XPCOM.
+        fd, temp_path = tempfile.mkstemp(prefix=".sbsdiff-",
+                                         dir=os.path.dirname(path))
+        stream = os.fdopen(fd, "wb")
+        try:
+            try:
+                header, footer = self.html_template.split("%s")
+                stream.write(header)
+                files_rendered = None
+                for piece in sbsdiff.iter_html():
+                    if isinstance(piece, unicode):
+                        stream.write(piece.encode("utf-8"))
+                    else:
+                        stream.write(piece)
+                    if sbsdiff.files_rendered != files_rendered and \
+                       not cancel_event.isSet():
+                        files_rendered = sbsdiff.files_rendered
+                        callback.onDiffGenerated(
+                            components.interfaces.sbsIDiffCallback.RESULT_PARTIAL,
+                            "%d/%d" % (files_rendered, len(sbsdiff.items)))
+                stream.write(footer)
+            finally:
+                stream.close()
+            # Held by cancelSbsDiff too, so that the file can't be moved into
+            # place once the generation has been cancelled.
+            self._file_lock.acquire()
+            try:
+                if cancel_event.isSet():
+                    return path
+                if os.path.exists(path):
+                    # Windows can't rename over an existing file.
+                    os.remove(path)
+                os.rename(temp_path, path)
+            finally:
+                self._file_lock.release()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return path
+
+    def cancelSbsDiff(self):
+        self._file_lock.acquire()
+        try:
+            if self._cancel_event is not None:
+                self._cancel_event.set()
+                self._cancel_event = None
+        finally:
+            self._file_lock.release()
+
+    def getChunkHTML(self, file_id, chunk_index):
+        if self._sbsdiff is None:
+            return ""
+        return self._sbsdiff.get_chunk_html(file_id, chunk_index)
+
     def filepathFromChunkId(self, chunk_id):
         sp = chunk_id.split(".")
         if len(sp) == 3:
@@ -40,6 +40,14 @@ var g_diff_result = null;
 var g_diff_cwd = null;
 var g_sbsDiff = null;
 var g_diffFormat = "contextual";
+// Bumped for every side-by-side diff started or cancelled, so that results
+// from an earlier one are ignored.
+var g_sbsGeneration = 0;
+// How far the side-by-side diff being generated has got, as
+// "<files rendered>/<files>", for showing once its page has loaded.
+var g_sbsProgress = null;
+// Whether the page of the side-by-side diff has loaded.
+var g_sbsPageLoaded = false;
 
 
 // Overriding functionality - overrides the diff.js loadDiffResult function.
@@ -58,6 +66,7 @@ var loadDiffResult = function overwritten_loadDiffResult(result, cwd) {
 // Side-by-side diff implementation.
 
 function loadSBSDiff() {
+    cancelSBSDiff();
     var koIDiff = Components.classes["@activestate.com/koDiff;1"].
                     createInstance(Components.interfaces.koIDiff);
     koIDiff.initWithDiffContent(g_diff_result);
@@ -71,14 +80,6 @@ function loadSBSDiff() {
     } else {
         document.getElementById('enable_highlighting_checkbox').removeAttribute('disabled');
     }
-    var html = g_sbsDiff.generateSbsDiff(koIDiff);
-
-    // Convert Unicode into UTF-8.
-    var unicodeConverter = Components.classes["@mozilla.org/intl/scriptableunicodeconverter"]
-                           .createInstance(Components.interfaces.nsIScriptableUnicodeConverter);
-    unicodeConverter.charset = "UTF-8";
-    html = unicodeConverter.ConvertFromUnicode(html);
-
     // Get the extension's on-disk location.
     var aFile = Components.classes["@mozilla.org/file/directory_service;1"].
                         getService( Components.interfaces.nsIProperties).
@@ -87,25 +88,78 @@ function loadSBSDiff() {
     aFile.append("sbsdiff@activestate.com");
     aFile.append("content");
     aFile.append("diff.html");
-    if (aFile.exists())
-        aFile.remove(false);
-    aFile.create(Components.interfaces.nsIFile.NORMAL_FILE_TYPE, parseInt("0660", 8));
-    var stream = Components.classes["@mozilla.org/network/safe-file-output-stream;1"]
-                           .createInstance(Components.interfaces.nsIFileOutputStream);
-    stream.init(aFile, 0x04 | 0x08 | 0x20, parseInt("0600", 8), 0); // write, create, truncate
-    stream.write(html, html.length);
-    if (stream instanceof Components.interfaces.nsISafeOutputStream) {
-        stream.finish();
-    } else {
-        stream.close();
-    }
 
-    // do whatever you need to the created file
-    //dump("file.path: " + ko.uriparse.localPathToURI(aFile.path) + "\n");
+    // Generate the diff in the background, so that large diffs don't
+    // freeze Komodo while they're being built. The HTML is written straight
+    // to the file as UTF-8. Until it's done, the page shows how many of the
+    // files have been rendered.
+    var generation = g_sbsGeneration;
+    g_sbsDiff.generateSbsDiffToFile(koIDiff, aFile.path, function(result, data) {
+        if (generation != g_sbsGeneration) {
+            // Cancelled, or replaced by a newer diff.
+            return;
+        }
+        if (result == Components.interfaces.sbsIDiffCallback.RESULT_PARTIAL) {
+            showSBSDiffProgress(data);
+            return;
+        }
+        g_sbsProgress = null;
+        if (result != Components.interfaces.sbsIDiffCallback.RESULT_SUCCESS) {
+            alert("Unable to generate the side-by-side diff: " + data);
+            return;
+        }
+        // The file now holds the whole diff.
+        showSBSDiff();
+    });
+    // The file holds the page with an empty body until the diff is done.
+    showSBSDiff();
+}
+
+function showSBSDiff() {
     var filepath = "chrome://sbsdiff/content/diff.html";
+    var browser = document.getElementById("sbs_diff_browser");
+    g_sbsPageLoaded = false;
     // Set src to "", in order to clear any existing path (to reload itself).
-    document.getElementById("sbs_diff_browser").setAttribute("src", "");
-    document.getElementById("sbs_diff_browser").setAttribute("src", filepath);
+    browser.setAttribute("src", "");
+    browser.setAttribute("src", filepath);
+}
+
+function onSBSDiffPageLoad(event) {
+    var doc = document.getElementById("sbs_diff_browser").contentDocument;
+    if (event.target != doc || doc.location.href != "chrome://sbsdiff/content/diff.html") {
+        // The blank page shown in between, or a frame of the diff's page.
+        return;
+    }
+    g_sbsPageLoaded = true;
+    if (g_sbsProgress) {
+        showSBSDiffProgress(g_sbsProgress);
+    }
+}
+
+// Shows how many files of the diff being generated have been rendered, in
+// the page with an empty body that stands in for the diff until then.
+function showSBSDiffProgress(progress) {
+    g_sbsProgress = progress;
+    if (!g_sbsPageLoaded) {
+        return;
+    }
+    var counts = progress.split("/");
+    var doc = document.getElementById("sbs_diff_browser").contentDocument;
+    doc.body.textContent = "Generating the side-by-side diff: " + counts[0] +
+                           " of " + counts[1] + " files rendered...";
+}
+
+// Called by the diff page to fill in a collapsed chunk when it's expanded.
+function getSBSChunkHTML(file_id, chunk_index) {
+    return g_sbsDiff.getChunkHTML(file_id, chunk_index);
+}
+
+function cancelSBSDiff() {
+    g_sbsGeneration++;
+    g_sbsProgress = null;
+    if (g_sbsDiff) {
+        g_sbsDiff.cancelSbsDiff();
+    }
 }
 
 
@@ -113,6 +167,7 @@ function changeDiffStyle(style) {
     g_diffFormat = style;
     var deck = document.getElementById('deck');
     if (style == 'contextual') {
+        cancelSBSDiff();
         deck.selectedIndex = 0;
     } else if (style == 'side-by-side') {
         deck.selectedIndex = 1;
@@ -188,10 +243,13 @@ function sbsOnload() {
         deck.selectedIndex = 1;
     }
     document.getElementById("diff_style_menulist").selectedIndex = deck.selectedIndex;
+    document.getElementById("sbs_diff_browser").addEventListener(
+        "load", onSBSDiffPageLoad, true);
     sbsEnableUI();
 }
 
 function sbsOnunload() {
+    cancelSBSDiff();
     var prefs = Components.classes["@mozilla.org/preferences-service;1"]
                         .getService(Components.interfaces.nsIPrefService);
     var sbs_prefs = prefs.getBranch("extensions.sbsdiff.");
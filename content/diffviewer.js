@@ -46,8 +46,16 @@ function getEl(id) {
 }
 function expandChunkKomodo(file_id, chunk_index, num_lines) {
     var orig_scrollHeight = document.documentElement.scrollHeight;
+    var chunk = getEl('chunk.' + file_id + '.' + chunk_index);
 
-    getEl('chunk.' + file_id + '.' + chunk_index).style.display = '';
+    if (chunk.className == "lazy") {
+        // The lines of collapsed chunks are only rendered once they're
+        // expanded.
+        chunk.innerHTML = parent.getSBSChunkHTML(file_id, chunk_index);
+        chunk.className = "";
+    }
+
+    chunk.style.display = '';
     getEl('chunk-collapse.' + file_id + '.' + chunk_index).style.display = '';
     getEl('chunk-expand.' + file_id + '.' + chunk_index).style.display = 'none';
 
@@ -1 +1,9 @@
 pref("extensions.sbsdiff.deck.selectedIndex", 0);
+// Processes used to render the files of a side-by-side diff, 0 for one per
+// CPU.
+pref("extensions.sbsdiff.processes", 1);
+// Whether to render side-by-side diffs in a separate, resident Python
+// process, and the Python 2 interpreter to run it with. The worker is only
+// used when both are set.
+pref("extensions.sbsdiff.worker", false);
+pref("extensions.sbsdiff.worker.python", "");
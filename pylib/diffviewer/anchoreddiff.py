@@ -0,0 +1,166 @@
+import time
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.patiencediff import find_unique_anchors
+
+
+def _diff_region(task):
+    """
+    Diffs one region of an AnchoredDiffer. This is a module-level function
+    so that it can be sent to a multiprocessing pool.
+
+    The region gets what's left of the whole diff's time budget by
+    deadline (a time.time() value, or None for no limit).
+    """
+    differ_class, a, b, differ_kwargs, deadline = task
+
+    if deadline is not None:
+        differ_kwargs = dict(differ_kwargs,
+                             time_budget=max(0, deadline - time.time()))
+
+    differ = differ_class(a, b, **differ_kwargs)
+    opcodes = list(differ.get_opcodes())
+    return opcodes, differ.approximated
+
+
+class AnchoredDiffer(object):
+    """
+    Splits a large diff into independent regions and diffs each of them
+    separately, optionally across several processes.
+
+    The lines are first converted to codes, and the lines that are unique
+    in both files and appear in the same order are used as cut points.
+    Each region between cut points is diffed with ``differ_class`` (which
+    gets any extra keyword arguments), and the resulting opcodes are
+    stitched back together into one stream. A ``time_budget`` is for the
+    whole diff: each region only gets the time left of it when it starts.
+
+    With ``processes`` greater than 1 the regions are diffed in a
+    ``multiprocessing`` pool of that size, or in ``pool`` if one is passed
+    in (which saves starting new processes for every diff). Lines are coded
+    with ``code_table`` when one is given. Inputs smaller than
+    MIN_SPLIT_LINES are always diffed in one piece, in this process.
+
+    Since each region is searched on its own, the result can differ
+    slightly from diffing the whole file in one go, but it is always a
+    valid diff.
+    """
+    # Inputs with fewer lines (old and new combined) than this are not
+    # worth splitting.
+    MIN_SPLIT_LINES = 20000
+
+    # Regions are kept at least this large, so that the cost of sending
+    # them to another process stays small next to the cost of diffing them.
+    MIN_REGION_LINES = 2000
+
+    def __init__(self, a, b, ignore_space=False, differ_class=MyersDiffer,
+                 processes=1, pool=None, code_table=None, **differ_kwargs):
+        if type(a) != type(b):
+            raise TypeError
+
+        self.a = a
+        self.b = b
+        self.ignore_space = ignore_space
+        self.differ_class = differ_class
+        self.processes = max(1, processes or 1)
+        self.pool = pool
+        self.code_table = code_table
+        self.differ_kwargs = differ_kwargs
+        self.approximated = False
+
+    def get_opcodes(self):
+        """
+        Generator that returns opcodes representing the contents of the
+        diff, in the same format as MyersDiffer.
+        """
+        deadline = None
+
+        if self.differ_kwargs.get('time_budget') is not None:
+            deadline = time.time() + self.differ_kwargs['time_budget']
+
+        # The codes take care of ignore_space, so the regions can be diffed
+        # as plain lists of numbers, which are also cheap to send to other
+        # processes.
+        coder = MyersDiffer(self.a, self.b, self.ignore_space,
+                            code_table=self.code_table)
+        a_codes = coder._gen_diff_codes(self.a)
+        b_codes = coder._gen_diff_codes(self.b)
+
+        regions = self._split(a_codes, b_codes)
+        tasks = [(self.differ_class, a_codes[i1:i2], b_codes[j1:j2],
+                  self.differ_kwargs, deadline)
+                 for i1, i2, j1, j2 in regions]
+
+        if len(tasks) > 1 and (self.pool or self.processes > 1):
+            pool = self.pool
+
+            if pool is None:
+                # Only pull in multiprocessing when it's actually used.
+                import multiprocessing
+                pool = multiprocessing.Pool(self.processes)
+
+            try:
+                results = pool.map(_diff_region, tasks)
+            finally:
+                if pool is not self.pool:
+                    pool.close()
+                    pool.join()
+        else:
+            results = map(_diff_region, tasks)
+
+        last_group = None
+
+        for (i_offset, i_end, j_offset, j_end), (opcodes, approximated) in \
+            zip(regions, results):
+            self.approximated = self.approximated or approximated
+
+            for tag, i1, i2, j1, j2 in opcodes:
+                if i1 == i2 and j1 == j2:
+                    continue
+
+                if last_group and last_group[0] == tag:
+                    last_group = (tag,
+                                  last_group[1], i2 + i_offset,
+                                  last_group[3], j2 + j_offset)
+                else:
+                    if last_group:
+                        yield last_group
+
+                    last_group = (tag, i1 + i_offset, i2 + i_offset,
+                                  j1 + j_offset, j2 + j_offset)
+
+        if not last_group:
+            last_group = ("equal", 0, len(self.a), 0, len(self.b))
+
+        yield last_group
+
+    def _split(self, a_codes, b_codes):
+        """
+        Returns the (i1, i2, j1, j2) regions to diff. Together they cover
+        both files, in order.
+        """
+        a_length = len(a_codes)
+        b_length = len(b_codes)
+        total = a_length + b_length
+
+        if total < self.MIN_SPLIT_LINES:
+            return [(0, a_length, 0, b_length)]
+
+        anchors = find_unique_anchors(a_codes, 0, a_length,
+                                      b_codes, 0, b_length) or []
+
+        # Aim for a few regions per process, so that one slow region
+        # doesn't hold everything else up.
+        target = max(self.MIN_REGION_LINES, total / (4 * self.processes))
+
+        regions = []
+        i_start = j_start = 0
+
+        for i, j in anchors:
+            if (i - i_start) + (j - j_start) >= target:
+                regions.append((i_start, i, j_start, j))
+                i_start, j_start = i, j
+
+        regions.append((i_start, a_length, j_start, b_length))
+
+        return regions
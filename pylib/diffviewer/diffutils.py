@@ -1,9 +1,6 @@
 import fnmatch
 import logging
-import os
 import re
-import subprocess
-import tempfile
 from difflib import SequenceMatcher
 
 try:
@@ -18,7 +15,10 @@ except ImportError:
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
+from reviewboard.diffviewer.anchoreddiff import AnchoredDiffer
 from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.patcher import PatchError, apply_patch
+from reviewboard.diffviewer.patiencediff import PatienceDiffer
 from reviewboard.diffviewer.smdiff import SMDiffer
 from reviewboard.scmtools.core import PRE_CREATION, HEAD
 
@@ -35,101 +35,62 @@ class DiffCompatError(Exception):
 
 
 def Differ(a, b, ignore_space=False,
-           compat_version=DEFAULT_DIFF_COMPAT_VERSION):
+           compat_version=DEFAULT_DIFF_COMPAT_VERSION,
+           fast_approximate=False, max_cost=None, time_budget=None,
+           processes=None, code_table=None):
     """
     Factory wrapper for returning a differ class based on the compat version
     and flags specified.
+
+    fast_approximate, max_cost and time_budget bound how long the differ
+    may search for a minimal diff (see MyersDiffer). Differs that always
+    run in bounded time ignore them. The differ's ``approximated``
+    attribute reports whether the result was cut short.
+
+    If processes is set, large inputs are split on unique lines and the
+    pieces are diffed separately, across that many processes (see
+    AnchoredDiffer).
+
+    code_table is an optional LineCodeTable to share between the differs
+    of several files, so that lines common to them are only stored once.
     """
     if compat_version == 0:
         return SMDiffer(a, b)
-    elif compat_version == 1:
-        return MyersDiffer(a, b, ignore_space)
+
+    if compat_version == 1:
+        differ_class = MyersDiffer
+    elif compat_version == 2:
+        differ_class = PatienceDiffer
     else:
         raise DiffCompatError(
             "Invalid diff compatibility version (%s) passed to Differ" %
                 (compat_version))
 
+    if processes is not None:
+        return AnchoredDiffer(a, b, ignore_space,
+                              differ_class=differ_class,
+                              processes=processes,
+                              code_table=code_table,
+                              fast_approximate=fast_approximate,
+                              max_cost=max_cost, time_budget=time_budget)
+
+    return differ_class(a, b, ignore_space,
+                        fast_approximate=fast_approximate,
+                        max_cost=max_cost, time_budget=time_budget,
+                        code_table=code_table)
 
-def patch(diff, file, filename):
-    """Apply a diff to a file.  Delegates out to `patch` because noone
-       except Larry Wall knows how to patch."""
-
-    #log_timer = log_timed("Patching file %s" % filename)
-
-    def convert_line_endings(data):
-        # Files without a trailing newline come out of Perforce (and possibly
-        # other systems) with a trailing \r. Diff will see the \r and
-        # add a "\ No newline at end of file" marker at the end of the file's
-        # contents, which patch understands and will happily apply this to
-        # a file with a trailing \r.
-        #
-        # The problem is that we normalize \r's to \n's, which breaks patch.
-        # Our solution to this is to just remove that last \r and not turn
-        # it into a \n.
-        #
-        # See http://code.google.com/p/reviewboard/issues/detail?id=386
-        # and http://reviews.review-board.org/r/286/
-        if data == "":
-            return ""
-
-        if data[-1] == "\r":
-            data = data[:-1]
-
-        temp = data.replace('\r\n', '\n')
-        temp = temp.replace('\r', '\n')
-        return temp
 
+def patch(diff, file, filename):
+    """Apply a diff to a file."""
     if diff.strip() == "":
         # Someone uploaded an unchanged file. Return the one we're patching.
         return file
 
-    # Prepare the temporary directory if none is available
-    tempdir = tempfile.mkdtemp(prefix='reviewboard.')
-
-    (fd, oldfile) = tempfile.mkstemp(dir=tempdir)
-    f = os.fdopen(fd, "w+b")
-    f.write(convert_line_endings(file))
-    f.close()
-
-    diff = convert_line_endings(diff)
-
-    # XXX: catch exception if Popen fails?
-    newfile = '%s-new' % oldfile
-    p = subprocess.Popen(['patch', '-o', newfile, oldfile],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    p.stdin.write(diff)
-    p.stdin.close()
-    patch_output = p.stdout.read()
-    failure = p.wait()
-
-    if failure:
-        f = open("%s.diff" %
-                 (os.path.join(tempdir, os.path.basename(filename))), "w")
-        f.write(diff)
-        f.close()
-
-        #log_timer.done()
-
-        # FIXME: This doesn't provide any useful error report on why the patch
-        # failed to apply, which makes it hard to debug.  We might also want to
-        # have it clean up if DEBUG=False
-        raise Exception(_("The patch to '%s' didn't apply cleanly. The temporary " +
-                          "files have been left in '%s' for debugging purposes.\n" +
-                          "`patch` returned: %s") %
-                        (filename, tempdir, patch_output))
-
-    f = open(newfile, "r")
-    data = f.read()
-    f.close()
-
-    os.unlink(oldfile)
-    os.unlink(newfile)
-    os.rmdir(tempdir)
-
-    #log_timer.done()
-
-    return data
+    try:
+        return apply_patch(diff, file)
+    except PatchError, e:
+        raise Exception(_("The patch to '%s' didn't apply cleanly: %s") %
+                        (filename, e))
 
 
 def get_line_changed_regions(oldline, newline):
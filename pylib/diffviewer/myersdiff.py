@@ -1,9 +1,109 @@
+import time
+from array import array
+from collections import defaultdict
+from itertools import izip
+
+
+class LineCodeTable(object):
+    """
+    Assigns a unique number to each distinct line of text.
+
+    Lines are looked up by their hash (the interpreter's string hash, which
+    is 64 bits wide on 64-bit builds), and one copy of each distinct line
+    is kept so that hash collisions can be detected and given codes of
+    their own. Comparing lists of numbers is faster than comparing lists
+    of strings.
+
+    One table can be shared by the differs for every file in a multi-file
+    diff, so lines that repeat across files (license headers, imports and
+    other boilerplate) are only hashed into the table and stored once.
+    """
+    def __init__(self):
+        # Code 0 is never handed out.
+        self.lines = [None]
+        self._codes_by_hash = {}
+        self._collisions = {}
+
+    def __len__(self):
+        return len(self.lines) - 1
+
+    @property
+    def last_code(self):
+        return len(self.lines) - 1
+
+    def get_code(self, line):
+        return self.get_codes([line])[0]
+
+    def get_codes(self, lines):
+        """
+        Returns the list of codes for a list of lines, adding any new lines
+        to the table.
+        """
+        codes = []
+        append_code = codes.append
+        table_lines = self.lines
+        codes_by_hash = self._codes_by_hash
+
+        get_code = codes_by_hash.get
+
+        for line, key in izip(lines, map(hash, lines)):
+            code = get_code(key)
+
+            if code is None:
+                # This is a new, unrecorded line, so mark it and store it.
+                code = len(table_lines)
+                table_lines.append(line)
+                codes_by_hash[key] = code
+            elif table_lines[code] != line:
+                code = self._get_collision_code(line)
+
+            append_code(code)
+
+        return codes
+
+    def _get_collision_code(self, line):
+        """
+        Returns the code for a line whose hash is already taken by a
+        different line.
+        """
+        code = self._collisions.get(line)
+
+        if code is None:
+            code = len(self.lines)
+            self.lines.append(line)
+            self._collisions[line] = code
+
+        return code
+
+
 class MyersDiffer:
     """
     An implementation of Eugene Myers's O(ND) Diff algorithm based on GNU diff.
+
+    By default every middle snake is searched for in full, which is O(ND)
+    and can take minutes on pathological inputs (such as a file whose lines
+    have been shuffled). Passing ``fast_approximate=True`` enables GNU diff's
+    cost cutoff: once a search has gone on for ``max_cost`` rounds (which
+    defaults to roughly the square root of the input size), the best
+    diagonal found so far is used instead. Passing ``time_budget`` does the
+    same for every search once that many seconds have passed for the whole
+    diff, checking the clock every few hundred diagonals, so that the diff
+    takes little more than its budget (see OVERTIME). The result is still a
+    valid diff, just not necessarily a minimal one, and ``approximated`` is
+    set to True when this happened.
     """
     SNAKE_LIMIT = 20
 
+    # Number of diagonals searched between looks at the clock, when there's
+    # a time budget.
+    DEADLINE_CHECK_INTERVAL = 256
+
+    # Once the time budget has run out, each part of the diff still to be
+    # searched gets a single round, which is enough to find the unchanged
+    # lines around ordinary changes. This goes on for at most this fraction
+    # of the budget again; after that, whatever is left is replaced lines.
+    OVERTIME = 0.02
+
     DISCARD_NONE = 0
     DISCARD_FOUND = 1
     DISCARD_CANCEL = 2
@@ -11,30 +111,57 @@ class MyersDiffer:
     # The Myers diff algorithm effectively turns the diff problem into a graph
     # search.  It works by finding the "shortest middle snake," which
 
-    class DiffData:
+    class DiffData(object):
+        """
+        Per-file state for the differ.
+
+        The line flags are kept in compact arrays rather than dicts and
+        lists, which matters a great deal on files with hundreds of
+        thousands of lines. ``modified`` has one extra trailing byte that is
+        never set. It acts as the guard for both line ``length`` and line
+        -1 (which wraps around to it), so callers can probe one line past
+        either end without bounds checks, as GNU diff does.
+        """
+        __slots__ = ('data', 'length', 'modified', 'undiscarded',
+                     'undiscarded_lines', 'real_indexes')
+
         def __init__(self, data):
             self.data = data
             self.length = len(data)
-            self.modified = {}
-            self.undiscarded = []
+            self.modified = bytearray(self.length + 1)
+            self.undiscarded = array('l')
             self.undiscarded_lines = 0
-            self.real_indexes = []
+            self.real_indexes = array('l')
 
         def is_modified(self, line):
-            return self.modified.has_key(line) and self.modified[line]
+            return self.modified[line]
 
+        def num_modified(self):
+            return self.modified.count(b'\x01')
 
-    def __init__(self, a, b, ignore_space=False):
+
+    def __init__(self, a, b, ignore_space=False, fast_approximate=False,
+                 max_cost=None, time_budget=None, code_table=None):
         if type(a) != type(b):
             raise TypeError
 
         self.a = a
         self.b = b
-        self.code_table = {}
-        self.last_code = 0
+
+        if code_table is None:
+            code_table = LineCodeTable()
+
+        self.code_table = code_table
         self.a_data = self.b_data = None
         self.ignore_space = ignore_space
         self.minimal_diff = False
+        self.fast_approximate = fast_approximate or max_cost is not None
+        self.max_cost = max_cost
+        self.time_budget = time_budget
+        self.approximated = False
+        self.deadline = None
+        self.overtime_deadline = None
+        self.out_of_time = False
 
         # SMS State
         self.max_lines = 0
@@ -43,8 +170,8 @@ class MyersDiffer:
 
     def ratio(self):
         self._gen_diff_data()
-        a_equals = self.a_data.length - len(self.a_data.modified)
-        b_equals = self.b_data.length - len(self.b_data.modified)
+        a_equals = self.a_data.length - self.a_data.num_modified()
+        b_equals = self.b_data.length - self.b_data.num_modified()
 
         return 1.0 * (a_equals + b_equals) / \
                      (self.a_data.length + self.b_data.length)
@@ -59,18 +186,21 @@ class MyersDiffer:
         """
         self._gen_diff_data()
 
+        a_length = self.a_data.length
+        b_length = self.b_data.length
+        a_modified = self.a_data.modified
+        b_modified = self.b_data.modified
+
         a_line = b_line = 0
         last_group = None
 
         # Go through the entire set of lines on both the old and new files
-        while a_line < self.a_data.length or b_line < self.b_data.length:
+        while a_line < a_length or b_line < b_length:
             a_start = a_line
             b_start = b_line
 
-            if a_line < self.a_data.length and \
-               not self.a_data.is_modified(a_line) and \
-               b_line < self.b_data.length and \
-               not self.b_data.is_modified(b_line):
+            if a_line < a_length and not a_modified[a_line] and \
+               b_line < b_length and not b_modified[b_line]:
                 # Equal
                 a_changed = b_changed = 1
                 tag = "equal"
@@ -82,17 +212,15 @@ class MyersDiffer:
                 # Count every old line that's been modified, and the
                 # remainder of old lines if we've reached the end of the new
                 # file.
-                while a_line < self.a_data.length and \
-                      (b_line >= self.b_data.length or \
-                       self.a_data.is_modified(a_line)):
+                while a_line < a_length and \
+                      (b_line >= b_length or a_modified[a_line]):
                     a_line += 1
 
                 # Count every new line that's been modified, and the
                 # remainder of new lines if we've reached the end of the old
                 # file.
-                while b_line < self.b_data.length and \
-                      (a_line >= self.a_data.length or \
-                       self.b_data.is_modified(b_line)):
+                while b_line < b_length and \
+                      (a_line >= a_length or b_modified[b_line]):
                     b_line += 1
 
                 a_changed = a_line - a_start
@@ -129,7 +257,7 @@ class MyersDiffer:
 
 
         if not last_group:
-            last_group = ("equal", 0, self.a_data.length, 0, self.b_data.length)
+            last_group = ("equal", 0, a_length, 0, b_length)
 
         yield last_group
 
@@ -141,6 +269,11 @@ class MyersDiffer:
         if self.a_data and self.b_data:
             return
 
+        if self.time_budget is not None:
+            self.deadline = time.time() + self.time_budget
+            self.overtime_deadline = self.deadline + \
+                                     self.time_budget * self.OVERTIME
+
         self.a_data = self.DiffData(self._gen_diff_codes(self.a))
         self.b_data = self.DiffData(self._gen_diff_codes(self.b))
 
@@ -163,33 +296,26 @@ class MyersDiffer:
 
     def _gen_diff_codes(self, lines):
         """
-        Converts all unique lines of text into unique numbers. Comparing
-        lists of numbers is faster than comparing lists of strings.
+        Converts all unique lines of text into unique numbers, using the
+        (possibly shared) code table.
         """
-        codes = []
+        # TODO: Handle ignoring/triming spaces, ignoring casing, and
+        #       special hooks
+        if self.ignore_space:
+            normalized = []
 
-        for line in lines:
-            # TODO: Handle ignoring/triming spaces, ignoring casing, and
-            #       special hooks
-
-            if self.ignore_space:
+            for line in lines:
                 temp = line.lstrip()
 
                 # We still want to show lines that contain only whitespace.
                 if temp != "":
                     line = temp
 
-            if self.code_table.has_key(line):
-                code = self.code_table[line]
-            else:
-                # This is a new, unrecorded line, so mark it and store it.
-                self.last_code += 1
-                code = self.last_code
-                self.code_table[line] = code
+                normalized.append(line)
 
-            codes.append(code)
+            lines = normalized
 
-        return codes
+        return self.code_table.get_codes(lines)
 
     def _find_sms(self, a_lower, a_upper, b_lower, b_upper, find_minimal):
         """
@@ -212,7 +338,15 @@ class MyersDiffer:
         up_min   = up_max   = up_k
 
         cost = 0
-        max_cost = max(256, self._very_approx_sqrt(self.max_lines * 4))
+        max_cost = self.max_cost
+        if max_cost is None:
+            max_cost = max(256, self._very_approx_sqrt(self.max_lines * 4))
+
+        # Once out of time, the rest of the round is finished without
+        # following any snakes, and the best diagonal so far is used.
+        deadline = self.deadline
+        out_of_time = False
+        checks = self.DEADLINE_CHECK_INTERVAL
 
         while True:
             cost += 1
@@ -243,15 +377,24 @@ class MyersDiffer:
                 y = x - k
                 old_x = x
 
-                # Find the end of the furthest reaching forward D-path in
-                # diagonal k
-                while x < a_upper and y < b_upper and \
-                      self.a_data.undiscarded[x] == self.b_data.undiscarded[y]:
-                    x += 1
-                    y += 1
+                if deadline is not None:
+                    checks -= 1
+
+                    if not checks:
+                        checks = self.DEADLINE_CHECK_INTERVAL
+                        out_of_time = time.time() >= deadline
 
-                if x - old_x > self.SNAKE_LIMIT:
-                    big_snake = True
+                if not out_of_time:
+                    # Find the end of the furthest reaching forward D-path
+                    # in diagonal k
+                    while x < a_upper and y < b_upper and \
+                          self.a_data.undiscarded[x] == \
+                          self.b_data.undiscarded[y]:
+                        x += 1
+                        y += 1
+
+                    if x - old_x > self.SNAKE_LIMIT:
+                        big_snake = True
 
                 down_vector[self.downoff + k] = x
 
@@ -284,14 +427,22 @@ class MyersDiffer:
                 y = x - k
                 old_x = x
 
-                while x > a_lower and y > b_lower and \
-                      self.a_data.undiscarded[x - 1] == \
-                      self.b_data.undiscarded[y - 1]:
-                    x -= 1
-                    y -= 1
+                if deadline is not None:
+                    checks -= 1
+
+                    if not checks:
+                        checks = self.DEADLINE_CHECK_INTERVAL
+                        out_of_time = time.time() >= deadline
 
-                if old_x - x > self.SNAKE_LIMIT:
-                    big_snake = True
+                if not out_of_time:
+                    while x > a_lower and y > b_lower and \
+                          self.a_data.undiscarded[x - 1] == \
+                          self.b_data.undiscarded[y - 1]:
+                        x -= 1
+                        y -= 1
+
+                    if old_x - x > self.SNAKE_LIMIT:
+                        big_snake = True
 
                 up_vector[self.upoff + k] = x
 
@@ -299,7 +450,12 @@ class MyersDiffer:
                    x <= down_vector[self.downoff + k]:
                     return x, y, True, True
 
-            if find_minimal:
+            # The time budget holds even for the parts that would otherwise
+            # be searched in full.
+            if deadline is not None and not out_of_time:
+                out_of_time = time.time() >= deadline
+
+            if find_minimal and not out_of_time:
                 continue
 
             # Heuristics courtesy of GNU diff.
@@ -312,7 +468,7 @@ class MyersDiffer:
             # small ones often starting with replaces. It also makes the output
             # closer to that of GNU diff, which more people would expect.
 
-            if cost > 200 and big_snake:
+            if cost > 200 and big_snake and not find_minimal:
                 def find_diagonal(minimum, maximum, k, best, diagoff, vector,
                                   vdiff_func, check_x_range, check_y_range,
                                   discard_index, k_offset):
@@ -366,11 +522,12 @@ class MyersDiffer:
                 if best > 0:
                     return ret_x, ret_y, False, True
 
-            continue # XXX
-
-            # If we've reached or gone past the max cost, just give up now
-            # and report the halfway point between our best results.
-            if cost >= max_cost:
+            # If we've reached or gone past the max cost (or run out of
+            # time), just give up now and report the halfway point between
+            # our best results.
+            if out_of_time or (self.fast_approximate and cost >= max_cost):
+                self.approximated = True
+                self.out_of_time = out_of_time
                 fx_best = bx_best = 0
 
                 # Find the forward diagonal that maximized x + y
@@ -399,7 +556,7 @@ class MyersDiffer:
 
                     if x + y < bxy_best:
                         bxy_best = x + y
-                        bx_bet = x
+                        bx_best = x
 
                 # Use the better of the two diagonals
                 if a_upper + b_upper - bxy_best < \
@@ -415,38 +572,65 @@ class MyersDiffer:
         """
         The divide-and-conquer implementation of the Longest Common
         Subsequence (LCS) algorithm.
+
+        Rather than recursing into the two halves on either side of each
+        middle snake, the pending ranges are kept on an explicit stack, so
+        very large inputs can't exhaust Python's recursion limit. The lower
+        half is always processed before the upper half, which matches the
+        order (and so the results) of the recursive form.
         """
-        # Fast walkthrough equal lines at the start
-        while a_lower < a_upper and b_lower < b_upper and \
-              self.a_data.undiscarded[a_lower] == \
-              self.b_data.undiscarded[b_lower]:
-            a_lower += 1
-            b_lower += 1
-
-        while a_upper > a_lower and b_upper > b_lower and \
-              self.a_data.undiscarded[a_upper - 1] == \
-              self.b_data.undiscarded[b_upper - 1]:
-            a_upper -= 1
-            b_upper -= 1
-
-        if a_lower == a_upper:
-            # Inserted lines.
-            while b_lower < b_upper:
-                self.b_data.modified[self.b_data.real_indexes[b_lower]] = True
-                b_lower += 1
-        elif b_lower == b_upper:
-            # Deleted lines
-            while a_lower < a_upper:
-                self.a_data.modified[self.a_data.real_indexes[a_lower]] = True
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
+
+        pending = [(a_lower, a_upper, b_lower, b_upper, find_minimal)]
+
+        while pending:
+            a_lower, a_upper, b_lower, b_upper, find_minimal = pending.pop()
+
+            # Fast walkthrough equal lines at the start
+            while a_lower < a_upper and b_lower < b_upper and \
+                  a_undiscarded[a_lower] == b_undiscarded[b_lower]:
                 a_lower += 1
-        else:
-            # Find the middle snake and length of an optimal path for A and B
-            x, y, low_minimal, high_minimal = \
-                self._find_sms(a_lower, a_upper, b_lower, b_upper,
-                               find_minimal)
+                b_lower += 1
+
+            while a_upper > a_lower and b_upper > b_lower and \
+                  a_undiscarded[a_upper - 1] == b_undiscarded[b_upper - 1]:
+                a_upper -= 1
+                b_upper -= 1
+
+            if a_lower == a_upper:
+                # Inserted lines.
+                while b_lower < b_upper:
+                    self.b_data.modified[self.b_data.real_indexes[b_lower]] = \
+                        True
+                    b_lower += 1
+            elif b_lower == b_upper:
+                # Deleted lines
+                while a_lower < a_upper:
+                    self.a_data.modified[self.a_data.real_indexes[a_lower]] = \
+                        True
+                    a_lower += 1
+            elif self.out_of_time and time.time() >= self.overtime_deadline:
+                # There's no time left to search what remains, so it's all
+                # replaced lines.
+                while a_lower < a_upper:
+                    self.a_data.modified[self.a_data.real_indexes[a_lower]] = \
+                        True
+                    a_lower += 1
+
+                while b_lower < b_upper:
+                    self.b_data.modified[self.b_data.real_indexes[b_lower]] = \
+                        True
+                    b_lower += 1
+            else:
+                # Find the middle snake and length of an optimal path for A
+                # and B
+                x, y, low_minimal, high_minimal = \
+                    self._find_sms(a_lower, a_upper, b_lower, b_upper,
+                                   find_minimal)
 
-            self._lcs(a_lower, x, b_lower, y, low_minimal)
-            self._lcs(x, a_upper, y, b_upper, high_minimal)
+                pending.append((x, a_upper, y, b_upper, high_minimal))
+                pending.append((a_lower, x, b_lower, y, low_minimal))
 
     def _shift_chunks(self, data, other_data):
         """
@@ -461,15 +645,22 @@ class MyersDiffer:
         the two lines are identical, we can shift the chunk so that the line
         appears both before and after the line, rather than only after.
         """
+        # j tracks the matching position in the other data set, and can
+        # run past its start while shifting. Lines before the start are
+        # never modified, so guard those lookups explicitly rather than
+        # letting negative indexes wrap around.
+        modified = data.modified
+        other_modified = other_data.modified
+
         i = j = 0
         i_end = data.length
 
         while True:
             # Scan forward in order to find the start of a run of changes.
-            while i < i_end and not data.is_modified(i):
+            while i < i_end and not modified[i]:
                 i += 1
 
-                while other_data.is_modified(j):
+                while j >= 0 and other_modified[j]:
                     j += 1
 
             if i == i_end:
@@ -479,10 +670,10 @@ class MyersDiffer:
 
             # Find the end of these changes
             i += 1
-            while data.is_modified(i):
+            while modified[i]:
                 i += 1
 
-            while other_data.is_modified(j):
+            while j >= 0 and other_modified[j]:
                 j += 1
 
             while True:
@@ -495,21 +686,21 @@ class MyersDiffer:
                     start -= 1
                     i -= 1
 
-                    data.modified[start] = True
-                    data.modified[i] = False
+                    modified[start] = True
+                    modified[i] = False
 
-                    while data.is_modified(start - 1):
+                    while modified[start - 1]:
                         start -= 1
 
                     j -= 1
-                    while other_data.is_modified(j):
+                    while j >= 0 and other_modified[j]:
                         j -= 1
 
                 # The end of the changed run at the last point where it
                 # corresponds to the changed run in the other data set.
                 # If it's equal to i_end, then we didn't find a corresponding
                 # point.
-                if other_data.is_modified(j - 1):
+                if j > 0 and other_modified[j - 1]:
                     corresponding = i
                 else:
                     corresponding = i_end
@@ -517,17 +708,17 @@ class MyersDiffer:
                 # Move the changed region forward as long as the first
                 # changed line is the same as the following unchanged line.
                 while i != i_end and data.data[start] == data.data[i]:
-                    data.modified[start] = False
-                    data.modified[i] = True
+                    modified[start] = False
+                    modified[i] = True
 
                     start += 1
                     i += 1
 
-                    while data.is_modified(i):
+                    while modified[i]:
                         i += 1
 
                     j += 1
-                    while other_data.is_modified(j):
+                    while j >= 0 and other_modified[j]:
                         j += 1
                         corresponding = i
 
@@ -540,11 +731,11 @@ class MyersDiffer:
                 start -= 1
                 i -= 1
 
-                data.modified[start] = True
-                data.modified[i] = False
+                modified[start] = True
+                modified[i] = False
 
                 j -= 1
-                while other_data.is_modified(j):
+                while j >= 0 and other_modified[j]:
                     j -= 1
 
     def _discard_confusing_lines(self):
@@ -654,14 +845,23 @@ class MyersDiffer:
             data.undiscarded_lines = j
 
 
-        self.a_data.undiscarded = [0] * self.a_data.length
-        self.b_data.undiscarded = [0] * self.b_data.length
-        self.a_data.real_indexes = [0] * self.a_data.length
-        self.b_data.real_indexes = [0] * self.b_data.length
-        a_discarded = [0] * self.a_data.length
-        b_discarded = [0] * self.b_data.length
-        a_code_counts = [0] * (1 + self.last_code)
-        b_code_counts = [0] * (1 + self.last_code)
+        self.a_data.undiscarded = array('l', [0]) * self.a_data.length
+        self.b_data.undiscarded = array('l', [0]) * self.b_data.length
+        self.a_data.real_indexes = array('l', [0]) * self.a_data.length
+        self.b_data.real_indexes = array('l', [0]) * self.b_data.length
+        a_discarded = bytearray(self.a_data.length)
+        b_discarded = bytearray(self.b_data.length)
+        # The code table may be shared with other files, in which case it
+        # can be far larger than this diff. Only use flat arrays indexed by
+        # code when they're not much bigger than the files themselves.
+        num_codes = 1 + self.code_table.last_code
+
+        if num_codes <= 2 * (self.a_data.length + self.b_data.length):
+            a_code_counts = array('l', [0]) * num_codes
+            b_code_counts = array('l', [0]) * num_codes
+        else:
+            a_code_counts = defaultdict(int)
+            b_code_counts = defaultdict(int)
 
         for item in self.a_data.data:
             a_code_counts[item] += 1
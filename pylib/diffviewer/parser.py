@@ -1,16 +1,108 @@
 import logging
+import mmap
+import os
 import re
+from array import array
+from itertools import islice
 
 
-class File:
+class File(object):
     def __init__(self):
         self.origFile = None
         self.newFile = None
         self.origInfo = None
         self.newInfo = None
-        self.data = None
         self.binary = False
 
+        # The diff is sliced out of the parser's buffer when it's asked for,
+        # after any text in _data (see DiffParser.iter_files).
+        self._data = None
+        self._source = None
+
+    def _get_data(self):
+        if self._source is None:
+            return self._data
+
+        buffer, start, end = self._source
+        return (self._data or "") + buffer[start:end]
+
+    def _set_data(self, data):
+        self._data = data
+        self._source = None
+
+    data = property(_get_data, _set_data)
+
+
+class LineIndex(object):
+    """
+    A read-only, list-like view of the lines in a buffer, without their
+    line endings (as with str.splitlines). Only the offsets of the lines are
+    stored, and they're found as the lines are asked for, so a large diff
+    is never split up in memory.
+    """
+    LINE_END_RE = re.compile(r"\r\n|\r|\n")
+    BATCH_SIZE = 1024
+
+    def __init__(self, data):
+        self.data = data
+
+        # Offsets of the start of each line found so far, followed by the
+        # offset just past the last one.
+        self._starts = array('l', [0])
+        self._line_ends = self.LINE_END_RE.finditer(data)
+        self._complete = False
+
+    def has_line(self, linenum):
+        """
+        Returns whether the buffer has the given line, finding the lines up
+        to it if needed.
+        """
+        starts = self._starts
+
+        if linenum + 1 < len(starts):
+            return linenum >= 0
+
+        while len(starts) <= linenum + 1 and not self._complete:
+            # Lines are found a batch at a time, which keeps the overhead
+            # per line down.
+            found = [m.end() for m in islice(self._line_ends, self.BATCH_SIZE)]
+            starts.extend(found)
+
+            if len(found) < self.BATCH_SIZE:
+                self._complete = True
+
+                if starts[-1] < len(self.data):
+                    # The last line has no line ending.
+                    starts.append(len(self.data))
+
+        return 0 <= linenum < len(starts) - 1
+
+    def offset(self, linenum):
+        """
+        Returns the offset in the buffer of the start of a line, or the size
+        of the buffer for the line after the last one.
+        """
+        if linenum != 0 and not self.has_line(linenum - 1):
+            raise IndexError(linenum)
+
+        return self._starts[linenum]
+
+    def __len__(self):
+        self.has_line(len(self.data))
+        return len(self._starts) - 1
+
+    def __getitem__(self, linenum):
+        starts = self._starts
+
+        if not 0 <= linenum < len(starts) - 1:
+            if linenum < 0:
+                linenum += len(self)
+
+            if not self.has_line(linenum):
+                raise IndexError(linenum)
+
+        return self.data[starts[linenum]:starts[linenum + 1]].rstrip("\r\n")
+
 
 class DiffParserError(Exception):
     def __init__(self, msg, linenum):
@@ -28,38 +120,78 @@ class DiffParser(object):
 
     def __init__(self, data):
         self.data = data
-        self.lines = data.splitlines()
+        self.lines = LineIndex(data)
+
+    @classmethod
+    def from_path(cls, path):
+        """
+        Returns a parser for the diff in the file at path. The file is
+        mapped into memory rather than read in, so that very large diffs
+        can be parsed without holding them in memory.
+        """
+        f = open(path, "rb")
+
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped.
+                return cls("")
+
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        finally:
+            f.close()
 
     def parse(self):
         """
         Parses the diff, returning a list of File objects representing each
         file in the diff.
         """
+        self.files = list(self.iter_files())
+
+        return self.files
+
+    def iter_files(self):
+        """
+        Parses the diff, yielding a File object for each file in the diff as
+        soon as the end of it is found.
+
+        The data of each File is a slice of the diff, which is only taken
+        when it's asked for, so the line endings are kept as they are in
+        the diff.
+        """
         logging.debug("DiffParser.parse: Beginning parse of diff, size = %s",
                       len(self.data))
 
-        self.files = []
         file = None
         i = 0
 
         # Go through each line in the diff, looking for diff headers.
-        while i < len(self.lines):
+        while self.lines.has_line(i):
             next_linenum, new_file = self.parse_change_header(i)
 
             if new_file:
                 # This line is the start of a new file diff.
+                if file:
+                    self._end_file(file, i)
+                    yield file
+
                 file = new_file
-                self.files.append(file)
                 i = next_linenum
             else:
-                if file:
-                    file.data += self.lines[i] + "\n"
-
                 i += 1
 
+        if file:
+            self._end_file(file, i)
+            yield file
+
         logging.debug("DiffParser.parse: Finished parsing diff.")
 
-        return self.files
+    def _end_file(self, file, linenum):
+        """
+        Points the data of a file at the part of the diff from the end of
+        its header up to the given line.
+        """
+        file._source = (self.data, file._data_start,
+                        self.lines.offset(linenum))
 
     def parse_change_header(self, linenum):
         """
@@ -82,7 +214,7 @@ class DiffParser(object):
             file.newFile  = info.get('newFile')
             file.origInfo = info.get('origInfo')
             file.newInfo  = info.get('newInfo')
-            file.data = ""
+            header = []
 
             # The header is part of the diff, so make sure it gets in the
             # diff content. But only the parts that patch will understand.
@@ -99,7 +231,15 @@ class DiffParser(object):
                     self.lines[i + 1] == self.INDEX_SEP):
 
                     # This is a valid part of a diff header. Add it.
-                    file.data += self.lines[i] + "\n"
+                    header.append(line + "\n")
+
+            if len(header) == linenum - start:
+                # The whole header is kept, so the data can be sliced
+                # straight out of the diff.
+                file._data_start = self.lines.offset(start)
+            else:
+                file._data = "".join(header)
+                file._data_start = self.lines.offset(linenum)
 
         return linenum, file
 
@@ -112,7 +252,7 @@ class DiffParser(object):
         The line number returned is the line after the special header,
         which can be multiple lines long.
         """
-        if linenum + 1 < len(self.lines) and \
+        if self.lines.has_line(linenum + 1) and \
            self.lines[linenum].startswith("Index: ") and \
            self.lines[linenum + 1] == self.INDEX_SEP:
             # This is an Index: header, which is common in CVS and Subversion,
@@ -133,7 +273,7 @@ class DiffParser(object):
         The line number returned is the line after the special header,
         which can be multiple lines long.
         """
-        if linenum + 1 < len(self.lines) and \
+        if self.lines.has_line(linenum + 1) and \
            ((self.lines[linenum].startswith('--- ') and
              self.lines[linenum + 1].startswith('+++ ')) or
             (self.lines[linenum].startswith('*** ') and
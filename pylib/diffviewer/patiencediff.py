@@ -0,0 +1,139 @@
+from bisect import bisect_left
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+class PatienceDiffer(MyersDiffer):
+    """
+    A differ that splits the problem on unique lines before running the
+    Myers algorithm (the "patience diff" approach used by bzr and git).
+
+    Lines that appear exactly once in both files, in the same relative
+    order, are almost always the lines a person would match up by eye
+    (function definitions, distinctive statements, and so on). Matching
+    those first cuts a large diff into many small, independent ranges,
+    which keeps the O(ND) search cheap on big refactors and tends to give
+    more readable results where code was moved around.
+
+    Ranges with no such anchors are handed to MyersDiffer unchanged. The
+    discarding of confusing lines, the chunk shifting and the opcode format
+    are all shared with MyersDiffer.
+    """
+    def _lcs(self, a_lower, a_upper, b_lower, b_upper, find_minimal):
+        """
+        Splits the range on its unique-line anchors, and runs the Myers
+        LCS over whatever is left between them.
+        """
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
+
+        pending = [(a_lower, a_upper, b_lower, b_upper)]
+
+        while pending:
+            a_lower, a_upper, b_lower, b_upper = pending.pop()
+
+            # Fast walkthrough equal lines at the start and end
+            while a_lower < a_upper and b_lower < b_upper and \
+                  a_undiscarded[a_lower] == b_undiscarded[b_lower]:
+                a_lower += 1
+                b_lower += 1
+
+            while a_upper > a_lower and b_upper > b_lower and \
+                  a_undiscarded[a_upper - 1] == b_undiscarded[b_upper - 1]:
+                a_upper -= 1
+                b_upper -= 1
+
+            anchors = None
+
+            if a_lower < a_upper and b_lower < b_upper:
+                anchors = self._find_anchors(a_lower, a_upper,
+                                             b_lower, b_upper)
+
+            if not anchors:
+                MyersDiffer._lcs(self, a_lower, a_upper, b_lower, b_upper,
+                                 find_minimal)
+                continue
+
+            # Queue up the ranges between the anchors, last one first so
+            # that they're processed from the top of the file down.
+            anchors.append((a_upper, b_upper))
+            a_start, b_start = a_lower, b_lower
+            ranges = []
+
+            for a_anchor, b_anchor in anchors:
+                ranges.append((a_start, a_anchor, b_start, b_anchor))
+                a_start, b_start = a_anchor + 1, b_anchor + 1
+
+            ranges.reverse()
+            pending.extend(ranges)
+
+    def _find_anchors(self, a_lower, a_upper, b_lower, b_upper):
+        return find_unique_anchors(self.a_data.undiscarded, a_lower, a_upper,
+                                   self.b_data.undiscarded, b_lower, b_upper)
+
+
+def find_unique_anchors(a, a_lower, a_upper, b, b_lower, b_upper):
+    """
+    Returns the longest run of (i, j) index pairs, increasing on both sides,
+    of items that occur exactly once in a[a_lower:a_upper] and exactly once
+    in b[b_lower:b_upper]. Returns None if there are no such items.
+    """
+    # Maps each item to the index of its only occurrence in a, or -1 if it
+    # occurs more than once.
+    a_unique = {}
+
+    for i in xrange(a_lower, a_upper):
+        item = a[i]
+        if item in a_unique:
+            a_unique[item] = -1
+        else:
+            a_unique[item] = i
+
+    b_unique = {}
+
+    for j in xrange(b_lower, b_upper):
+        item = b[j]
+        if a_unique.get(item, -1) != -1:
+            if item in b_unique:
+                b_unique[item] = -1
+            else:
+                b_unique[item] = j
+
+    matches = [(a_unique[item], j)
+               for item, j in b_unique.iteritems()
+               if j != -1]
+
+    if not matches:
+        return None
+
+    matches.sort()
+
+    # Patience sorting: find the longest increasing subsequence of the b
+    # indexes, in a order.
+    tails = []
+    tail_indexes = []
+    backpointers = [None] * len(matches)
+
+    for index, (i, j) in enumerate(matches):
+        pile = bisect_left(tails, j)
+
+        if pile > 0:
+            backpointers[index] = tail_indexes[pile - 1]
+
+        if pile == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[pile] = j
+            tail_indexes[pile] = index
+
+    anchors = []
+    index = tail_indexes[-1]
+
+    while index is not None:
+        anchors.append(matches[index])
+        index = backpointers[index]
+
+    anchors.reverse()
+
+    return anchors
@@ -6,6 +6,9 @@ class SMDiffer(SequenceMatcher):
     Wrapper around SequenceMatcher that works around bugs in how it does
     its matching.
     """
+    # SequenceMatcher never cuts its search short.
+    approximated = False
+
     def __init__(self, a, b):
         SequenceMatcher.__init__(self, None, a, b)
 
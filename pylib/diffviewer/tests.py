@@ -1,9 +1,15 @@
 import os
+import random
+import sys
+import time
+import traceback
 import unittest
 
 from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
 
+from reviewboard.diffviewer.myersdiff import LineCodeTable
+from reviewboard.diffviewer.patcher import PatchError, apply_patch
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
 import reviewboard.diffviewer.diffutils as diffutils
 import reviewboard.diffviewer.parser as diffparser
@@ -75,12 +81,231 @@ class MyersDifferTest(TestCase):
                           ("insert", 19, 19, 333, 402),
                           ("equal",  19, 20, 402, 403)])
 
+    def testRatio(self):
+        """Testing myers differ ratio"""
+        self.assertEquals(diffutils.MyersDiffer([1, 2, 3], [1, 2, 3]).ratio(),
+                          1.0)
+        self.assertEquals(diffutils.MyersDiffer([1, 2, 3], [1, 2, 4]).ratio(),
+                          4.0 / 6)
+
+    def testApproximate(self):
+        """Testing myers differ with a cost budget"""
+        a = range(200)
+        b = a[1::2] + a[::2]
+
+        differ = diffutils.MyersDiffer(a, b)
+        list(differ.get_opcodes())
+        self.assertFalse(differ.approximated)
+
+        differ = diffutils.Differ(a, b, max_cost=1)
+        opcodes = list(differ.get_opcodes())
+        self.assertTrue(differ.approximated)
+
+        i = j = 0
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEquals((i1, j1), (i, j))
+            if tag == "equal":
+                self.assertEquals(a[i1:i2], b[j1:j2])
+            i, j = i2, j2
+        self.assertEquals((i, j), (len(a), len(b)))
+
+    def testTimeBudget(self):
+        """Testing myers differ keeps to its time budget"""
+        random.seed(1)
+        a = ["line %d" % random.randrange(50) for i in xrange(3000)]
+        b = ["line %d" % random.randrange(50) for i in xrange(3000)]
+
+        for fast_approximate in (False, True):
+            differ = diffutils.Differ(a, b, fast_approximate=fast_approximate,
+                                      time_budget=0.5)
+            start = time.time()
+            opcodes = list(differ.get_opcodes())
+            elapsed = time.time() - start
+
+            self.assertTrue(differ.approximated)
+            self.assertTrue(elapsed < 0.6, "took %.2fs" % elapsed)
+
+            i = j = 0
+            for tag, i1, i2, j1, j2 in opcodes:
+                self.assertEquals((i1, j1), (i, j))
+                if tag == "equal":
+                    self.assertEquals(a[i1:i2], b[j1:j2])
+                i, j = i2, j2
+            self.assertEquals((i, j), (len(a), len(b)))
+
+    def testSharedCodeTable(self):
+        """Testing myers differs sharing a line code table"""
+        code_table = LineCodeTable()
+        differ = diffutils.Differ(["a", "b", "c"], ["a", "c"],
+                                  code_table=code_table)
+        self.assertEquals(list(differ.get_opcodes()),
+                          [("equal", 0, 1, 0, 1),
+                           ("delete", 1, 2, 1, 1),
+                           ("equal", 2, 3, 1, 2)])
+        self.assertEquals(len(code_table), 3)
+
+        differ = diffutils.Differ(["c", "d"], ["a", "d"],
+                                  code_table=code_table)
+        self.assertEquals(list(differ.get_opcodes()),
+                          [("replace", 0, 1, 0, 1),
+                           ("equal", 1, 2, 1, 2)])
+        self.assertEquals(len(code_table), 4)
+
+    def testCodeTableCollisions(self):
+        """Testing line code table with colliding hashes"""
+        # -1 and -2 hash to the same value.
+        self.assertEquals(hash(-1), hash(-2))
+
+        code_table = LineCodeTable()
+        codes = code_table.get_codes([-1, -2, -1, -2])
+        self.assertNotEquals(codes[0], codes[1])
+        self.assertEquals(codes, [codes[0], codes[1]] * 2)
+        self.assertEquals(code_table.get_code(-2), codes[1])
+
+    def testStress(self):
+        """Testing myers differ on 1M line inputs (SBSDIFF_STRESS_TESTS=1)"""
+        if not os.environ.get('SBSDIFF_STRESS_TESTS'):
+            self.skipTest("set SBSDIFF_STRESS_TESTS=1 to run")
+
+        num_lines = 1000000
+        a = ["line %d" % (i % 5000) for i in xrange(num_lines)]
+        b = list(a)
+
+        for i in xrange(0, num_lines, 1000):
+            b[i] = "line %d" % ((i * 7 + 3) % 5000)
+
+        class DepthCountingDiffer(diffutils.MyersDiffer):
+            depth = max_depth = 0
+
+            def _lcs(self, *args):
+                self.depth += 1
+                self.max_depth = max(self.max_depth, self.depth)
+                try:
+                    return diffutils.MyersDiffer._lcs(self, *args)
+                finally:
+                    self.depth -= 1
+
+        # The differ must not depend on the size of the input for its call
+        # depth, so leave it room for its own calls but not for recursing
+        # through the input.
+        differ = DepthCountingDiffer(a, b)
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(traceback.extract_stack()) + 200)
+        try:
+            opcodes = list(differ.get_opcodes())
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+        self.assertEquals(differ.max_depth, 1)
+
+        i = j = 0
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEquals((i1, j1), (i, j))
+            i, j = i2, j2
+        self.assertEquals((i, j), (num_lines, num_lines))
 
     def __test_diff(self, a, b, expected):
         opcodes = list(diffutils.MyersDiffer(a, b).get_opcodes())
         self.assertEquals(opcodes, expected)
 
 
+class PatienceDifferTest(TestCase):
+    def testDiff(self):
+        """Testing patience differ"""
+        self.__test_diff(["1", "2", "3"],
+                         ["1", "2", "3"],
+                         [("equal", 0, 3, 0, 3),])
+
+        self.__test_diff(["1", "2", "3"],
+                         [],
+                         [("delete", 0, 3, 0, 0),])
+
+        self.__test_diff("1\n2\n3\n7\n",
+                         "1\n2\n4\n5\n6\n7\n",
+                         [("equal",   0, 4, 0, 4),
+                          ("replace", 4, 5, 4, 5),
+                          ("insert",  5, 5, 5, 9),
+                          ("equal",   5, 8, 9, 12)])
+
+    def testMovedBlock(self):
+        """Testing patience differ with a moved block"""
+        a = ["def a():", "    a = 1", "    return a", "",
+             "def b():", "    b = 2", "    return b", "",
+             "def c():", "    return 3"]
+        b = ["def b():", "    b = 2", "    return b", "",
+             "def c():", "    return 3", "",
+             "def a():", "    a = 1", "    return a"]
+
+        self.__test_diff(a, b,
+                         [("delete",  0,  4, 0,  0),
+                          ("equal",   4, 10, 0,  6),
+                          ("insert", 10, 10, 6, 10)])
+
+    def testDifferFactory(self):
+        """Testing Differ with compat version 2"""
+        differ = diffutils.Differ(["1"], ["2"], compat_version=2)
+        self.assertTrue(isinstance(differ, diffutils.PatienceDiffer))
+
+    def __test_diff(self, a, b, expected):
+        opcodes = list(diffutils.PatienceDiffer(a, b).get_opcodes())
+        self.assertEquals(opcodes, expected)
+
+
+class AnchoredDifferTest(TestCase):
+    class SplittingDiffer(diffutils.AnchoredDiffer):
+        MIN_SPLIT_LINES = 0
+        MIN_REGION_LINES = 4
+
+    def testDiff(self):
+        """Testing anchored differ"""
+        a = ["header", "1", "2", "3", "middle", "4", "5", "6", "footer"]
+        b = ["header", "1", "x", "3", "middle", "4", "5", "y", "6", "footer"]
+
+        differ = self.SplittingDiffer(a, b)
+        self.assertTrue(len(differ._split(a, b)) > 1)
+        self.assertEquals(list(differ.get_opcodes()),
+                          [("equal",   0, 2, 0, 2),
+                           ("replace", 2, 3, 2, 3),
+                           ("equal",   3, 7, 3, 7),
+                           ("insert",  7, 7, 7, 8),
+                           ("equal",   7, 9, 8, 10)])
+
+    def testTimeBudget(self):
+        """Testing anchored differ shares its time budget between regions"""
+        budgets = []
+
+        class SlowDiffer(diffutils.MyersDiffer):
+            def __init__(self, a, b, **kwargs):
+                budgets.append(kwargs["time_budget"])
+                time.sleep(0.05)
+                diffutils.MyersDiffer.__init__(self, a, b, **kwargs)
+
+        a = ["header", "1", "2", "3", "middle", "4", "5", "6", "footer"]
+        b = ["header", "1", "x", "3", "middle", "4", "5", "y", "6", "footer"]
+
+        differ = self.SplittingDiffer(a, b, differ_class=SlowDiffer,
+                                      time_budget=0.06)
+        list(differ.get_opcodes())
+
+        # Each region gets less time than the last, and by the third one
+        # the whole budget is gone.
+        self.assertTrue(len(budgets) > 2)
+        self.assertTrue(budgets[0] <= 0.06)
+        self.assertEquals(budgets, sorted(budgets, reverse=True))
+        self.assertEquals(budgets[-1], 0)
+
+    def testSmallInput(self):
+        """Testing anchored differ doesn't split small inputs"""
+        a = ["a", "b", "c"]
+        b = ["a", "c"]
+
+        differ = diffutils.Differ(a, b, processes=2)
+        self.assertTrue(isinstance(differ, diffutils.AnchoredDiffer))
+        self.assertEquals(differ._split(a, b), [(0, 3, 0, 2)])
+        self.assertEquals(list(differ.get_opcodes()),
+                          list(diffutils.MyersDiffer(a, b).get_opcodes()))
+
+
 class DiffParserTest(unittest.TestCase):
     PREFIX = 'diffviewer/testdata'
 
@@ -123,6 +348,16 @@ class DiffParserTest(unittest.TestCase):
         files = diffparser.DiffParser(data).parse()
         self.compareDiffs(files, "context")
 
+    def testIterFiles(self):
+        """Testing parsing a diff from a path one file at a time"""
+        diff = self._get_file('diffs', 'unified', 'README.crlf.diff')
+        files = diffparser.DiffParser.from_path(
+            "%s/diffs/unified/README.crlf.diff" % self.PREFIX).iter_files()
+
+        # The data is the diff as it is, line endings and all.
+        self.assertEqual(files.next().data, diff)
+        self.assertRaises(StopIteration, files.next)
+
     def testPatch(self):
         """Testing patching"""
 
@@ -138,6 +373,30 @@ class DiffParserTest(unittest.TestCase):
         diff = self._get_file('diffs', 'unified', 'README.diff')
         self.assertRaises(Exception, lambda: diffutils.patch(diff, old, file))
 
+    def testPatchReverse(self):
+        """Testing patching in reverse"""
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        patched = apply_patch(diff, new, reverse=True)
+        self.assertEqual(patched, old)
+
+    def testPatchOffsetAndFuzz(self):
+        """Testing patching with an offset and fuzz"""
+        old = "".join(["%d\n" % i for i in xrange(20)])
+        diff = "--- a\n+++ b\n@@ -9,5 +9,5 @@\n 8\n 9\n-10\n+ten\n 11\n 12\n"
+
+        # Lines added above the hunk.
+        patched = apply_patch(diff, "x\ny\n" + old)
+        self.assertEqual(patched, "x\ny\n" + old.replace("10\n", "ten\n"))
+
+        # A changed line of context.
+        fuzzy = old.replace("\n8\n", "\neight\n")
+        patched = apply_patch(diff, fuzzy)
+        self.assertEqual(patched, fuzzy.replace("10\n", "ten\n"))
+        self.assertRaises(PatchError, apply_patch, diff, fuzzy, fuzz=0)
+
     def testEmptyPatch(self):
         """Testing patching with an empty diff"""
         old = 'This is a test'
@@ -337,6 +337,7 @@ class HtmlFormatter(Formatter):
         self.lineanchors = options.get('lineanchors', '')
 
         self._class_cache = {}
+        self._span_cache = {}
         self._create_stylesheet()
 
     def _get_css_class(self, ttype):
@@ -517,64 +518,99 @@ class HtmlFormatter(Formatter):
             yield tup
         yield 0, '</pre>'
 
-    def _format_lines(self, tokensource):
+    def _get_span(self, ttype):
         """
-        Just format the tokens, without any wrapping tags.
-        Yield individual lines.
+        Return the tags that open and close the ``<span>`` of a token type,
+        which are empty if it has no class or style.
+        """
+        if self.noclasses:
+            # for <span style=""> lookup only
+            getcls = self.ttype2class.get
+            cclass = getcls(ttype)
+            while cclass is None:
+                ttype = ttype.parent
+                cclass = getcls(ttype)
+            cspan = cclass and '<span style="%s">' % \
+                               self.class2style[cclass][0] or ''
+        else:
+            cls = self._get_css_class(ttype)
+            cspan = cls and '<span class="%s">' % cls or ''
+        return cspan, cspan and '</span>' or ''
+
+    def iter_lines(self, tokensource):
         """
-        nocls = self.noclasses
+        Format the tokens, without any wrapping tags or line separators.
+        Yield the markup of each source line.
+        """
+        spans = self._span_cache
         enc = self.encoding
-        lsep = self.lineseparator
-        # for <span style=""> lookup only
-        getcls = self.ttype2class.get
-        c2s = self.class2style
+        escaped = {}
 
-        lspan = ''
-        line = ''
+        lspan = lclose = ''
+        line = []
         for ttype, value in tokensource:
-            if nocls:
-                cclass = getcls(ttype)
-                while cclass is None:
-                    ttype = ttype.parent
-                    cclass = getcls(ttype)
-                cspan = cclass and '<span style="%s">' % c2s[cclass][0] or ''
-            else:
-                cls = self._get_css_class(ttype)
-                cspan = cls and '<span class="%s">' % cls or ''
+            try:
+                cspan, cclose = spans[ttype]
+            except KeyError:
+                cspan, cclose = spans[ttype] = self._get_span(ttype)
 
             if enc:
                 value = value.encode(enc)
 
-            parts = escape_html(value).split('\n')
-
-            # for all but the last line
-            for part in parts[:-1]:
-                if line:
-                    if lspan != cspan:
-                        line += (lspan and '</span>') + cspan + part + \
-                                (cspan and '</span>') + lsep
-                    else: # both are the same
-                        line += part + (lspan and '</span>') + lsep
-                    yield 1, line
-                    line = ''
-                elif part:
-                    yield 1, cspan + part + (cspan and '</span>') + lsep
-                else:
-                    yield 1, lsep
+            if '\n' in value:
+                parts = escape_html(value).split('\n')
+
+                # for all but the last line
+                for part in parts[:-1]:
+                    if line:
+                        if lspan != cspan:
+                            line.extend((lclose, cspan, part, cclose))
+                        else: # both are the same
+                            line.extend((part, lclose))
+                        yield ''.join(line)
+                        line = []
+                    elif part:
+                        yield cspan + part + cclose
+                    else:
+                        yield ''
+                part = parts[-1]
+            else:
+                # the same names, operators and whitespace keep coming up
+                part = escaped.get(value)
+                if part is None:
+                    part = escaped[value] = escape_html(value)
+
             # for the last line
-            if line and parts[-1]:
+            if line and part:
                 if lspan != cspan:
-                    line += (lspan and '</span>') + cspan + parts[-1]
-                    lspan = cspan
+                    line.extend((lclose, cspan, part))
+                    lspan, lclose = cspan, cclose
                 else:
-                    line += parts[-1]
-            elif parts[-1]:
-                line = cspan + parts[-1]
-                lspan = cspan
+                    line.append(part)
+            elif part:
+                line = [cspan, part]
+                lspan, lclose = cspan, cclose
             # else we neither have to open a new span nor set lspan
 
         if line:
-            yield 1, line + (lspan and '</span>') + lsep
+            line.append(lclose)
+            yield ''.join(line)
+
+    def format_lines(self, tokensource):
+        """
+        Return a list with the markup of each source line, as given by
+        `iter_lines`.
+        """
+        return list(self.iter_lines(tokensource))
+
+    def _format_lines(self, tokensource):
+        """
+        Just format the tokens, without any wrapping tags.
+        Yield individual lines.
+        """
+        lsep = self.lineseparator
+        for line in self.iter_lines(tokensource):
+            yield 1, line + lsep
 
     def wrap(self, source, outfile):
         """
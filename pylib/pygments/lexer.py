@@ -9,6 +9,9 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+import sre_compile
+import sre_constants
+import sre_parse
 
 try:
     set
@@ -343,6 +346,83 @@ def using(_other, **kwargs):
     return callback
 
 
+# The characters that the rules of a state are dispatched on. Anything
+# else tries all of them.
+_DISPATCH_CHARS = [unichr(i) for i in xrange(128)]
+
+
+def _first_chars(items, state, flags):
+    """
+    Return ``(chars, nullable)`` for the parsed regex ``items``: the set of
+    `_DISPATCH_CHARS` that a match can start with (``None`` if that can't
+    be told) and whether a match can be empty.
+    """
+    chars = set()
+    for op, av in items:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                  sre_constants.ANY, sre_constants.IN):
+            # a single character: ask a regex of just that
+            match = sre_compile.compile(sre_parse.SubPattern(state, [(op, av)]),
+                                        flags).match
+            chars.update([c for c in _DISPATCH_CHARS if match(c)])
+            return chars, False
+        elif op == sre_constants.SUBPATTERN:
+            subchars, nullable = _first_chars(av[-1], state, flags)
+        elif op == sre_constants.BRANCH:
+            nullable = False
+            subchars = set()
+            for branch in av[1]:
+                branchchars, branchnullable = _first_chars(branch, state, flags)
+                if branchchars is None:
+                    return None, True
+                subchars.update(branchchars)
+                nullable = nullable or branchnullable
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            subchars, nullable = _first_chars(av[2], state, flags)
+            nullable = nullable or av[0] == 0
+        elif op in (sre_constants.AT, sre_constants.ASSERT,
+                    sre_constants.ASSERT_NOT):
+            # zero-width, so the next item decides
+            continue
+        else:
+            return None, True
+        if subchars is None:
+            return None, True
+        chars.update(subchars)
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def _rule_first_chars(rex):
+    """
+    Return the set of `_DISPATCH_CHARS` that a match of the compiled
+    rule ``rex`` can start with, or ``None`` if it can be empty or
+    anything else gets in the way of telling.
+    """
+    pattern = rex.__self__
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        chars, nullable = _first_chars(parsed, parsed.pattern, pattern.flags)
+    except Exception:
+        return None
+    if nullable:
+        return None
+    return chars
+
+
+class _StateTokens(list):
+    """
+    The rules of a state, with ``table``, which maps each of the
+    `_DISPATCH_CHARS` to the rules (in order) that can match starting with
+    it. The other rules can't match there, so they needn't be tried.
+    """
+
+    def __init__(self, tokens, table):
+        list.__init__(self, tokens)
+        self.table = table
+
+
 class RegexLexerMeta(LexerMeta):
     """
     Metaclass for RegexLexer, creates the self._tokens attribute from
@@ -413,11 +493,34 @@ class RegexLexerMeta(LexerMeta):
             tokens.append((rex, tdef[1], new_state))
         return tokens
 
+    def _build_dispatch(cls, processed):
+        """
+        Replace each state in ``processed`` with a `_StateTokens`.
+        """
+        first_chars = {}
+        for state, tokens in processed.items():
+            rules = []
+            for rule in tokens:
+                if rule[0] not in first_chars:
+                    first_chars[rule[0]] = _rule_first_chars(rule[0])
+                rules.append((rule, first_chars[rule[0]]))
+            table = {}
+            # the same rules keep coming up, so share them
+            seen = {}
+            for c in _DISPATCH_CHARS:
+                indexes = tuple([i for i, (rule, chars) in enumerate(rules)
+                                 if chars is None or c in chars])
+                if indexes not in seen:
+                    seen[indexes] = tuple([tokens[i] for i in indexes])
+                table[c] = seen[indexes]
+            processed[state] = _StateTokens(tokens, table)
+
     def process_tokendef(cls, name, tokendefs=None):
         processed = cls._all_tokens[name] = {}
         tokendefs = tokendefs or cls.tokens[name]
         for state in tokendefs.keys():
             cls._process_state(tokendefs, processed, state)
+        cls._build_dispatch(processed)
         return processed
 
     def __call__(cls, *args, **kwds):
@@ -470,15 +573,34 @@ class RegexLexer(Lexer):
 
         ``stack`` is the inital stack (default: ``['root']``)
         """
+        return self.get_tokens_from_stack(text, list(stack))
+
+    def get_tokens_from_stack(self, text, statestack, match_start=None):
+        """
+        Like `get_tokens_unprocessed`, but starting from the list
+        ``statestack``, which is changed in place as the lexer moves
+        between states. When a token comes out, ``statestack`` holds the
+        state it was matched in. If the list ``match_start`` is given, its
+        first item is set to where that match started, which is before the
+        token for all but the first of the tokens of a callback.
+        """
+        if match_start is None:
+            match_start = [0]
         pos = 0
+        textlen = len(text)
         tokendefs = self._tokens
-        statestack = list(stack)
         statetokens = tokendefs[statestack[-1]]
         while 1:
-            for rexmatch, action, new_state in statetokens:
+            if pos < textlen:
+                # only the rules that can match this character
+                rules = statetokens.table.get(text[pos], statetokens)
+            else:
+                rules = statetokens
+            for rexmatch, action, new_state in rules:
                 m = rexmatch(text, pos)
                 if m:
                     # print rex.pattern
+                    match_start[0] = pos
                     if type(action) is _TokenType:
                         yield pos, action, m.group()
                     else:
@@ -509,10 +631,12 @@ class RegexLexer(Lexer):
                     if text[pos] == '\n':
                         # at EOL, reset state to "root"
                         pos += 1
-                        statestack = ['root']
+                        statestack[:] = ['root']
                         statetokens = tokendefs['root']
+                        match_start[0] = pos
                         yield pos, Text, u'\n'
                         continue
+                    match_start[0] = pos
                     yield pos, Error, text[pos]
                     pos += 1
                 except IndexError:
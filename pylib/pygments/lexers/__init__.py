@@ -10,7 +10,7 @@
 """
 import fnmatch
 import types
-from os.path import basename
+from os.path import basename, normcase
 
 try:
     set
@@ -23,10 +23,15 @@ from pygments.util import ClassNotFound
 
 
 __all__ = ['get_lexer_by_name', 'get_lexer_for_filename', 'find_lexer_class',
-           'guess_lexer'] + LEXERS.keys()
+           'find_lexer_class_for_filename', 'guess_lexer'] + LEXERS.keys()
 
 _lexer_cache = {}
 
+# The index of the builtin lexers' filename patterns (see
+# _build_filename_index), and the lexer found for each basename so far.
+_filename_index = None
+_filename_matches = {}
+
 
 def _load_lexers(module_name):
     """
@@ -83,22 +88,99 @@ def get_lexer_by_name(_alias, **options):
     raise ClassNotFound('no lexer for alias %r found' % _alias)
 
 
-def get_lexer_for_filename(_fn, **options):
+def _build_filename_index():
     """
-    Get a lexer for a filename.
+    Index the filename patterns of the builtin lexers.
+
+    Returns a tuple ``(names, suffixes, patterns)``: a dict of the patterns
+    without wildcards, a dict of the ``*<suffix>`` patterns keyed by the
+    extension they end in, and a list of all other patterns. Every entry
+    is ``(order, pattern, modname, name)``, where order is the position of
+    the pattern in a walk over ``LEXERS``, so that the first match of that
+    walk can still be picked.
+    """
+    names = {}
+    suffixes = {}
+    patterns = []
+    for lexer_index, (modname, name, _, filenames, _) in \
+            enumerate(LEXERS.itervalues()):
+        for pattern_index, filename in enumerate(filenames):
+            # fnmatch.fnmatch normalizes case the same way.
+            filename = normcase(filename)
+            entry = ((lexer_index, pattern_index), filename, modname, name)
+            suffix = filename[1:]
+            if not _has_magic(filename):
+                names.setdefault(filename, entry)
+            elif filename.startswith('*') and not _has_magic(suffix) and \
+                 '.' in suffix:
+                suffixes.setdefault(suffix.rsplit('.', 1)[1], []).append(entry)
+            else:
+                patterns.append(entry)
+    return names, suffixes, patterns
+
+
+def _has_magic(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+
+def _match_filename(fn):
+    """
+    Return ``(modname, name)`` of the builtin lexer for the basename fn,
+    or None. This gives the same lexer as trying the patterns of every
+    lexer in turn, but looks most of them up directly.
+    """
+    global _filename_index
+    if _filename_index is None:
+        _filename_index = _build_filename_index()
+    names, suffixes, patterns = _filename_index
+    fn = normcase(fn)
+    best = names.get(fn)
+    if '.' in fn:
+        for entry in suffixes.get(fn.rsplit('.', 1)[1], ()):
+            if best is not None and entry[0] > best[0]:
+                break
+            if fn.endswith(entry[1][1:]):
+                best = entry
+                break
+    for entry in patterns:
+        if best is not None and entry[0] > best[0]:
+            break
+        if fnmatch.fnmatchcase(fn, entry[1]):
+            best = entry
+            break
+    if best is None:
+        return None
+    return best[2], best[3]
+
+
+def find_lexer_class_for_filename(_fn):
+    """
+    Lookup the lexer class for a filename. Return None if not found.
     """
     fn = basename(_fn)
-    for modname, name, _, filenames, _ in LEXERS.itervalues():
-        for filename in filenames:
-            if fnmatch.fnmatch(fn, filename):
-                if name not in _lexer_cache:
-                    _load_lexers(modname)
-                return _lexer_cache[name](**options)
+    try:
+        match = _filename_matches[fn]
+    except KeyError:
+        match = _filename_matches[fn] = _match_filename(fn)
+    if match is not None:
+        modname, name = match
+        if name not in _lexer_cache:
+            _load_lexers(modname)
+        return _lexer_cache[name]
     for cls in find_plugin_lexers():
         for filename in cls.filenames:
             if fnmatch.fnmatch(fn, filename):
-                return cls(**options)
-    raise ClassNotFound('no lexer for filename %r found' % _fn)
+                return cls
+
+
+def get_lexer_for_filename(_fn, **options):
+    """
+    Get a lexer for a filename.
+    """
+    cls = find_lexer_class_for_filename(_fn)
+    if cls is None:
+        raise ClassNotFound('no lexer for filename %r found' % _fn)
+    return cls(**options)
 
 
 def get_lexer_for_mimetype(_mime, **options):
@@ -35,10 +35,10 @@
     :copyright: 2006-2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
-try:
-    import pkg_resources
-except ImportError:
-    pkg_resources = None
+# pkg_resources is slow to import, so it's only imported once plugins are
+# first looked for (see _iter_entry_points).
+pkg_resources = None
+_pkg_resources_imported = False
 
 LEXER_ENTRY_POINT = 'pygments.lexers'
 FORMATTER_ENTRY_POINT = 'pygments.formatters'
@@ -46,29 +46,34 @@ STYLE_ENTRY_POINT = 'pygments.styles'
 FILTER_ENTRY_POINT = 'pygments.filters'
 
 
-def find_plugin_lexers():
+def _iter_entry_points(group):
+    global pkg_resources, _pkg_resources_imported
+    if not _pkg_resources_imported:
+        try:
+            import pkg_resources
+        except ImportError:
+            pkg_resources = None
+        _pkg_resources_imported = True
     if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(LEXER_ENTRY_POINT):
+        return []
+    return pkg_resources.iter_entry_points(group)
+
+
+def find_plugin_lexers():
+    for entrypoint in _iter_entry_points(LEXER_ENTRY_POINT):
         yield entrypoint.load()
 
 
 def find_plugin_formatters():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(FORMATTER_ENTRY_POINT):
+    for entrypoint in _iter_entry_points(FORMATTER_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
 
 
 def find_plugin_styles():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(STYLE_ENTRY_POINT):
+    for entrypoint in _iter_entry_points(STYLE_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
 
 
 def find_plugin_filters():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(FILTER_ENTRY_POINT):
+    for entrypoint in _iter_entry_points(FILTER_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
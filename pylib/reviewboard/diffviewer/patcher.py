@@ -0,0 +1,258 @@
+import re
+
+
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(Exception):
+    pass
+
+
+class Hunk(object):
+    """
+    One hunk of a unified diff. The old and new lines keep their newlines,
+    except for a last line marked with "\ No newline at end of file".
+    """
+    def __init__(self, old_start, old_len, new_start, new_len):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.old_lines = []
+        self.new_lines = []
+
+        # Number of context lines at the start and the end of the hunk,
+        # which may be ignored when applying it with fuzz.
+        self.prefix_len = 0
+        self.suffix_len = 0
+
+
+def convert_line_endings(data):
+    # Files without a trailing newline come out of Perforce (and possibly
+    # other systems) with a trailing \r. Diff will see the \r and
+    # add a "\ No newline at end of file" marker at the end of the file's
+    # contents, which patch understands and will happily apply this to
+    # a file with a trailing \r.
+    #
+    # The problem is that we normalize \r's to \n's, which breaks patch.
+    # Our solution to this is to just remove that last \r and not turn
+    # it into a \n.
+    #
+    # See http://code.google.com/p/reviewboard/issues/detail?id=386
+    # and http://reviews.review-board.org/r/286/
+    if data == "":
+        return ""
+
+    if data[-1] == "\r":
+        data = data[:-1]
+
+    temp = data.replace('\r\n', '\n')
+    temp = temp.replace('\r', '\n')
+    return temp
+
+
+def split_lines(data):
+    """
+    Splits data into lines, keeping their newlines.
+    """
+    lines = [line + "\n" for line in data.split("\n")]
+
+    # The last piece is either empty (the data ended with a newline) or a
+    # line without one.
+    last = lines.pop()[:-1]
+
+    if last:
+        lines.append(last)
+
+    return lines
+
+
+def parse_hunks(diff):
+    """
+    Returns the list of Hunks in a unified diff. Anything outside the hunks,
+    such as the file headers, is skipped.
+    """
+    hunks = []
+    hunk = None
+    old_left = new_left = 0
+    in_prefix = False
+    last_tag = None
+
+    for line in split_lines(diff):
+        if line.startswith("\\"):
+            # "\ No newline at end of file" applies to the line before it.
+            if hunk is not None and last_tag is not None:
+                if last_tag in " -":
+                    hunk.old_lines[-1] = hunk.old_lines[-1].rstrip("\n")
+                if last_tag in " +":
+                    hunk.new_lines[-1] = hunk.new_lines[-1].rstrip("\n")
+
+            continue
+
+        if old_left > 0 or new_left > 0:
+            # Some tools strip the space from empty context lines.
+            if line == "\n":
+                line = " \n"
+
+            tag = line[0]
+            text = line[1:]
+
+            if tag == " ":
+                old_left -= 1
+                new_left -= 1
+                hunk.old_lines.append(text)
+                hunk.new_lines.append(text)
+
+                if in_prefix:
+                    hunk.prefix_len += 1
+                else:
+                    hunk.suffix_len += 1
+            elif tag == "-":
+                old_left -= 1
+                hunk.old_lines.append(text)
+            elif tag == "+":
+                new_left -= 1
+                hunk.new_lines.append(text)
+            else:
+                raise PatchError("Malformed hunk at line %d of the diff" %
+                                 hunk.old_start)
+
+            if tag != " ":
+                in_prefix = False
+                hunk.suffix_len = 0
+
+            last_tag = tag
+            continue
+
+        last_tag = None
+        m = HUNK_HEADER_RE.match(line)
+
+        if m:
+            old_start, old_len, new_start, new_len = \
+                [int(x or 1) for x in m.groups()]
+            hunk = Hunk(old_start, old_len, new_start, new_len)
+            hunks.append(hunk)
+            old_left, new_left = old_len, new_len
+            in_prefix = True
+
+    if old_left > 0 or new_left > 0:
+        raise PatchError("The diff ends in the middle of a hunk")
+
+    return hunks
+
+
+def _find_lines(lines, pattern, expected, lower, upper):
+    """
+    Returns the index between ``lower`` and ``upper`` closest to
+    ``expected`` at which ``pattern`` appears in lines, or None.
+    """
+    size = len(pattern)
+    upper = min(upper, len(lines) - size)
+
+    if upper < lower:
+        return None
+
+    expected = min(max(expected, lower), upper)
+
+    if not pattern:
+        return expected
+
+    first = pattern[0]
+
+    for distance in xrange(max(expected - lower, upper - expected) + 1):
+        for i in (expected - distance, expected + distance):
+            if lower <= i <= upper and lines[i] == first and \
+               lines[i:i + size] == pattern:
+                return i
+
+    return None
+
+
+def apply_patch(diff, data, reverse=False, fuzz=2, normalize=True):
+    """
+    Applies a unified diff to the contents of a file, and returns the
+    patched contents.
+
+    This works like ``patch``: a hunk that isn't found at the line given in
+    its header is looked for above and below it, and if it still doesn't
+    match, up to ``fuzz`` lines of context at either end of it are ignored.
+    With ``reverse``, the diff is taken back out of the file instead.
+
+    If ``normalize`` is set, line endings in the diff and the file are
+    normalized with convert_line_endings, so the result always uses "\n".
+    Otherwise lines are split on "\n" alone, and any "\r" is kept as part
+    of the line. Raises PatchError if a hunk can't be applied.
+    """
+    if normalize:
+        data = convert_line_endings(data)
+        diff = convert_line_endings(diff)
+
+    lines = split_lines(data)
+    hunks = parse_hunks(diff)
+
+    if not hunks:
+        raise PatchError("The diff has no hunks")
+
+    result = []
+    pos = 0
+    offset = 0
+
+    for num, hunk in enumerate(hunks):
+        if reverse:
+            old_lines, new_lines = hunk.new_lines, hunk.old_lines
+            start = hunk.new_start
+        else:
+            old_lines, new_lines = hunk.old_lines, hunk.new_lines
+            start = hunk.old_start
+
+        # Empty sides give the line number before the hunk.
+        if old_lines:
+            start -= 1
+
+        start += offset
+
+        # As with patch, fuzz is counted against the longer of the leading
+        # and trailing context. A hunk with less context on one side than
+        # the other is at the start or end of the file, and must match
+        # there.
+        context = max(hunk.prefix_len, hunk.suffix_len)
+
+        for level in xrange(fuzz + 1):
+            prefix = min(level + hunk.prefix_len - context, hunk.prefix_len)
+            suffix = min(level + hunk.suffix_len - context, hunk.suffix_len)
+            pattern = old_lines[max(prefix, 0):len(old_lines) - max(suffix, 0)]
+            lower = pos
+            upper = len(lines)
+
+            if prefix < 0:
+                lower = upper = 0
+            elif suffix < 0:
+                lower = upper = max(len(lines) - len(pattern), pos)
+
+            if prefix < 0 and suffix < 0 and len(pattern) != len(lines):
+                found = None
+            else:
+                prefix = max(prefix, 0)
+                suffix = max(suffix, 0)
+                found = _find_lines(lines, pattern, start + prefix,
+                                    lower, upper)
+
+            if found is not None:
+                break
+        else:
+            raise PatchError("Hunk #%d (line %d) doesn't apply" %
+                             (num + 1, start - offset + 1))
+
+        result.extend(lines[pos:found])
+        result.extend(new_lines[prefix:len(new_lines) - suffix])
+        pos = found + len(old_lines) - prefix - suffix
+
+        if pos < len(lines) and result and not result[-1].endswith("\n"):
+            # The hunk ended the file, but there's more after it here.
+            result[-1] += "\n"
+
+        offset = found - prefix - (start - offset)
+
+    result.extend(lines[pos:])
+
+    return "".join(result)
@@ -45,13 +45,17 @@
 #           which uses a MIT license.
 #
 
-import os
-import sys
 import fnmatch
+import hashlib
+import itertools
 import logging
+import os
 import re
-import subprocess
+import struct
 import tempfile
+import threading
+import time
+import zlib
 from difflib import SequenceMatcher
 
 try:
@@ -62,36 +66,137 @@ except ImportError:
     def URIToPath(uri):
         return uri.split("file://", 1)[1]
 
-try:
-    import pygments
-    from pygments.lexers import get_lexer_for_filename
-    # from pygments.lexers import guess_lexer_for_filename
-    from pygments.formatters import HtmlFormatter
-    _have_pygments = True
-except ImportError:
-    import warnings
-    warnings.warn("Could not import pygments", ImportWarning)
-    _have_pygments = False
-
-from django.utils.safestring import mark_safe
+from django.utils.encoding import force_unicode
+from django.utils.safestring import EscapeData, SafeData, mark_safe
 from django.utils.translation import ugettext as _
 from django.utils.html import escape
 
-from reviewboard.diffviewer.myersdiff import MyersDiffer
-from reviewboard.diffviewer.smdiff import SMDiffer
+from reviewboard.diffviewer.patcher import PatchError, apply_patch
+
+# pygments, the differs and the Django template filters are imported the
+# first time they're used (see _import_pygments, Differ and
+# _import_filters), so that opening the first diff doesn't wait for
+# whatever it won't use, such as pygments when highlighting is off.
+# _have_pygments is None until pygments has been looked for.
+_have_pygments = None
+highlightregion = showextrawhitespace = None
+
+
+def _import_pygments():
+    """
+    Imports the parts of pygments used here, the first time it's called.
+    Returns whether pygments is available.
+    """
+    global _have_pygments, pygments, find_lexer_class_for_filename, \
+           HtmlFormatter, apply_filters, RegexLexer, ClassNotFound
+
+    if _have_pygments is None:
+        try:
+            import pygments
+            from pygments.lexers import find_lexer_class_for_filename
+            # from pygments.lexers import guess_lexer_for_filename
+            from pygments.formatters import HtmlFormatter
+            from pygments.filter import apply_filters
+            from pygments.lexer import RegexLexer
+            from pygments.util import ClassNotFound
+            _have_pygments = True
+        except ImportError:
+            import warnings
+            warnings.warn("Could not import pygments", ImportWarning)
+            _have_pygments = False
+
+    return _have_pygments
+
+
+def _import_filters():
+    """
+    Imports the highlightregion and showextrawhitespace template filters,
+    and with them the Django template machinery, the first time it's
+    called.
+    """
+    global highlightregion, showextrawhitespace
+
+    if showextrawhitespace is None:
+        from reviewboard.diffviewer.templatetags.difftags import \
+             highlightregion, showextrawhitespace
 
 
 DEFAULT_DIFF_COMPAT_VERSION = 1
 
+# Seconds the differ may spend looking for a minimal diff of a single file
+# before settling for an approximate one, so that pathological files can't
+# freeze the diff dialog. None means no limit.
+DEFAULT_DIFF_TIME_BUDGET = 5.0
+
+# Number of processes used to diff very large files, which are split into
+# independent regions first (see AnchoredDiffer). None diffs every file in
+# one piece, in Komodo's own process.
+DEFAULT_DIFF_PROCESSES = None
+
+# Whether to leave the lines of collapsed chunks out of the HTML, until
+# they're asked for with DiffItem.get_chunk_html.
+DEFAULT_LAZY_COLLAPSED = True
+
+# Number of processes used to diff and render the files of a changeset (see
+# SideBySideDiff). 0 uses one per CPU, and None renders the files one by
+# one in Komodo's own process.
+DEFAULT_RENDER_PROCESSES = None
+
+# Whether to build the opcodes for files on disk straight from the hunks of
+# their diff (see DifferFromHunks), rather than reconstructing the original
+# file with patch and diffing the two whole files.
+DEFAULT_HUNK_DRIVEN = True
+
+# Total size of the file contents kept between diffs (see FileContentsCache).
+DEFAULT_FILE_CACHE_BYTES = 32 * 1024 * 1024
+
+# Total size of the highlighted files kept on disk (see HighlightCache).
+DEFAULT_HIGHLIGHT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Files are shown without syntax highlighting if either side is bigger than
+# this many bytes, or has a line longer than this many characters (which is
+# usually minified code). None means no limit.
+DEFAULT_HIGHLIGHT_MAX_BYTES = 1024 * 1024
+DEFAULT_HIGHLIGHT_MAX_LINE_LENGTH = 5000
+
+# Seconds that highlighting may take for one file, and for all the files of
+# a diff together, before files are shown without it. None means no limit.
+DEFAULT_HIGHLIGHT_TIME_BUDGET = 3.0
+DEFAULT_DIFF_HIGHLIGHT_TIME_BUDGET = 15.0
+
+# Whether to highlight only the lines of big files that are shown, rather
+# than whole files (see HighlightedLines). This only makes a difference
+# with DEFAULT_LAZY_COLLAPSED, since otherwise every line is shown.
+DEFAULT_HIGHLIGHT_BY_REGION = True
+
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+# Characters that pygments treats as line breaks (the latter only in
+# unicode input), but split_lines doesn't.
+LONE_CR_RE = re.compile(r"\r(?!\n)")
+UNICODE_LINE_BREAK_RE = re.compile(u"[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
 
 class UserVisibleError(Exception):
     pass
 
 
+class DiffCancelled(Exception):
+    pass
+
+
+class HighlightBudgetExceeded(Exception):
+    pass
+
+
 class DiffCompatError(Exception):
     pass
 
 
+class HunkMismatchError(Exception):
+    pass
+
+
 class OpCode(object):
     def __init__(self, tag, i1, i2, j1, j2, i_offset=0, j_offset=0):
         self.tag = tag
@@ -103,20 +208,54 @@ class OpCode(object):
         self.j_offset = j_offset
 
 def Differ(a, b, ignore_space=False,
-           compat_version=DEFAULT_DIFF_COMPAT_VERSION):
+           compat_version=DEFAULT_DIFF_COMPAT_VERSION,
+           fast_approximate=False, max_cost=None, time_budget=None,
+           processes=None, code_table=None):
     """
     Factory wrapper for returning a differ class based on the compat version
     and flags specified.
+
+    fast_approximate, max_cost and time_budget bound how long the differ
+    may search for a minimal diff (see MyersDiffer). Differs that always
+    run in bounded time ignore them. The differ's ``approximated``
+    attribute reports whether the result was cut short.
+
+    If processes is set, large inputs are split on unique lines and the
+    pieces are diffed separately, across that many processes (see
+    AnchoredDiffer).
+
+    code_table is an optional LineCodeTable to share between the differs
+    of several files, so that lines common to them are only stored once.
     """
     if compat_version == 0:
+        from reviewboard.diffviewer.smdiff import SMDiffer
         return SMDiffer(a, b)
-    elif compat_version == 1:
-        return MyersDiffer(a, b, ignore_space)
+
+    if compat_version == 1:
+        from reviewboard.diffviewer.myersdiff import MyersDiffer
+        differ_class = MyersDiffer
+    elif compat_version == 2:
+        from reviewboard.diffviewer.patiencediff import PatienceDiffer
+        differ_class = PatienceDiffer
     else:
         raise DiffCompatError(
             "Invalid diff compatibility version (%s) passed to Differ" %
                 (compat_version))
 
+    if processes is not None:
+        from reviewboard.diffviewer.anchoreddiff import AnchoredDiffer
+        return AnchoredDiffer(a, b, ignore_space,
+                              differ_class=differ_class,
+                              processes=processes,
+                              code_table=code_table,
+                              fast_approximate=fast_approximate,
+                              max_cost=max_cost, time_budget=time_budget)
+
+    return differ_class(a, b, ignore_space,
+                        fast_approximate=fast_approximate,
+                        max_cost=max_cost, time_budget=time_budget,
+                        code_table=code_table)
+
 
 def get_line_changed_regions(oldline, newline):
     if oldline is None or newline is None:
@@ -182,10 +321,54 @@ def new_chunk(lines, numlines, tag, collapsable=False):
         'collapsable': collapsable,
     }
 
-def add_ranged_chunks(chunks, lines, start, end, collapsable=False):
-    numlines = end - start
-    chunks.append(new_chunk(lines[start:end], end - start, 'equal',
-                  collapsable))
+def get_diff_lines(a, b, markup_a, markup_b, linenum, i1, i2, j1, j2,
+                   start, end):
+    """
+    Returns rows start to end of the diff_lines for an opcode, whose first
+    row is numbered linenum.
+    """
+    i_start, i_end = i1 + start, min(i2, i1 + end)
+    j_start, j_end = j1 + start, min(j2, j1 + end)
+
+    return map(diff_line,
+               xrange(linenum + start, linenum + end),
+               xrange(i_start + 1, i_end + 1), xrange(j_start + 1, j_end + 1),
+               a[i_start:i_end], b[j_start:j_end],
+               markup_a[i_start:i_end], markup_b[j_start:j_end])
+
+
+class LazyLines(object):
+    """
+    The lines of a chunk, which are only built with ``build(*args)`` the
+    first time they're used.
+
+    Collapsed chunks are mostly never expanded, so rendering them can be
+    left until they are (see render_file_fragment).
+    """
+    def __init__(self, build, *args):
+        self._build = build
+        self._args = args
+        self._lines = None
+
+    @property
+    def built(self):
+        return self._lines is not None
+
+    def _get_lines(self):
+        if self._lines is None:
+            self._lines = self._build(*self._args)
+            self._build = self._args = None
+
+        return self._lines
+
+    def __iter__(self):
+        return iter(self._get_lines())
+
+    def __len__(self):
+        return len(self._get_lines())
+
+    def __getitem__(self, index):
+        return self._get_lines()[index]
 
 class DifferFromFileDiffItem:
     def __init__(self, diffitem):
@@ -279,25 +462,1132 @@ class DifferFromFileDiffItem:
         for opcode in self._opcodes:
             yield opcode
 
-def apply_pygments(data, filename):
-    # XXX Guessing is preferable but really slow, especially on XML
-    #     files.
-    #if filename.endswith(".xml"):
-    lexer = get_lexer_for_filename(filename, stripnl=False)
-    #else:
-    #    lexer = guess_lexer_for_filename(filename, data, stripnl=False)
+class DifferFromHunks(object):
+    """
+    Builds the opcodes for a file straight from its unified diff and the
+    patched file, for when the whole file is shown.
+
+    Everything outside the hunks is unchanged, so the original file is the
+    patched file with each hunk's "+" lines swapped back for its "-" lines,
+    and the opcodes can be read off the hunk bodies. Neither patch nor the
+    diff search is needed, so the cost only depends on the size of the file
+    and of the diff. The "-" lines keep their line endings from the diff,
+    along with any "\\ No newline at end of file" after them.
+
+    Raises HunkMismatchError if the diff doesn't line up with the patched
+    file at the line numbers given in its hunk headers.
+    """
+    approximated = False
+
+    def __init__(self, diff, new):
+        self.new = new
+        self.right_contents = split_lines(new)
+        self.left_contents = []
+        # The line endings of both sides, the last one "" if the file
+        # doesn't end in a newline.
+        self._right_endings = re.findall(r"\r?\n", new)
+        if len(self._right_endings) < len(self.right_contents):
+            self._right_endings.append("")
+        self._left_endings = []
+        self._opcodes = []
+
+        hunks = self._parse_hunks(diff)
+
+        if not hunks:
+            raise HunkMismatchError("The diff has no hunks")
+
+        for hunk in hunks:
+            self._add_hunk(*hunk)
+
+        self._add_equal(len(self.right_contents))
+
+        self.old = "".join([line + ending for line, ending in
+                            itertools.izip(self.left_contents,
+                                           self._left_endings)])
+
+    def _parse_hunks(self, diff):
+        """
+        Returns the (old_start, old_len, new_start, new_len, lines) of each
+        hunk in the diff, with lines a list of (tag, line, line ending).
+        """
+        hunks = []
+        lines = None
+        old_left = new_left = 0
+        pieces = re.split(r"(\r?\n)", diff)
+        pieces.append("")
+
+        for line, ending in itertools.izip(pieces[::2], pieces[1::2]):
+            if lines and line[:1] == "\\":
+                # "\ No newline at end of file", for the line before.
+                lines[-1] = lines[-1][:2] + ("", )
+                continue
+
+            if old_left > 0 or new_left > 0:
+                # Some tools strip the space from empty context lines.
+                tag = line[:1] or " "
+
+                if tag in " -":
+                    old_left -= 1
+                if tag in " +":
+                    new_left -= 1
+
+                if tag in " -+":
+                    lines.append((tag, line[1:], ending))
+                else:
+                    raise HunkMismatchError("Truncated hunk in the diff")
+
+                continue
+
+            m = HUNK_HEADER_RE.match(line)
+
+            if m:
+                old_start, old_len, new_start, new_len = \
+                    [int(x or 1) for x in m.groups()]
+                old_left, new_left = old_len, new_len
+                lines = []
+                hunks.append((old_start, old_len, new_start, new_len, lines))
+
+        if old_left > 0 or new_left > 0:
+            raise HunkMismatchError("Truncated hunk in the diff")
+
+        return hunks
+
+    def _add_hunk(self, old_start, old_len, new_start, new_len, lines):
+        a = self.left_contents
+        b = self.right_contents
+        a_endings = self._left_endings
+
+        # Empty sides give the line number before the hunk.
+        if new_len:
+            new_start -= 1
+        if old_len:
+            old_start -= 1
+
+        self._add_equal(new_start)
+
+        if len(a) != old_start:
+            raise HunkMismatchError("Hunk at line %d doesn't line up" %
+                                    (new_start + 1))
+
+        j = new_start
+
+        for tag, line, ending in lines:
+            i = len(a)
+
+            if tag != "-" and (j >= len(b) or b[j] != line):
+                raise HunkMismatchError("Hunk at line %d doesn't match" %
+                                        (new_start + 1))
+
+            if tag == " ":
+                a.append(line)
+                a_endings.append(self._right_endings[j])
+                self._add_opcode("equal", i, i + 1, j, j + 1)
+                j += 1
+            elif tag == "-":
+                if line.endswith("\r"):
+                    # This wouldn't survive being split back into lines.
+                    raise HunkMismatchError("Unexpected line ending")
+
+                a.append(line)
+                a_endings.append(ending)
+                self._add_opcode("delete", i, i + 1, j, j)
+            else:
+                self._add_opcode("insert", i, i, j, j + 1)
+                j += 1
+
+    def _add_equal(self, j_end):
+        """
+        Copies the unchanged lines of the patched file up to j_end.
+        """
+        a = self.left_contents
+        b = self.right_contents
+
+        if self._opcodes:
+            j = self._opcodes[-1][4]
+        else:
+            j = 0
+
+        if j_end < j or j_end > len(b):
+            raise HunkMismatchError("Hunk at line %d is out of order" %
+                                    (j_end + 1))
+
+        i = len(a)
+        a.extend(b[j:j_end])
+        self._left_endings.extend(self._right_endings[j:j_end])
+        self._add_opcode("equal", i, len(a), j, j_end)
+
+    def _add_opcode(self, tag, i1, i2, j1, j2):
+        if i1 == i2 and j1 == j2:
+            return
+
+        if self._opcodes:
+            last_tag, last_i1, last_i2, last_j1, last_j2 = self._opcodes[-1]
+
+            if last_tag == tag or (last_tag != "equal" and tag != "equal"):
+                if last_tag != tag:
+                    tag = "replace"
+
+                self._opcodes[-1] = (tag, last_i1, i2, last_j1, j2)
+                return
+
+        self._opcodes.append((tag, i1, i2, j1, j2))
+
+    def get_opcodes(self):
+        for opcode in self._opcodes:
+            yield opcode
+
+
+def split_lines(data):
+    """
+    Splits file contents into the lines shown in the diff viewer. A missing
+    trailing newline is ignored.
+    """
+    if data and data[-1] != '\n':
+        data += '\n'
+
+    lines = re.split(r"\r?\n", data or '')
+
+    # Remove the trailing newline, now that we've split this. This will
+    # prevent a duplicate line number at the end of the diff.
+    del(lines[-1])
+
+    return lines
+
+
+class FileContentsCache(object):
+    """
+    Keeps the contents of recently read local files, so that showing the
+    same diff again (or toggling its options) doesn't read every file from
+    disk again.
+
+    Entries are keyed by URI and are only used while the file's size and
+    modification time are unchanged. Only file:// URIs are cached. Once the
+    cached contents go over ``max_bytes``, the least recently used files
+    are dropped.
+    """
+    def __init__(self, max_bytes=DEFAULT_FILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = {}
+        self._order = []
+        # Diffs can be generated in the background while expanded chunks
+        # are rendered on the main thread.
+        self._lock = threading.Lock()
+
+    def get(self, uri, read):
+        """
+        Returns the contents of the file at ``uri``, calling ``read(uri)``
+        to load it if it isn't cached or has changed.
+        """
+        try:
+            stat = os.stat(URIToPath(uri))
+        except (IndexError, OSError, ValueError):
+            return read(uri)
+
+        key = (stat.st_size, stat.st_mtime)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(uri)
+
+            if entry is not None and entry[0] == key:
+                self._order.remove(uri)
+                self._order.append(uri)
+                return entry[1]
+
+            self._discard(uri)
+        finally:
+            self._lock.release()
+
+        contents = read(uri)
+
+        if contents is not None and len(contents) <= self.max_bytes:
+            self._lock.acquire()
+            try:
+                self._discard(uri)
+                self._entries[uri] = (key, contents)
+                self._order.append(uri)
+                self.size += len(contents)
+
+                while self.size > self.max_bytes:
+                    self._discard(self._order[0])
+            finally:
+                self._lock.release()
+
+        return contents
+
+    def discard(self, uri):
+        self._lock.acquire()
+        try:
+            self._discard(uri)
+        finally:
+            self._lock.release()
+
+    def _discard(self, uri):
+        entry = self._entries.pop(uri, None)
+
+        if entry is not None:
+            self._order.remove(uri)
+            self.size -= len(entry[1])
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            del self._order[:]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+
+class HighlightCache(object):
+    """
+    Keeps the highlighted lines of files in a directory on disk, so that
+    showing the same diff again, or diffing the same file against other
+    revisions, doesn't highlight unchanged contents again. This outlives
+    Komodo sessions, and is shared by all the processes rendering a diff.
+
+    Entries are keyed by a hash of the contents, the lexer and its options,
+    the pygments version and the formatter's options (see get_key). Each
+    one is a zlib compressed file of the length-prefixed UTF-8 lines. Once
+    the files go over ``max_bytes``, the least recently used ones are
+    removed.
+    """
+    # Changes whenever the format of the entries or the markup does.
+    VERSION = 2
+
+    def __init__(self, directory, max_bytes=DEFAULT_HIGHLIGHT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Total size of the entries, counted when the first one is added.
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # This is sent along with each DiffItem rendered in a pool.
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_key(self, data, lexer, formatter):
+        """
+        Returns the key for data highlighted with lexer and formatter.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        lexer_class = lexer.__class__
+        filters = [(filter_.__class__.__name__, sorted(filter_.options.items()))
+                   for filter_ in lexer.filters]
+        key = hashlib.sha1(repr((self.VERSION, pygments.__version__,
+                                 lexer_class.__module__, lexer_class.__name__,
+                                 sorted(lexer.options.items()), filters,
+                                 formatter.__class__.__name__,
+                                 sorted(formatter.options.items()))))
+        key.update(data)
+
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.hl')
+
+    def get(self, key):
+        """
+        Returns the lines kept for key, or None if there aren't any.
+        """
+        path = self._path(key)
+
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+            # Mark it as recently used.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        lines = []
+        pos = 0
+
+        try:
+            data = zlib.decompress(data)
+
+            while pos < len(data):
+                length, = struct.unpack('!I', data[pos:pos + 4])
+                pos += 4 + length
+                lines.append(data[pos - length:pos].decode('utf-8'))
+        except (zlib.error, struct.error, UnicodeDecodeError):
+            lines = None
+
+        if lines is None or pos != len(data):
+            logging.debug("Removing corrupt highlight cache entry %s", path)
+            self._remove(path)
+            return None
+
+        return lines
+
+    def put(self, key, lines):
+        """
+        Keeps lines for key, removing the least recently used entries if
+        that takes the cache over max_bytes.
+        """
+        pieces = []
+
+        for line in lines:
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+
+            pieces.append(struct.pack('!I', len(line)))
+            pieces.append(line)
+
+        data = zlib.compress(''.join(pieces))
+
+        if len(data) > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+
+                # Other processes may be reading the entries, so only move
+                # it into place once it's complete.
+                fd, temp_path = tempfile.mkstemp(prefix='.hl-',
+                                                 dir=self.directory)
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+
+                path = self._path(key)
+
+                if os.path.exists(path):
+                    # Another process got there first, with the same lines.
+                    os.remove(temp_path)
+                    return
+
+                os.rename(temp_path, path)
+            except (IOError, OSError), ex:
+                logging.debug("Can't add to the highlight cache: %s", ex)
+                return
+
+            if self._size is None:
+                self._evict()
+            else:
+                self._size += len(data)
+
+                if self._size > self.max_bytes:
+                    self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """
+        Counts the size of the entries, and removes the least recently
+        used ones until they fit in max_bytes.
+        """
+        entries = []
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+
+        for name in names:
+            if name.endswith('.hl'):
+                path = os.path.join(self.directory, name)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        size = sum([entry[1] for entry in entries])
+
+        for mtime, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+
+            self._remove(path)
+            size -= entry_size
+
+        self._size = size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+
+            for name in names:
+                if name.endswith('.hl'):
+                    self._remove(os.path.join(self.directory, name))
+
+            self._size = None
+        finally:
+            self._lock.release()
+
+
+def _is_plain_regex_lexer(lexer_class):
+    """
+    Returns whether lexer_class lexes with RegexLexer's own
+    get_tokens_unprocessed, which keeps the state of each call to itself.
+    """
+    return issubclass(lexer_class, RegexLexer) and \
+           lexer_class.get_tokens_unprocessed.im_func is \
+           RegexLexer.get_tokens_unprocessed.im_func
+
+
+class LexerPool(object):
+    """
+    Hands out lexers set up for highlighting diffs, keyed by their class
+    and options. A lexer that only runs RegexLexer's own code keeps no
+    state between calls, so a single instance of each is shared by every
+    file and thread that uses it, however many files a diff has. Any other
+    lexer may keep state on itself, so it's made anew each time.
+    """
+    def __init__(self):
+        self._lexers = {}
+        # Diffs can be generated in the background while expanded chunks
+        # are rendered on the main thread.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lexers)
 
+    def get(self, lexer_class, **options):
+        """
+        Returns the lexer of lexer_class with the given options, with the
+        filters that diffs are highlighted with added to it.
+        """
+        _import_pygments()
+
+        if not _is_plain_regex_lexer(lexer_class):
+            return self._new_lexer(lexer_class, options)
+
+        key = (lexer_class, tuple(sorted(options.items())))
+
+        self._lock.acquire()
+        try:
+            lexer = self._lexers.get(key)
+
+            if lexer is None:
+                lexer = self._lexers[key] = self._new_lexer(lexer_class,
+                                                            options)
+
+            return lexer
+        finally:
+            self._lock.release()
+
+    def _new_lexer(self, lexer_class, options):
+        lexer = lexer_class(**options)
+
+        try:
+            # This is only available in 0.7 and higher
+            lexer.add_filter('codetagify')
+        except AttributeError:
+            pass
+
+        return lexer
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._lexers.clear()
+        finally:
+            self._lock.release()
+
+
+# These live as long as the module does, which is the whole Komodo session
+# unless the sbsDiff component is told to reload it.
+file_contents_cache = FileContentsCache()
+lexer_pool = LexerPool()
+_html_formatter = None
+
+
+def clear_caches():
+    """
+    Empties the caches kept between diffs.
+    """
+    global _html_formatter
+    file_contents_cache.clear()
+    lexer_pool.clear()
+    _html_formatter = None
+
+
+def read_uri(uri):
+    from xpcom import components
+    koFileEx = components.classes["@activestate.com/koFileEx;1"] \
+                  .createInstance(components.interfaces.koIFileEx)
+    koFileEx.URI = uri
+    koFileEx.open('rb')
     try:
-        # This is only available in 0.7 and higher
-        lexer.add_filter('codetagify')
-    except AttributeError:
-        pass
+        return koFileEx.readfile()
+    finally:
+        koFileEx.close()
+
+
+def get_lexer(filename):
+    """
+    Returns the lexer for filename from lexer_pool. Raises
+    pygments.util.ClassNotFound if there's no lexer for it.
+    """
+    _import_pygments()
+
+    # XXX Guessing is preferable but really slow, especially on XML files.
+    lexer_class = find_lexer_class_for_filename(filename)
+
+    if lexer_class is None:
+        raise ClassNotFound('no lexer for filename %r found' % filename)
+
+    return lexer_pool.get(lexer_class, stripnl=False)
+
+
+def _prepare_text(data, lexer):
+    """
+    Returns data as the unicode text the lexer works on, the way
+    Lexer.get_tokens prepares it, or None if its lines wouldn't line up
+    with the lines given by split_lines.
+    """
+    if lexer.stripnl or lexer.stripall or \
+       lexer.encoding in ('guess', 'chardet') or LONE_CR_RE.search(data):
+        return None
+
+    if isinstance(data, unicode):
+        if UNICODE_LINE_BREAK_RE.search(data):
+            return None
+
+        text = u'\n'.join(data.splitlines())
+    else:
+        text = '\n'.join(data.splitlines()).decode(lexer.encoding)
+
+    if lexer.tabsize > 0:
+        text = text.expandtabs(lexer.tabsize)
+
+    if not text.endswith(u'\n'):
+        text += u'\n'
+
+    return text
+
+
+def _line_starts(text):
+    """
+    Returns the offset of the start of each line in text, and of its end.
+    """
+    starts = [0]
+    pos = text.find(u'\n')
+
+    while pos != -1:
+        starts.append(pos + 1)
+        pos = text.find(u'\n', pos + 1)
+
+    return starts
+
+
+def _record_line_states(lexer, text, statestack, states, line):
+    """
+    Returns the (tokentype, value) of the tokens of text, which starts at
+    the given line of the file, from the RegexLexer lexer started in the
+    list statestack. Keeps a copy of the lexer's state stack in
+    states[line] for each line that starts with a new match, where the
+    lexer can be started over.
+    """
+    match_start = [0]
+    at_line_start = True
+
+    for pos, ttype, value in lexer.get_tokens_from_stack(text, statestack,
+                                                         match_start):
+        if at_line_start and pos == match_start[0]:
+            states[line] = tuple(statestack)
+
+        yield ttype, value
+
+        newlines = value.count(u'\n')
+
+        if newlines:
+            line += newlines
+            at_line_start = value.endswith(u'\n')
+        else:
+            at_line_start = False
+
+
+def _limit_time(tokens, deadline):
+    """
+    Passes on tokens, raising HighlightBudgetExceeded if they're still
+    coming at deadline (a time.time() value, or None for no limit).
+    """
+    if deadline is None:
+        return tokens
+
+    return _limit_time_iter(tokens, deadline)
+
 
-    return pygments.highlight(data, lexer, HtmlFormatter()).splitlines()
+def _limit_time_iter(tokens, deadline):
+    count = 0
+
+    for token in tokens:
+        count += 1
+
+        # Looking at the clock for every token would slow lexing down.
+        if count == 1000:
+            count = 0
+
+            if time.time() >= deadline:
+                raise HighlightBudgetExceeded
+
+        yield token
+
+
+def _highlight_lines(lexer, formatter, text, line, statestack=None,
+                     states=None, deadline=None):
+    """
+    Returns an iterator over the highlighted lines of text, which starts at
+    the given line of the file. The lexer starts in its root state, or in
+    the list statestack. If states is given, the lexer's state at the start
+    of the lines is kept in it (see _record_line_states), which takes a
+    RegexLexer. See _limit_time for deadline.
+    """
+    if states is None:
+        tokens = (token[1:]
+                  for token in lexer.get_tokens_unprocessed(text))
+    else:
+        tokens = _record_line_states(lexer, text, statestack or ['root'],
+                                     states, line)
+
+    tokens = apply_filters(_limit_time(tokens, deadline), lexer.filters,
+                           lexer)
+
+    return formatter.iter_lines(tokens)
+
+
+class HighlightedLines(object):
+    """
+    The syntax highlighted markup for the lines of a file, which is only
+    produced for the lines that are looked at.
+
+    The lines of collapsed chunks are only rendered when they're expanded
+    (see LazyLines), so most of a big file with a small change never needs
+    highlighting. The lexer can only be started over where its state is
+    known, so the lines up to a range are lexed (but not formatted), keeping
+    the lexer's state at the start of each line (see _record_line_states).
+    The range is then highlighted from the nearest line before it with a
+    known state. If the range starts shortly after the last one ended, the
+    lexer just carries on from there instead. The lines after the last one
+    looked at are never lexed. This takes a RegexLexer (see
+    _is_plain_regex_lexer), and files with fewer than MIN_LINES lines are
+    highlighted whole.
+
+    Looking at lines raises HighlightBudgetExceeded if they're still being
+    highlighted at ``deadline`` (see _limit_time).
+    """
+    MIN_LINES = 1000
+
+    def __init__(self, text, lexer, formatter, deadline=None):
+        self.deadline = deadline
+        self._text = text
+        self._lexer = lexer
+        self._formatter = formatter
+        self._markup = [None] * text.count(u'\n')
+        self._starts = _line_starts(text)
+        # The lexer's state stack at the start of each line, or None for a
+        # line it hasn't been through yet, or that starts inside a token.
+        # Every line before _lexed_line has been through.
+        self._states = [None] * (len(self._markup) + 1)
+        self._states[0] = ('root', )
+        self._lexed_line = 0
+
+        # The line that the lexer stopped before, and the iterator over
+        # the rest of the formatted lines.
+        self._next_line = None
+        self._next_lines = None
+
+    def __getstate__(self):
+        # Sent back from the process that highlighted the file, with the
+        # chunks that use it (see render_diff_item). The lexer is taken
+        # from that end's lexer_pool, and the lines that are still to be
+        # highlighted are from the known states.
+        state = self.__dict__.copy()
+        state['_lexer'] = (self._lexer.__class__, self._lexer.options)
+        state['_next_line'] = state['_next_lines'] = None
+        return state
+
+    def __setstate__(self, state):
+        _import_pygments()
+        self.__dict__.update(state)
+        lexer_class, options = state['_lexer']
+        self._lexer = lexer_pool.get(lexer_class, **options)
+
+    def __len__(self):
+        return len(self._markup)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self._markup))
+        else:
+            if index < 0:
+                index += len(self._markup)
+            start, end = index, index + 1
+
+        self._highlight(start, end)
+
+        return self._markup[index]
+
+    def _highlight(self, start, end):
+        markup = self._markup
+
+        while start < end and markup[start] is not None:
+            start += 1
+
+        while end > start and markup[end - 1] is not None:
+            end -= 1
+
+        if start == end:
+            return
+
+        self._lex_to(start)
+        line = self._find_restart(start)
+
+        if self._next_line is not None and line <= self._next_line <= start:
+            line = self._next_line
+            lines = self._next_lines
+        else:
+            lines = self._format(line)
+
+        self._next_line = self._next_lines = None
+
+        for piece in lines:
+            if markup[line] is None:
+                markup[line] = piece
+
+            line += 1
+            self._lexed_line = max(self._lexed_line, line)
+
+            if line == end:
+                self._next_line = line
+                self._next_lines = lines
+                break
+
+    def _lex_to(self, line):
+        """
+        Lexes on from the last line with a known state until the state at
+        the start of the given line is known.
+        """
+        if self._lexed_line > line:
+            return
+
+        lexed_line = self._find_restart(self._lexed_line)
+
+        for ttype, value in _limit_time(self._tokens(lexed_line),
+                                        self.deadline):
+            lexed_line += value.count(u'\n')
+
+            if lexed_line > line:
+                break
+
+        self._lexed_line = max(self._lexed_line, lexed_line)
+
+    def _tokens(self, line):
+        return _record_line_states(self._lexer,
+                                   self._text[self._starts[line]:],
+                                   list(self._states[line]), self._states,
+                                   line)
+
+    def _format(self, line):
+        return _highlight_lines(self._lexer, self._formatter,
+                                self._text[self._starts[line]:], line,
+                                list(self._states[line]), self._states,
+                                self.deadline)
+
+    def _find_restart(self, line):
+        """
+        Returns the nearest line at or before the given one where the
+        lexer's state is known.
+        """
+        states = self._states
+
+        while states[line] is None:
+            line -= 1
+
+        return line
+
+
+def apply_pygments(data, filename, by_region=False, deadline=None):
+    """
+    Returns the lines of data, syntax highlighted for the file type of
+    filename. With by_region, big files are returned as HighlightedLines,
+    which only highlights the lines that are looked at, and is given the
+    deadline. Otherwise, raises HighlightBudgetExceeded if highlighting is
+    still going at deadline.
+    """
+    global _html_formatter
+
+    lexer = get_lexer(filename)
+
+    if _html_formatter is None:
+        _html_formatter = HtmlFormatter()
+
+    if by_region and data.count('\n') >= HighlightedLines.MIN_LINES and \
+       _is_plain_regex_lexer(lexer.__class__):
+        text = _prepare_text(data, lexer)
+
+        if text is not None:
+            return HighlightedLines(text, lexer, _html_formatter, deadline)
+
+    return _html_formatter.format_lines(_limit_time(lexer.get_tokens(data),
+                                                    deadline))
+
+
+def apply_pygments_incremental(old, new, old_filename, new_filename,
+                               opcodes, deadline=None):
+    """
+    Returns the highlighted lines of old and new, the same as calling
+    apply_pygments on each, for files that differ by opcodes. Returns None
+    if their lexer can't be used this way.
+
+    Only old is highlighted whole, keeping the lexer's state at the start
+    of each of its lines. For new, the lexer is started in the same state
+    as on the old side just before each change, and runs until it's back
+    in the same state as the old side at a line that's unchanged. From
+    there on the lines of the old side are used, up to the next change.
+    """
+    global _html_formatter
+
+    lexer = get_lexer(old_filename)
+
+    if get_lexer(new_filename).__class__ is not lexer.__class__ or \
+       not _is_plain_regex_lexer(lexer.__class__):
+        return None
+
+    text_a = _prepare_text(old, lexer)
+    text_b = _prepare_text(new, lexer)
+
+    if text_a is None or text_b is None:
+        return None
+
+    if _html_formatter is None:
+        _html_formatter = HtmlFormatter()
+
+    formatter = _html_formatter
+    num_lines_a = text_a.count(u'\n')
+    starts_b = _line_starts(text_b)
+    num_lines_b = len(starts_b) - 1
+
+    states_a = [None] * (num_lines_a + 1)
+    markup_a = list(_highlight_lines(lexer, formatter, text_a, 0,
+                                     states=states_a, deadline=deadline))
+
+    # The line of old that each unchanged line of new matches.
+    old_lines = [None] * num_lines_b
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            for j in xrange(j1, min(j2, num_lines_b,
+                                    j1 + num_lines_a - i1)):
+                old_lines[j] = i1 + j - j1
+
+    markup_b = []
+    states_b = [None] * (num_lines_b + 1)
+
+    # The last line of new where the lexer is known to be in the same
+    # state as on the old side, and that state.
+    synced_line = 0
+    synced_state = ('root',)
+    line = 0
+    last_old_line = -1
+
+    while line < num_lines_b:
+        # Use the old side's lines up to the next change.
+        change = line
+
+        while change < num_lines_b and \
+              old_lines[change] == last_old_line + 1 + change - line:
+            change += 1
+
+        markup_b.extend(markup_a[last_old_line + 1:
+                                 last_old_line + 1 + change - line])
+
+        if change == num_lines_b:
+            break
+
+        # Start the lexer at the nearest line before the change where it's
+        # in its root state. Anything that was still open there on the
+        # old side, such as a string that the change closes, is lexed
+        # again from its start.
+        start = change
+
+        while start > synced_line and \
+              states_a[old_lines[start - 1] + 1] != ('root',):
+            start -= 1
+
+        if start > synced_line:
+            statestack = ['root']
+        else:
+            statestack = list(synced_state)
+
+        del markup_b[start:]
+        line = start
+        synced = False
+
+        for piece in _highlight_lines(lexer, formatter,
+                                      text_b[starts_b[start]:], start,
+                                      statestack, states_b, deadline):
+            markup_b.append(piece)
+
+            if line >= change and old_lines[line] is not None and \
+               states_b[line] is not None and \
+               states_b[line] == states_a[old_lines[line]]:
+                synced = True
+                synced_line = line
+                synced_state = states_b[line]
+                last_old_line = old_lines[line]
+                line += 1
+                break
+
+            line += 1
+
+        if not synced:
+            break
+
+    return markup_a, markup_b
+
+
+def highlight_files(old, new, old_filename, new_filename, opcodes,
+                    by_region=False, cache=None, deadline=None):
+    """
+    Returns the highlighted lines of old and new, for files that differ by
+    opcodes. The new side is highlighted from the old one where possible
+    (see apply_pygments_incremental), and by_region is passed on to
+    apply_pygments otherwise. Raises HighlightBudgetExceeded if
+    highlighting is still going at deadline.
+
+    If a HighlightCache is given, the lines of either side are taken from
+    it when they're there, and kept in it when they're highlighted whole.
+    """
+    global _html_formatter
+
+    _import_pygments()
+    markup_a = markup_b = None
+
+    if cache is not None:
+        if _html_formatter is None:
+            _html_formatter = HtmlFormatter()
+
+        key_a = cache.get_key(old, get_lexer(old_filename), _html_formatter)
+        key_b = cache.get_key(new, get_lexer(new_filename), _html_formatter)
+        markup_a = cache.get(key_a)
+        markup_b = cache.get(key_b)
+        cached_a = markup_a is not None
+        cached_b = markup_b is not None
+
+        if cached_a and cached_b:
+            return markup_a, markup_b
+
+    markups = None
+
+    if markup_a is None and markup_b is None and \
+       (not by_region or max(old.count('\n'), new.count('\n')) <
+                         HighlightedLines.MIN_LINES):
+        markups = apply_pygments_incremental(old, new, old_filename,
+                                             new_filename, opcodes, deadline)
+
+    if markups:
+        markup_a, markup_b = markups
+    else:
+        if markup_a is None:
+            markup_a = apply_pygments(old, old_filename, by_region, deadline)
+
+        if markup_b is None:
+            markup_b = apply_pygments(new, new_filename, by_region, deadline)
+
+    if cache is not None:
+        # HighlightedLines only highlight what's looked at.
+        if not cached_a and isinstance(markup_a, list):
+            cache.put(key_a, markup_a)
+
+        if not cached_b and isinstance(markup_b, list) and key_b != key_a:
+            cache.put(key_b, markup_b)
+
+    return markup_a, markup_b
+
+
+def can_highlight(filediff, old, new):
+    """
+    Returns whether old and new are within the size limits set on the diff
+    item for syntax highlighting.
+    """
+    max_bytes = filediff.highlight_max_bytes
+    max_line_length = filediff.highlight_max_line_length
+
+    for data in (old, new):
+        if max_bytes is not None and len(data) > max_bytes:
+            return False
+
+        if max_line_length is not None and len(data) > max_line_length and \
+           max([len(line) for line in data.splitlines()]) > max_line_length:
+            return False
+
+    return True
+
+
+def get_highlight_deadline(filediff):
+    """
+    Returns the time.time() by which highlighting the diff item has to be
+    done, or None if it can take as long as it takes. This is the earlier
+    of its own time budget and the deadline for the whole diff.
+    """
+    deadline = filediff.highlight_deadline
+
+    if filediff.highlight_time_budget is not None:
+        file_deadline = time.time() + filediff.highlight_time_budget
+
+        if deadline is None or file_deadline < deadline:
+            deadline = file_deadline
+
+    return deadline
+
+
+def get_hunk_differ(filediff):
+    """
+    Returns a DifferFromHunks for the diff item, or None if its diff can't
+    be used that way (in which case the file is patched and diffed instead).
+    """
+    if not filediff.diff:
+        return None
+
+    new = filediff.get_patched_file(allow_patching=False)
+
+    if new is None:
+        return None
+
+    try:
+        return DifferFromHunks(filediff.diff, new)
+    except HunkMismatchError, ex:
+        logging.debug("Can't build the chunks for filediff id %s from "
+                      "its hunks: %s", filediff.id, ex)
+        return None
 
 
 def get_chunks(filediff, interfilediff, force_interdiff,
-               enable_syntax_highlighting):
+               enable_syntax_highlighting, lazy_collapsed=False,
+               highlight_by_region=False):
 
 
     # There are three ways this function is called:
@@ -331,15 +1621,30 @@ def get_chunks(filediff, interfilediff, force_interdiff,
     #          in this case, so we have to indicate that we are indeed in
     #          interdiff mode so that we can special-case this and not
     #          grab a patched file for the interdiff version.
+    #
+    # With lazy_collapsed, the lines of the chunks that can be collapsed are
+    # LazyLines, which are only built when something looks at them. Adding
+    # highlight_by_region leaves the highlighting of big files until then
+    # too.
 
     assert filediff
 
     ignore_space = False
+    highlight_skipped = False
 
     if filediff.file_on_disk:
-        old = filediff.get_original_file()
-        
-        new = filediff.get_patched_file()
+        differ = None
+
+        if filediff.hunk_driven and not interfilediff and not force_interdiff:
+            differ = get_hunk_differ(filediff)
+
+        if differ:
+            old = differ.old
+            new = differ.new
+        else:
+            old = filediff.get_original_file()
+            new = filediff.get_patched_file()
+
         if interfilediff:
             old = new
             interdiff_orig = get_original_file(interfilediff)
@@ -358,29 +1663,51 @@ def get_chunks(filediff, interfilediff, force_interdiff,
         if new and new[-1] != '\n':
             new += '\n'
     
-        a = re.split(r"\r?\n", old or '')
-        b = re.split(r"\r?\n", new or '')
-    
-        # Remove the trailing newline, now that we've split this. This will
-        # prevent a duplicate line number at the end of the diff.
-        del(a[-1])
-        del(b[-1])
+        if differ:
+            a = differ.left_contents
+            b = differ.right_contents
+        else:
+            a = split_lines(old)
+            b = split_lines(new)
     
         a_num_lines = len(a)
         b_num_lines = len(b)
     
+        #siteconfig = SiteConfiguration.objects.get_current()
+
+        if not differ:
+            differ = Differ(a, b, ignore_space=ignore_space,
+                            time_budget=filediff.diff_time_budget,
+                            processes=filediff.diff_processes,
+                            code_table=filediff.code_table)
+
+        # The highlighting of new is based on the opcodes.
+        opcodes = list(differ.get_opcodes())
+
         markup_a = markup_b = None
     
-        if enable_syntax_highlighting and _have_pygments:
-            try:
-                # TODO: Try to figure out the right lexer for these files
-                #       once instead of twice.
-                markup_a = apply_pygments(old or '', filediff.source_file or filediff.dest_file)
-                markup_b = apply_pygments(new or '', filediff.dest_file or filediff.source_file)
-            except ValueError, ex:
-                import warnings
-                warnings.warn("apply_pygments failed: %r" % (ex, ))
-                pass
+        if enable_syntax_highlighting and _import_pygments():
+            deadline = get_highlight_deadline(filediff)
+
+            if not can_highlight(filediff, old or '', new or '') or \
+               (deadline is not None and time.time() >= deadline):
+                highlight_skipped = True
+            else:
+                try:
+                    markup_a, markup_b = highlight_files(
+                        old or '', new or '',
+                        filediff.source_file or filediff.dest_file,
+                        filediff.dest_file or filediff.source_file, opcodes,
+                        highlight_by_region and lazy_collapsed,
+                        filediff.highlight_cache, deadline)
+                except HighlightBudgetExceeded:
+                    logging.debug("Highlighting filediff id %s took too long",
+                                  filediff.id)
+                    highlight_skipped = True
+                except ValueError, ex:
+                    import warnings
+                    warnings.warn("apply_pygments failed: %r" % (ex, ))
+                    pass
     
         # If no highlighting, no pygments, or there was a pygments error (i.e. no lexer)
         if not markup_a:
@@ -388,10 +1715,6 @@ def get_chunks(filediff, interfilediff, force_interdiff,
         if not markup_b:
             markup_b = re.split(r"\r?\n", escape(new))
     
-        #siteconfig = SiteConfiguration.objects.get_current()
-
-        differ = Differ(a, b, ignore_space=ignore_space)
-    
         if interfilediff:
             logging.debug("Generating diff chunks for interdiff ids %s-%s",
                           filediff.id, interfilediff.id)
@@ -404,41 +1727,73 @@ def get_chunks(filediff, interfilediff, force_interdiff,
         b = differ.right_contents
         markup_a = [ escape(x) for x in a ]
         markup_b = [ escape(x) for x in b ]
+        opcodes = differ.get_opcodes()
 
-    chunks = []
-    linenum = 1
     # TODO: Make this back into a preference if people really want it.
     context_num_lines = 11
     collapse_threshold = 2 * context_num_lines + 3
 
-    for tag, i1, i2, j1, j2 in differ.get_opcodes():
-        oldlines = markup_a[i1:i2]
-        newlines = markup_b[j1:j2]
-        numlines = max(len(oldlines), len(newlines))
-
-        lines = map(diff_line,
-                    xrange(linenum, linenum + numlines),
-                    xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
-                    a[i1:i2], b[j1:j2], oldlines, newlines)
-        linenum += numlines
-
-        if tag == 'equal' and numlines > collapse_threshold:
-            last_range_start = numlines - context_num_lines
-
-            if len(chunks) == 0:
-                add_ranged_chunks(chunks, lines, 0, last_range_start, True)
-                add_ranged_chunks(chunks, lines, last_range_start, numlines)
+    def build_chunks(markup_a, markup_b):
+        chunks = []
+        linenum = 1
+
+        def add_ranged_chunks(start, end, collapsable=False):
+            args = (a, b, markup_a, markup_b, linenum, i1, i2, j1, j2,
+                    start, end)
+
+            if collapsable and lazy_collapsed:
+                lines = LazyLines(get_diff_lines, *args)
             else:
-                add_ranged_chunks(chunks, lines, 0, context_num_lines)
+                lines = get_diff_lines(*args)
+
+            chunks.append(new_chunk(lines, end - start, 'equal', collapsable))
+
+        for tag, i1, i2, j1, j2 in opcodes:
+            numlines = max(i2 - i1, j2 - j1)
 
-                if i2 == a_num_lines and j2 == b_num_lines:
-                    add_ranged_chunks(chunks, lines, context_num_lines, numlines, True)
+            if tag == 'equal' and numlines > collapse_threshold:
+                last_range_start = numlines - context_num_lines
+
+                if len(chunks) == 0:
+                    add_ranged_chunks(0, last_range_start, True)
+                    add_ranged_chunks(last_range_start, numlines)
                 else:
-                    add_ranged_chunks(chunks, lines, context_num_lines,
-                                      last_range_start, True)
-                    add_ranged_chunks(chunks, lines, last_range_start, numlines)
-        else:
-            chunks.append(new_chunk(lines, numlines, tag))
+                    add_ranged_chunks(0, context_num_lines)
+
+                    if i2 == a_num_lines and j2 == b_num_lines:
+                        add_ranged_chunks(context_num_lines, numlines, True)
+                    else:
+                        add_ranged_chunks(context_num_lines, last_range_start,
+                                          True)
+                        add_ranged_chunks(last_range_start, numlines)
+            else:
+                lines = get_diff_lines(a, b, markup_a, markup_b, linenum,
+                                       i1, i2, j1, j2, 0, numlines)
+                chunks.append(new_chunk(lines, numlines, tag))
+
+            linenum += numlines
+
+        return chunks
+
+    try:
+        chunks = build_chunks(markup_a, markup_b)
+    except HighlightBudgetExceeded:
+        # The lines of big files are highlighted as the chunks are built
+        # (see HighlightedLines), so the budget can run out here too.
+        logging.debug("Highlighting filediff id %s took too long",
+                      filediff.id)
+        highlight_skipped = True
+        chunks = build_chunks(re.split(r"\r?\n", escape(old)),
+                              re.split(r"\r?\n", escape(new)))
+
+    for markup in (markup_a, markup_b):
+        if isinstance(markup, HighlightedLines):
+            # Collapsed chunks that are expanded later on aren't held to
+            # the budget for generating the diff.
+            markup.deadline = None
+
+    filediff.approximated = getattr(differ, "approximated", False)
+    filediff.highlight_skipped = highlight_skipped
 
     if interfilediff:
         logging.debug("Done generating diff chunks for interdiff ids %s-%s",
@@ -450,13 +1805,69 @@ def get_chunks(filediff, interfilediff, force_interdiff,
     return chunks
 
 
+class _HunkSnapshot(object):
+    def __init__(self, lines):
+        self.lines = lines
+
+
+class FileDiffSnapshot(object):
+    """
+    A copy of the parts of a koIDiff file diff that DiffItem uses. Unlike
+    the original, it can be pickled, so that DiffItems built on it can be
+    sent to other processes.
+    """
+    def __init__(self, filediffex, cwd):
+        self.diff = filediffex.diff
+        self.hunks = [_HunkSnapshot(list(hunk.lines))
+                      for hunk in filediffex.hunks]
+        self.paths = dict(filediffex.paths)
+        self.cwd = cwd
+        self._best_path = filediffex.best_path(cwd)
+
+    def best_path(self, cwd):
+        assert cwd == self.cwd
+        return self._best_path
+
+
+def render_diff_item(item):
+    """
+    Diffs and renders a DiffItem, and returns its HTML and its chunks. This
+    is a module-level function so that it can be sent to a multiprocessing
+    pool, and the chunks come back from there for filling in the collapsed
+    ones (see DiffItem.get_chunk_html) without diffing the file again.
+    """
+    item.load_chunks()
+    return item.toHTML(), item.chunks
+
+
 class DiffItem(object):
-    def __init__(self, id, filediffex, cwd=None, hl_enabled=True, file_on_disk=True):
+    def __init__(self, id, filediffex, cwd=None, hl_enabled=True, file_on_disk=True,
+                 diff_time_budget=DEFAULT_DIFF_TIME_BUDGET,
+                 diff_processes=DEFAULT_DIFF_PROCESSES, code_table=None,
+                 hunk_driven=DEFAULT_HUNK_DRIVEN,
+                 lazy_collapsed=DEFAULT_LAZY_COLLAPSED,
+                 highlight_by_region=DEFAULT_HIGHLIGHT_BY_REGION,
+                 highlight_cache=None,
+                 highlight_max_bytes=DEFAULT_HIGHLIGHT_MAX_BYTES,
+                 highlight_max_line_length=DEFAULT_HIGHLIGHT_MAX_LINE_LENGTH,
+                 highlight_time_budget=DEFAULT_HIGHLIGHT_TIME_BUDGET,
+                 highlight_deadline=None):
         self.id = id
         self.filediffex = filediffex
         self.cwd = cwd
         self.enable_syntax_highlighting = hl_enabled
         self.file_on_disk = file_on_disk
+        self.diff_time_budget = diff_time_budget
+        self.diff_processes = diff_processes
+        self.code_table = code_table
+        self.hunk_driven = hunk_driven
+        self.lazy_collapsed = lazy_collapsed
+        self.highlight_by_region = highlight_by_region
+        self.highlight_cache = highlight_cache
+        self.highlight_max_bytes = highlight_max_bytes
+        self.highlight_max_line_length = highlight_max_line_length
+        self.highlight_time_budget = highlight_time_budget
+        self.highlight_deadline = highlight_deadline
 
         self._left_file_uri = None
         self._left_contents = None
@@ -466,6 +1877,8 @@ class DiffItem(object):
         self.dest_revision = ""
 
         self.chunks = None
+        self.approximated = False
+        self.highlight_skipped = False
         self.changed_chunks = []
         self.has_changes = False
         self.num_changes = 0
@@ -487,6 +1900,10 @@ class DiffItem(object):
             result.append("right_contents length: %d" % (len(self._right_contents), ))
         if self.filediffex.diff:
             result.append("diff length:           %d" % (len(self.diff), ))
+        if self.approximated:
+            result.append("approximated:          True")
+        if self.highlight_skipped:
+            result.append("highlight skipped:     True")
 
         result.append("left == right:           %r" % (self.get_original_file() == self.get_patched_file()), )
 
@@ -531,55 +1948,24 @@ class DiffItem(object):
             return URIToPath(self.right_file_uri)
         return ""
 
-    # XXX - This is not portable. Need to replace this function, perhaps:
-    #       http://code.google.com/p/python-patch
     def _patch_file(self, diff, file_contents, reversed=False):
-        from xpcom import components
-        result = None
-        fd, tfname = tempfile.mkstemp()
-        try:
-            os.fdopen(fd, "wb").write(file_contents)
-            afile = components.classes["@mozilla.org/file/directory_service;1"]. \
-                                getService(components.interfaces.nsIProperties). \
-                                get("ProfD", components.interfaces.nsIFile)
-            afile.append("extensions")
-            afile.append("sbsdiff@activestate.com")
-            afile.append("platform")
-            # Patch is not that common on installations, so it's # included by
-            # default in the extension itself.
-            if sys.platform.startswith("win"):
-                afile.append("WINNT")
-                afile.append("patch.exe")
-            else:
-                if sys.platform.startswith("linux"):
-                    # Detertmine the architecutre.
-                    import platform
-                    afile.append("Linux-%s" % (platform.architecture()[0]))
-                elif sys.platform.startswith("darwin"):
-                    afile.append("Darwin")
-                afile.append("patch")
-            argv = [afile.path, tfname]
-            if reversed:
-                argv.insert(1, "--reverse")
-            PIPE = subprocess.PIPE
-            p = subprocess.Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = p.communicate(diff)
-            if p.returncode == 0:
-                result = file(tfname, "rb").read()
-        finally:
-            os.remove(tfname)
-        return result
+        # Try the file as it is first, so that its line endings are kept,
+        # and then with the line endings of both normalized.
+        for normalize in (False, True):
+            try:
+                return apply_patch(diff, file_contents, reverse=reversed,
+                                   normalize=normalize)
+            except PatchError, ex:
+                pass
+
+        logging.debug("Can't patch filediff id %s: %s", self.id, ex)
+        return None
 
     def get_original_file(self, allow_patching=True):
-        from xpcom import components
         if self._left_contents is None:
             if self.left_file_uri:
-                koFileEx = components.classes["@activestate.com/koFileEx;1"] \
-                              .createInstance(components.interfaces.koIFileEx)
-                koFileEx.URI = self.left_file_uri
-                koFileEx.open('rb')
-                self._left_contents = koFileEx.readfile()
-                koFileEx.close()
+                self._left_contents = file_contents_cache.get(
+                    self.left_file_uri, read_uri)
             elif allow_patching and self.diff and (self._right_contents or self.right_file_uri):
                 right_contents = self.get_patched_file(allow_patching=False)
                 if right_contents is not None:
@@ -588,15 +1974,10 @@ class DiffItem(object):
         return self._left_contents
 
     def get_patched_file(self, allow_patching=True):
-        from xpcom import components
         if self._right_contents is None:
             if self.right_file_uri:
-                koFileEx = components.classes["@activestate.com/koFileEx;1"] \
-                              .createInstance(components.interfaces.koIFileEx)
-                koFileEx.URI = self.right_file_uri
-                koFileEx.open('rb')
-                self._right_contents = koFileEx.readfile()
-                koFileEx.close()
+                self._right_contents = file_contents_cache.get(
+                    self.right_file_uri, read_uri)
             elif allow_patching and self.diff and (self._left_contents or self.left_file_uri):
                 left_contents = self.get_original_file(allow_patching=False)
                 if left_contents is not None:
@@ -605,7 +1986,9 @@ class DiffItem(object):
         return self._right_contents
 
     def load_chunks(self):
-        chunks = get_chunks(self, None, 0, self.enable_syntax_highlighting)
+        chunks = get_chunks(self, None, 0, self.enable_syntax_highlighting,
+                            lazy_collapsed=self.lazy_collapsed,
+                            highlight_by_region=self.highlight_by_region)
         self.chunks = chunks
         self.has_changes = False
         self.changed_chunks = []
@@ -618,10 +2001,6 @@ class DiffItem(object):
         self.num_changes = len(self.changed_chunks)
 
     def toHTML(self):
-        import reviewboard.settings
-        from django.core.management import setup_environ
-        from django.template.loader import render_to_string
-        setup_environ(reviewboard.settings)
         # Force encoding to "utf-8".
         html = """<!doctype html>
 <head>
@@ -629,25 +2008,367 @@ class DiffItem(object):
 </head>
 
 """
-        html += render_to_string('diffviewer/diff_file_fragment.html',
-                                { 'file': self,
-                                  'collapseall': True })
+        html += render_file_fragment(self, collapseall=True)
         return html
 
+    def get_chunk_html(self, chunk_index):
+        """
+        Returns the HTML for the rows of one chunk, numbered from 1 as in
+        the ids of the chunks in toHTML. This is how collapsed chunks that
+        were left out of toHTML are filled in.
+        """
+        if self.chunks is None:
+            # The file was rendered in a diff worker that has gone away
+            # since. The deadline for highlighting the whole diff has passed
+            # by now, so only the file's own budget applies.
+            self.highlight_deadline = None
+            self.load_chunks()
+
+        chunk = self.chunks[chunk_index - 1]
+        out = []
+        _render_lines(out.append, _render_value(self.id), chunk['change'],
+                      chunk['lines'])
+        return u"".join(out)
+
+
+
+def _render_value(value):
+    """
+    Renders a value the way a {{ variable }} in an autoescaping template
+    would.
+    """
+    if isinstance(value, (int, long)):
+        # Line numbers, which need neither decoding nor escaping.
+        return unicode(value)
+
+    try:
+        output = force_unicode(value)
+    except UnicodeDecodeError:
+        return u''
+
+    if not isinstance(output, SafeData) or isinstance(output, EscapeData):
+        return force_unicode(escape(output))
+
+    return output
+
+
+def _render_markup(value, regions=None):
+    """
+    Renders a line's markup through the highlightregion and
+    showextrawhitespace filters, keeping it safe if it was safe to start
+    with.
+    """
+    is_safe = isinstance(value, SafeData)
+
+    if regions is not None:
+        value = highlightregion(value, regions)
+
+    value = showextrawhitespace(value)
+
+    if is_safe:
+        value = mark_safe(value)
+
+    return _render_value(value)
+
+
+def render_file_fragment(file, collapseall=True):
+    """
+    Renders the side-by-side table for one file, giving exactly what
+    diffviewer/diff_file_fragment.html gives for it.
+
+    Files are rendered one after another, many lines at a time, so going
+    through the template engine for every line (and setting up the Django
+    environment and loading the template for every file) is most of the
+    time spent rendering a diff. This builds the same markup directly.
+    The template is still what reviewboard uses, so the two must be kept
+    in sync.
+    """
+    file_id = _render_value(getattr(file, 'id', ''))
+    out = [u'\n\n\n']
+    append = out.append
+
+    append(u'\n<table class="sidebyside%s" id="file.%s">\n'
+           u' <colgroup>\n'
+           u'  <col class="line" />\n'
+           u'  <col class="left" />\n'
+           u'  <col class="line" />\n'
+           u'  <col class="right" />\n'
+           u' </colgroup>\n'
+           u' <thead>\n'
+           u'  <tr onClick="gotoAnchor(\'%s\');">\n'
+           u'   <th colspan="4">%s</th>\n'
+           u'  </tr>\n'
+           u'  <tr>\n'
+           u'   <th colspan="2" class="rev">%s</th>\n'
+           u'   <th colspan="2" class="rev">%s</th>\n'
+           u'  </tr>\n'
+           u' </thead>\n\n'
+           % ((getattr(file, 'newfile', False) and u' newfile' or u''),
+              file_id, file_id,
+              _render_value(getattr(file, 'dest_file', '')),
+              _render_value(getattr(file, 'source_revision', '')),
+              _render_value(getattr(file, 'dest_revision', ''))))
+
+    if getattr(file, 'binary', False):
+        append(u'\n <tbody class="binary">\n'
+               u'  <tr>\n'
+               u'   <td colspan="4">%s</td>\n'
+               u'  </tr>\n'
+               u' </tbody>\n'
+               % _("This is a binary file. The content cannot be "
+                   "displayed."))
+    else:
+        append(u'\n')
+
+        if getattr(file, 'approximated', False):
+            append(u'\n <tbody class="approximated">\n'
+                   u'  <tr>\n'
+                   u'   <td colspan="4">%s</td>\n'
+                   u'  </tr>\n'
+                   u' </tbody>\n'
+                   % _("This file took too long to compare exactly. The "
+                       "changes shown are correct, but may not be the "
+                       "smallest possible set."))
+
+        if getattr(file, 'highlight_skipped', False):
+            append(u'\n <tbody class="unhighlighted">\n'
+                   u'  <tr>\n'
+                   u'   <td colspan="4">%s</td>\n'
+                   u'  </tr>\n'
+                   u' </tbody>\n'
+                   % _("This file is too big or took too long to syntax "
+                       "highlight, so it is shown without highlighting."))
+
+        append(u'\n')
+
+        for counter, chunk in enumerate(getattr(file, 'chunks', []) or []):
+            _render_chunk(append, file_id, counter + 1, chunk, collapseall)
+
+        append(u'\n')
+
+    append(u'\n\n\n</table>\n\n')
+
+    return u''.join(out)
+
+
+def _render_chunk(append, file_id, counter, chunk, collapseall):
+    change = chunk.get('change', '')
+    collapsed = chunk.get('collapsable') and collapseall
+    numlines = _render_value(chunk.get('numlines', ''))
+    plural = chunk.get('numlines') != 1 and u's' or u''
+    lines = chunk.get('lines', [])
+
+    # The lines of a lazy chunk are left out until it's expanded (see
+    # DiffItem.get_chunk_html), and the chunk is marked for
+    # expandChunkKomodo.
+    lazy = collapsed and isinstance(lines, LazyLines) and not lines.built
+
+    append(u'\n\n')
+
+    if collapsed:
+        append(u'\n <tbody class="collapsed" id="chunk-expand.%s.%d">\n'
+               u'  <tr>\n'
+               u'   <th>...</th>\n'
+               u'   <td colspan="3">%s line%s hidden [<a href="#" '
+               u'onclick="javascript:expandChunkKomodo(%s, %d, %s); '
+               u'return false;">%s</a>]</td>\n'
+               u'  </tr>\n'
+               u' </tbody>\n\n'
+               u' <tbody id="chunk.%s.%d"%s style="display: none;">\n'
+               % (file_id, counter, numlines, plural,
+                  file_id, counter, numlines, _("Expand"),
+                  file_id, counter, lazy and u' class="lazy"' or u''))
+    elif change != 'equal':
+        append(u'\n <tbody id="chunk.%s.%d" class="%s">\n'
+               % (file_id, counter, _render_value(change)))
+    elif chunk.get('collapsable'):
+        append(u'\n <tbody id="chunk.%s.%d" class="collapsable">\n'
+               % (file_id, counter))
+    else:
+        append(u'\n <tbody id="chunk.%s.%d">\n' % (file_id, counter))
+
+    append(u'\n\n')
+
+    if not lazy:
+        _render_lines(append, file_id, change, lines)
+
+    append(u'\n\n </tbody>\n\n')
+
+    if collapsed:
+        append(u'\n <tbody class="collapsed" id="chunk-collapse.%s.%d" '
+               u'style="display: none;">\n'
+               u'  <tr>\n'
+               u'   <th></th>\n'
+               u'   <td colspan="3">%s line%s shown [<a href="#" '
+               u'onclick="javascript:collapseChunkKomodo(%s, %d, %s); '
+               u'return false;">%s</a>]</td>\n'
+               u'  </tr>\n'
+               u' </tbody>\n'
+               % (file_id, counter, numlines, plural,
+                  file_id, counter, numlines, _("Collapse")))
+
+    append(u'\n\n')
+
+
+def _render_lines(append, file_id, change, lines):
+    _import_filters()
+
+    last = len(lines) - 1
+
+    for i, line in enumerate(lines):
+        if change == 'equal':
+            row_class = u''
+        else:
+            row_class = u' class="%s %s"' % (i == 0 and u'first' or u'',
+                                             i == last and u'last' or u'')
+
+        if change == 'replace':
+            left = _render_markup(line[2], line[3])
+            right = _render_markup(line[5], line[6])
+        else:
+            left = _render_markup(line[2])
+            right = _render_markup(line[5])
+
+        if i == 0:
+            if change != 'equal':
+                anchor = u'\n\n     <a name="%s."/>\n\n' % file_id
+            else:
+                anchor = u'\n\n'
+        else:
+            anchor = u''
+
+        append(u'\n  <tr line="%s"%s>\n'
+               u'   <th class="left" colspan="1">%s\n'
+               u'%s'
+               u'\n   </th>\n\n'
+               u'   <td class="left"><pre>%s</pre></td>\n'
+               u'   <th class="right">%s</th>\n'
+               u'   <td class="right"><pre>%s</pre></td>\n\n'
+               u'  </tr>\n'
+               % (_render_value(line[0]), row_class, _render_value(line[1]),
+                  anchor, left, _render_value(line[4]), right))
 
 
 class SideBySideDiff(object):
-    def __init__(self, koIDiff, cwd=None, hl_enabled=True):
+    """
+    Renders the HTML for a whole koIDiff: an index of the changed files,
+    followed by the side-by-side table of each file.
+
+    With ``processes`` greater than 1 (or 0, for one per CPU), the files
+    are diffed, highlighted and rendered in a ``multiprocessing`` pool of
+    that size, or in ``pool`` if one is passed in. The files are still
+    read in this process, since they're read through XPCOM, and the
+    output is the same as rendering them one by one.
+
+    With a ``worker`` (a sbs_diff_worker.DiffWorker), the files are
+    diffed, highlighted and rendered in that resident process instead,
+    whatever their number, and collapsed chunks are filled in from it.
+
+    Highlighted files are kept in ``highlight_cache`` (a HighlightCache),
+    if one is passed in.
+
+    Files bigger than ``highlight_max_bytes``, with lines longer than
+    ``highlight_max_line_length``, or that take longer than
+    ``highlight_time_budget`` seconds to highlight are shown without
+    syntax highlighting, as is every file after the first
+    ``diff_highlight_time_budget`` seconds of rendering. Any of them can be
+    None for no limit.
+    """
+    def __init__(self, koIDiff, cwd=None, hl_enabled=True,
+                 diff_time_budget=DEFAULT_DIFF_TIME_BUDGET,
+                 diff_processes=DEFAULT_DIFF_PROCESSES,
+                 hunk_driven=DEFAULT_HUNK_DRIVEN, is_cancelled=None,
+                 processes=DEFAULT_RENDER_PROCESSES, pool=None,
+                 lazy_collapsed=DEFAULT_LAZY_COLLAPSED,
+                 highlight_by_region=DEFAULT_HIGHLIGHT_BY_REGION,
+                 highlight_cache=None,
+                 highlight_max_bytes=DEFAULT_HIGHLIGHT_MAX_BYTES,
+                 highlight_max_line_length=DEFAULT_HIGHLIGHT_MAX_LINE_LENGTH,
+                 highlight_time_budget=DEFAULT_HIGHLIGHT_TIME_BUDGET,
+                 diff_highlight_time_budget=DEFAULT_DIFF_HIGHLIGHT_TIME_BUDGET,
+                 worker=None):
         self.koIDiff = koIDiff
         self.cwd = cwd
         self.hl_enabled = hl_enabled
+        self.diff_time_budget = diff_time_budget
+        self.diff_processes = diff_processes
+        self.hunk_driven = hunk_driven
+        self.processes = processes
+        self.pool = pool
+        self.lazy_collapsed = lazy_collapsed
+        self.highlight_by_region = highlight_by_region
+        self.highlight_cache = highlight_cache
+        self.highlight_max_bytes = highlight_max_bytes
+        self.highlight_max_line_length = highlight_max_line_length
+        self.highlight_time_budget = highlight_time_budget
+        self.diff_highlight_time_budget = diff_highlight_time_budget
+        self.worker = worker
+        self.items = []
+        # The key of the items in the worker, once they've been sent to it.
+        self._worker_key = None
+        # The index and the DiffItems built by read_files, for iter_html.
+        self._prepared = None
+        # The number of files iter_html has given the HTML of so far.
+        self.files_rendered = 0
+
+        # Called before each file is diffed and rendered. If it returns
+        # True, toHTML stops and raises DiffCancelled.
+        self.is_cancelled = is_cancelled
+
+    def _check_cancelled(self):
+        if self.is_cancelled is not None and self.is_cancelled():
+            raise DiffCancelled
 
     def toHTML(self):
+        return "".join(self.iter_html())
+
+    def write_html(self, stream, encoding="utf-8"):
+        """
+        Writes the HTML to stream one file at a time, encoded with
+        encoding, so that the whole document is never held in memory.
+        """
+        for piece in self.iter_html():
+            if isinstance(piece, unicode):
+                piece = piece.encode(encoding)
+            stream.write(piece)
+
+    def read_files(self):
+        """
+        Reads the files of the diff. They're read through XPCOM, which has
+        to be done on the main thread, so this is called there before
+        iter_html is run on another thread. Only the diffing, highlighting
+        and rendering are then left for iter_html.
+        """
+        if self._prepared is None:
+            self._prepared = self._prepare()
+
+        self._read_files(self._prepared[1])
+
+    def _read_files(self, items):
+        for d in items:
+            if d.file_on_disk:
+                self._check_cancelled()
+                d.get_patched_file(allow_patching=False)
+
+    def _prepare(self):
+        # Builds the index of the files and their DiffItems.
         cwd = self.cwd
         file_on_disk = ((cwd and True) or False)
         file_count = 1
         html_pieces = ['<div id="diff-details"><p><label>Files Changed:</label></p>', "<ol>"]
-        file_pieces = []
+        items = []
+
+        separate = self._use_worker() or self._use_pool()
+
+        if separate:
+            # Line codes can't be shared between processes.
+            code_table = None
+        else:
+            # All the files share one line code table, so boilerplate that
+            # repeats from file to file is only hashed and stored once.
+            from reviewboard.diffviewer.myersdiff import LineCodeTable
+            code_table = LineCodeTable()
+
         for filediffex in self.koIDiff.diffex.file_diffs:
             # Add the index.
             shortest_path = None
@@ -666,13 +2387,150 @@ class SideBySideDiff(object):
             html_pieces.append("]\n  </li>")
 
             # Add the diff.
+            if separate:
+                filediffex = FileDiffSnapshot(filediffex, cwd)
             d = DiffItem("%s" % (file_count), filediffex, cwd=cwd,
                          hl_enabled=self.hl_enabled,
-                         file_on_disk=file_on_disk)
+                         file_on_disk=file_on_disk,
+                         diff_time_budget=self.diff_time_budget,
+                         diff_processes=self.diff_processes,
+                         code_table=code_table,
+                         hunk_driven=self.hunk_driven,
+                         lazy_collapsed=self.lazy_collapsed,
+                         highlight_by_region=self.highlight_by_region,
+                         highlight_cache=self.highlight_cache,
+                         highlight_max_bytes=self.highlight_max_bytes,
+                         highlight_max_line_length=self.highlight_max_line_length,
+                         highlight_time_budget=self.highlight_time_budget)
             file_count += 1
-            d.load_chunks()
-            #print d
-            file_pieces.append(d.toHTML())
+            items.append(d)
         html_pieces.append("</div>")
-        html_pieces += file_pieces
-        return "\n\n".join(html_pieces)
+        return "\n\n".join(html_pieces), items
+
+    def _get_processes(self):
+        if self.pool is None and self.processes == 0:
+            import multiprocessing
+            return multiprocessing.cpu_count()
+        return self.processes
+
+    def _use_worker(self):
+        return self.worker is not None
+
+    def _use_pool(self):
+        return not self._use_worker() and \
+               (self.pool is not None or (self._get_processes() or 1) > 1) and \
+               len(self.koIDiff.diffex.file_diffs) > 1
+
+    def iter_html(self):
+        """
+        Generator that returns the pieces of the HTML given by toHTML: the
+        index of the files first, and then each file as it's rendered.
+        """
+        if self.diff_highlight_time_budget is not None:
+            highlight_deadline = time.time() + self.diff_highlight_time_budget
+        else:
+            highlight_deadline = None
+
+        # The files read by read_files are only used once, so that
+        # rendering again reads them again.
+        prepared, self._prepared = self._prepared, None
+        if prepared is None:
+            prepared = self._prepare()
+        index_html, items = prepared
+
+        for d in items:
+            d.highlight_deadline = highlight_deadline
+        self.items = items
+
+        if self._use_worker() or self._use_pool():
+            # Read the files here, rather than through XPCOM in the pool or
+            # the worker. They're already read if read_files was called.
+            self._read_files(items)
+
+        self.files_rendered = 0
+        yield index_html
+
+        if self._use_worker():
+            file_pieces = self._render_in_worker(items)
+        elif self._use_pool():
+            file_pieces = self._render_in_pool(items, self.pool,
+                                               self._get_processes())
+        else:
+            file_pieces = self._render(items)
+
+        for piece in file_pieces:
+            yield "\n\n"
+            yield piece
+            self.files_rendered += 1
+
+    def get_chunk_html(self, file_id, chunk_index):
+        """
+        Returns the HTML for the rows of a chunk left out of the HTML. The
+        file and chunk are numbered from 1, as in the ids in the HTML.
+        """
+        if self._worker_key is not None:
+            from sbs_diff_worker import WorkerError
+
+            try:
+                return self.worker.get_chunk_html(self._worker_key, file_id,
+                                                  chunk_index)
+            except WorkerError, ex:
+                # The worker has lost the items, so diff the file again
+                # here.
+                logging.debug("Can't get chunk %s.%s from the diff worker: "
+                              "%s", file_id, chunk_index, ex)
+
+        return self.items[file_id - 1].get_chunk_html(chunk_index)
+
+    def _render(self, items):
+        for d in items:
+            self._check_cancelled()
+            d.load_chunks()
+            self._check_cancelled()
+            yield d.toHTML()
+
+    def _render_in_worker(self, items):
+        worker = self.worker
+        self._check_cancelled()
+        key = worker.render(items)
+        # The chunks of the files already rendered can be asked for while
+        # the rest are.
+        self._worker_key = key
+        finished = False
+
+        try:
+            for i in xrange(len(items)):
+                self._check_cancelled()
+                yield worker.next_html(key)
+
+            finished = True
+        finally:
+            if not finished:
+                self._worker_key = None
+                worker.forget(key)
+
+    def _render_in_pool(self, items, pool, processes):
+        if pool is None:
+            # Only pull in multiprocessing when it's actually used.
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+
+        finished = False
+
+        try:
+            # imap hands the files back in order, whichever finishes first.
+            results = pool.imap(render_diff_item, items)
+
+            for item, (html, chunks) in itertools.izip(items, results):
+                item.chunks = chunks
+                self._check_cancelled()
+                yield html
+
+            finished = True
+        finally:
+            if pool is not self.pool:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+#
+# The Original Code is "side by side diff" code.
+#
+# The Initial Developer of the Original Code is ActiveState Software Inc.
+# Portions created by ActiveState Software Inc are Copyright (C) 2008-2009
+# ActiveState Software Inc. All Rights Reserved.
+#
+# Contributor(s):
+#   Todd Whiteman @ ActiveState Software Inc
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+#
+# Overview:
+#   A resident process that diffs, highlights and renders side-by-side
+#   diffs for Komodo, so that the work neither holds up Komodo's own
+#   Python threads nor has to import everything again for every diff.
+#
+#   The process reads requests on its stdin and writes the replies on its
+#   stdout. Each message is a frame: its length as a 4 byte big-endian
+#   unsigned int, followed by that many bytes of pickle. A request is a
+#   tuple (id, command, args...), and the reply is (id, "ok", value) or
+#   (id, "error", message), with the id of the request it answers. The
+#   rendering requests (render, next, forget and clear_caches) are answered
+#   in turn, and the others straight away, so the replies can come back in
+#   a different order from the requests. The commands are:
+#
+#     ping                      -> the worker's process id
+#     render key items          -> the number of items; starts rendering
+#                                  the DiffItems and keeps them as key
+#     next key                  -> the HTML of the next item of key
+#     chunk key file_id index   -> the HTML of a chunk left out of it
+#     forget key                -> None; drops key, and stops rendering it
+#     clear_caches              -> None; see sbs_diff_helper.clear_caches
+#     shutdown                  -> None, and the worker exits
+#
+#   DiffWorker starts the process and talks to it, and SideBySideDiff
+#   renders through it when it's given one.
+#
+
+import cPickle as pickle
+import collections
+import itertools
+import logging
+import os
+import Queue
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+
+log = logging.getLogger("sbsDiff.worker")
+
+# Number of diffs the worker keeps the items of, for filling in their
+# collapsed chunks. The oldest is dropped when another one is rendered.
+MAX_KEPT_DIFFS = 4
+
+_length = struct.Struct("!I")
+
+
+class WorkerError(Exception):
+    """
+    Raised by DiffWorker when the worker process fails a request, or isn't
+    there to answer it.
+    """
+    pass
+
+
+def write_frame(stream, message):
+    """
+    Writes message to stream as one frame, and flushes it.
+    """
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    stream.write(_length.pack(len(data)) + data)
+    stream.flush()
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+
+    if len(data) != size:
+        raise EOFError("the stream ended inside a frame")
+
+    return data
+
+
+def read_frame(stream):
+    """
+    Reads the message of one frame from stream. Returns None at the end of
+    the stream, and raises EOFError if it ends part way through a frame.
+    """
+    header = stream.read(_length.size)
+
+    if not header:
+        return None
+
+    if len(header) != _length.size:
+        raise EOFError("the stream ended inside a frame")
+
+    return pickle.loads(_read_exactly(stream, _length.unpack(header)[0]))
+
+
+class PooledRender(object):
+    """
+    Iterator over the results of func for each of items, computed in pool
+    and returned in order. Unlike pool.imap, only ``window`` items are
+    handed to the pool at a time, so the rest are never rendered if the
+    iterator is dropped part way.
+    """
+    def __init__(self, pool, func, items, window):
+        self._pool = pool
+        self._func = func
+        self._items = iter(items)
+        self._results = collections.deque()
+
+        for i in xrange(window):
+            self._submit()
+
+    def _submit(self):
+        try:
+            item = self._items.next()
+        except StopIteration:
+            return
+
+        self._results.append(self._pool.apply_async(self._func, (item, )))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self._results:
+            raise StopIteration
+
+        result = self._results.popleft()
+        self._submit()
+        return result.get()
+
+
+class WorkerServer(object):
+    """
+    Answers the requests read from a stream. With ``processes`` greater
+    than 1 (or 0, for one per CPU), the items of a diff are rendered in a
+    ``multiprocessing`` pool of that size, which is kept for the life of
+    the worker.
+    """
+    # Answered one after another on a thread of their own, so that the
+    # chunks of a diff can be asked for while the rest of it is rendered.
+    RENDER_COMMANDS = ("render", "next", "forget", "clear_caches")
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._pool = None
+        self._pool_size = None
+        # Key -> (items, iterator over the items and their rendering, the
+        # rendering), oldest first in _keys.
+        self._diffs = {}
+        self._keys = []
+
+    def serve(self, instream, outstream):
+        """
+        Answers the requests on instream until it ends or the worker is
+        told to shut down.
+        """
+        write_lock = threading.Lock()
+        renders = Queue.Queue()
+        shutdown_id = None
+
+        def answer(request_id, command, args):
+            try:
+                method = getattr(self, "do_" + command)
+                reply = (request_id, "ok", method(*args))
+            except Exception, ex:
+                log.debug("%s failed:\n%s", command,
+                          traceback.format_exc())
+                reply = (request_id, "error",
+                         "%s: %s" % (ex.__class__.__name__, ex))
+
+            write_lock.acquire()
+            try:
+                write_frame(outstream, reply)
+            finally:
+                write_lock.release()
+
+        def answer_renders():
+            while True:
+                request = renders.get()
+
+                if request is None:
+                    break
+
+                answer(*request)
+
+        render_thread = threading.Thread(target=answer_renders,
+                                         name="sbsDiff worker renders")
+        render_thread.setDaemon(True)
+        render_thread.start()
+
+        try:
+            while True:
+                request = read_frame(instream)
+
+                if request is None:
+                    break
+
+                request_id, command, args = request[0], request[1], \
+                                            request[2:]
+
+                if command == "shutdown":
+                    shutdown_id = request_id
+                    break
+                elif command in self.RENDER_COMMANDS:
+                    renders.put((request_id, command, args))
+                else:
+                    answer(request_id, command, args)
+        finally:
+            renders.put(None)
+            render_thread.join()
+
+            if shutdown_id is not None:
+                answer(shutdown_id, "shutdown", ())
+
+            if self._pool is not None:
+                self._stop_pool()
+
+    def _get_pool(self):
+        if self._pool is None:
+            import multiprocessing
+            self._pool_size = self.processes or multiprocessing.cpu_count()
+            self._pool = multiprocessing.Pool(self._pool_size)
+        return self._pool
+
+    def _stop_pool(self):
+        # Let the files still being rendered finish, rather than terminating
+        # the pool: a pool process killed while it's handing back a result
+        # keeps the result queue locked, and terminate then never returns.
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def do_ping(self):
+        return os.getpid()
+
+    def do_render(self, key, items):
+        import sbs_diff_helper
+
+        if (self.processes == 0 or (self.processes or 1) > 1) and \
+           len(items) > 1:
+            # Keep every process busy, with the next file queued.
+            pool = self._get_pool()
+            results = PooledRender(pool, sbs_diff_helper.render_diff_item,
+                                   items, self._pool_size * 2)
+        else:
+            results = itertools.imap(sbs_diff_helper.render_diff_item, items)
+
+        self.do_forget(key)
+        self._diffs[key] = (items, itertools.izip(items, results), results)
+        self._keys.append(key)
+
+        while len(self._keys) > MAX_KEPT_DIFFS:
+            self.do_forget(self._keys[0])
+
+        return len(items)
+
+    def do_next(self, key):
+        item, (html, chunks) = self._diffs[key][1].next()
+        # Items rendered in the pool get their chunks from there.
+        item.chunks = chunks
+        return html
+
+    def do_chunk(self, key, file_id, chunk_index):
+        return self._diffs[key][0][file_id - 1].get_chunk_html(chunk_index)
+
+    def do_forget(self, key):
+        # The files already handed to the pool are still rendered, but no
+        # more of them are (see PooledRender).
+        if key in self._diffs:
+            del self._diffs[key]
+            self._keys.remove(key)
+
+    def do_clear_caches(self):
+        import sbs_diff_helper
+        sbs_diff_helper.clear_caches()
+
+    def do_shutdown(self):
+        pass
+
+
+class DiffWorker(object):
+    """
+    The Komodo end of a worker process, which is started the first time
+    it's needed and again if it has gone away. Requests from different
+    threads are sent as they're made, and each waits for its own reply,
+    so that a chunk can be asked for while a file is being rendered.
+
+    The worker runs with ``python`` (this interpreter by default), and
+    renders the items of a diff in ``processes`` processes (see
+    WorkerServer).
+    """
+    def __init__(self, processes=None, python=None):
+        self.processes = processes
+        self.python = python or sys.executable
+        self._process = None
+        # The replies of _process, keyed by the id of the request they
+        # answer. None is added once the process has gone away.
+        self._replies = None
+        self._keys = itertools.count(1)
+        self._request_ids = itertools.count(1)
+        # Guards the attributes above, and is never held while waiting on
+        # the process, so that its replies are always read.
+        self._lock = threading.Lock()
+        # Notified when a reply is read, or the process goes away.
+        self._replied = threading.Condition(self._lock)
+        # Held while a request is written to the process.
+        self._write_lock = threading.Lock()
+
+    def _start(self):
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        args = [self.python, script]
+
+        if self.processes is not None:
+            args += ["--processes", str(self.processes)]
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, env=env)
+        self._replies = {}
+        thread = threading.Thread(target=self._read_replies,
+                                  name="sbsDiff worker replies",
+                                  args=(self._process, self._replies))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _read_replies(self, process, replies):
+        # Runs for as long as process does, handing its replies to the
+        # requests waiting for them.
+        try:
+            try:
+                while True:
+                    reply = read_frame(process.stdout)
+
+                    if reply is None:
+                        break
+
+                    self._replied.acquire()
+                    try:
+                        replies[reply[0]] = reply[1:]
+                        self._replied.notifyAll()
+                    finally:
+                        self._replied.release()
+            except (EnvironmentError, EOFError), ex:
+                log.debug("Lost the diff worker's replies: %s", ex)
+        finally:
+            self._replied.acquire()
+            try:
+                replies[None] = None
+                self._replied.notifyAll()
+            finally:
+                self._replied.release()
+
+            self._drop(process)
+            process.stdout.close()
+            process.wait()
+
+    def request(self, command, *args):
+        """
+        Sends a request to the worker, and returns the value of its reply.
+        """
+        return self._request(command, args)
+
+    def _request(self, command, args, start=True):
+        self._lock.acquire()
+        try:
+            if self._process is None or None in self._replies:
+                if not start:
+                    raise WorkerError("The diff worker isn't running")
+                self._start()
+
+            process = self._process
+            replies = self._replies
+            request_id = self._request_ids.next()
+        finally:
+            self._lock.release()
+
+        self._write_lock.acquire()
+        try:
+            try:
+                write_frame(process.stdin, (request_id, command) + args)
+                error = None
+            except (EnvironmentError, ValueError), ex:
+                # ValueError is raised once another request has closed
+                # stdin, having found the process gone.
+                error = ex
+        finally:
+            self._write_lock.release()
+
+        if error is not None:
+            self._drop(process)
+            raise WorkerError("The diff worker went away: %s" % (error, ))
+
+        self._replied.acquire()
+        try:
+            while request_id not in replies and None not in replies:
+                self._replied.wait()
+
+            reply = replies.pop(request_id, None)
+        finally:
+            self._replied.release()
+
+        if reply is None:
+            raise WorkerError("The diff worker went away")
+
+        status, value = reply
+
+        if status != "ok":
+            raise WorkerError(value)
+
+        return value
+
+    def render(self, items):
+        """
+        Starts rendering the DiffItems in the worker, and returns the key
+        to get their HTML with next_html, and their chunks with
+        get_chunk_html.
+        """
+        key = self._keys.next()
+        self.request("render", key, items)
+        return key
+
+    def next_html(self, key):
+        return self.request("next", key)
+
+    def get_chunk_html(self, key, file_id, chunk_index):
+        return self.request("chunk", key, file_id, chunk_index)
+
+    def forget(self, key):
+        """
+        Drops the items of key from the worker, if it's still running.
+        """
+        if self._process is None:
+            return
+
+        try:
+            self.request("forget", key)
+        except WorkerError, ex:
+            log.debug("Can't forget diff %s: %s", key, ex)
+
+    def ping(self):
+        return self.request("ping")
+
+    def clear_caches(self):
+        self.request("clear_caches")
+
+    def close(self):
+        """
+        Shuts the worker process down, if it's running.
+        """
+        process = self._process
+
+        if process is not None:
+            try:
+                self._request("shutdown", (), start=False)
+            except WorkerError:
+                pass
+
+            self._drop(process)
+
+    def _drop(self, process):
+        # Stops using process, and closes its stdin so that it exits once
+        # it has answered the requests it has already read.
+        self._lock.acquire()
+        try:
+            if self._process is process:
+                self._process = None
+        finally:
+            self._lock.release()
+
+        self._write_lock.acquire()
+        try:
+            if not process.stdin.closed:
+                process.stdin.close()
+        finally:
+            self._write_lock.release()
+
+
+def main(argv):
+    import optparse
+
+    parser = optparse.OptionParser(usage="%prog [--processes N]",
+        description="Renders side-by-side diffs for the requests framed on "
+                    "stdin, replying on stdout.")
+    parser.add_option("--processes", type="int", default=None,
+                      help="processes to render the files of a diff in, "
+                           "0 for one per CPU")
+    options, args = parser.parse_args(argv[1:])
+
+    rvb_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "reviewboard")
+    if rvb_path not in sys.path:
+        sys.path.append(rvb_path)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+    if sys.platform == "win32":
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+
+    # Only frames go to stdout; anything printed goes to stderr instead.
+    outstream = sys.stdout
+    sys.stdout = sys.stderr
+
+    WorkerServer(options.processes).serve(sys.stdin, outstream)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
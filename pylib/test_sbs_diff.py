@@ -0,0 +1,957 @@
+"""
+Tests for sbs_diff_helper, sbs_diff_worker and the changes to the bundled
+pygments. Run them from this directory:
+
+    python test_sbs_diff.py
+"""
+
+import cPickle as pickle
+import difflib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+from django.template.loader import render_to_string
+
+import sbs_diff_helper
+import sbs_diff_worker
+
+
+class FakeHunk(object):
+    def __init__(self, lines):
+        self.lines = lines
+
+
+class FakeFileDiff(object):
+    def __init__(self, path, hunks):
+        self.paths = {"---": path, "+++": path}
+        self.hunks = hunks
+        self.diff = "--- %s\n+++ %s\n" % (path, path) + \
+                    "".join(["@@ -1 +1 @@\n%s\n" % "\n".join(hunk.lines)
+                             for hunk in hunks])
+
+    def best_path(self, cwd):
+        return "file:///" + self.paths["+++"]
+
+
+class FakeKoDiff(object):
+    def __init__(self, file_diffs):
+        class DiffEx(object):
+            pass
+
+        self.diffex = DiffEx()
+        self.diffex.file_diffs = file_diffs
+
+
+class ItemOnDisk(sbs_diff_helper.DiffItem):
+    """
+    A DiffItem for a file whose patched contents are given, rather than
+    read through Komodo.
+    """
+    def __init__(self, new, filediff, **kwargs):
+        sbs_diff_helper.DiffItem.__init__(self, "1", filediff, cwd="/",
+                                          **kwargs)
+        self.new = new
+
+    def get_patched_file(self, allow_patching=True):
+        return self.new
+
+
+class SlowItem(ItemOnDisk):
+    def load_chunks(self):
+        time.sleep(0.3)
+        ItemOnDisk.load_chunks(self)
+
+
+def make_filediff(old, new, path="foo.py"):
+    """
+    Returns a FakeFileDiff of the unified diff between old and new.
+    """
+    filediff = FakeFileDiff(path, [])
+    filediff.diff = "".join(difflib.unified_diff(
+        old.splitlines(True), new.splitlines(True), path, path))
+    return filediff
+
+
+class DifferFromHunksTest(unittest.TestCase):
+    def testDiff(self):
+        """Testing building opcodes from hunks"""
+        diff = "--- foo.py\n+++ foo.py\n" \
+               "@@ -1,3 +1,3 @@\n 1\n-2\n+two\n 3\n" \
+               "@@ -8,3 +8,4 @@\n 8\n 9\n+9.5\n 10\n"
+        old = "".join(["%d\n" % i for i in xrange(1, 13)])
+        new = old.replace("2\n", "two\n", 1).replace("9\n", "9\n9.5\n")
+
+        differ = sbs_diff_helper.DifferFromHunks(diff, new)
+        self.assertEquals(differ.old, old)
+        self.assertEquals(list(differ.get_opcodes()),
+                          [("equal",   0, 1, 0, 1),
+                           ("replace", 1, 2, 1, 2),
+                           ("equal",   2, 9, 2, 9),
+                           ("insert",  9, 9, 9, 10),
+                           ("equal",   9, 12, 10, 13)])
+
+    def testLineEndings(self):
+        """Testing rebuilding the original file's line endings from hunks"""
+        old = "1\r\n2\r\n3\r\n4\r\n"
+        new = "1\r\ntwo\r\n3\r\n4\r\n"
+        diff = "--- foo.py\r\n+++ foo.py\r\n" \
+               "@@ -1,3 +1,3 @@\r\n 1\r\n-2\r\n+two\r\n 3\r\n"
+
+        differ = sbs_diff_helper.DifferFromHunks(diff, new)
+        self.assertEquals(differ.old, old)
+        self.assertEquals(differ.left_contents, ["1", "2", "3", "4"])
+
+        old = "1\n2\n3"
+        new = "1\n2\nthree\n4\n"
+        diff = "--- foo.py\n+++ foo.py\n" \
+               "@@ -1,3 +1,4 @@\n 1\n 2\n-3\n" \
+               "\\ No newline at end of file\n+three\n+4\n"
+
+        differ = sbs_diff_helper.DifferFromHunks(diff, new)
+        self.assertEquals(differ.old, old)
+        self.assertEquals(list(differ.get_opcodes()),
+                          [("equal",   0, 2, 0, 2),
+                           ("replace", 2, 3, 2, 4)])
+
+        differ = sbs_diff_helper.DifferFromHunks(
+            "--- foo.py\n+++ foo.py\n@@ -1,2 +1,2 @@\n-1\n+one\n 2\n"
+            "\\ No newline at end of file\n", "one\n2")
+        self.assertEquals(differ.old, "1\n2")
+
+    def testMismatch(self):
+        """Testing building opcodes from hunks that don't match the file"""
+        diff = "--- foo.py\n+++ foo.py\n@@ -1,2 +1,2 @@\n 1\n-2\n+two\n"
+
+        self.assertRaises(sbs_diff_helper.HunkMismatchError,
+                          sbs_diff_helper.DifferFromHunks, diff, "1\n2\n")
+        self.assertRaises(sbs_diff_helper.HunkMismatchError,
+                          sbs_diff_helper.DifferFromHunks,
+                          diff.replace("+1,2", "+3,2"), "1\ntwo\n")
+
+
+class FileContentsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.reads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read(self, uri):
+        self.reads.append(uri)
+        f = open(uri[len("file://"):], "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def write(self, name, data):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return "file://" + path
+
+    def testCache(self):
+        """Testing caching file contents between diffs"""
+        cache = sbs_diff_helper.FileContentsCache()
+        uri = self.write("foo.py", "1\n2\n")
+
+        self.assertEqual(cache.get(uri, self.read), "1\n2\n")
+        self.assertEqual(cache.get(uri, self.read), "1\n2\n")
+        self.assertEqual(len(self.reads), 1)
+
+        self.write("foo.py", "1\n2\n3\n")
+        self.assertEqual(cache.get(uri, self.read), "1\n2\n3\n")
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(cache.size, 6)
+
+    def testEviction(self):
+        """Testing dropping the least recently used file contents"""
+        cache = sbs_diff_helper.FileContentsCache(max_bytes=10)
+        uri1 = self.write("1.txt", "aaaa")
+        uri2 = self.write("2.txt", "bbbb")
+        uri3 = self.write("3.txt", "cccc")
+
+        cache.get(uri1, self.read)
+        cache.get(uri2, self.read)
+        cache.get(uri1, self.read)
+        cache.get(uri3, self.read)
+        self.assertEqual(cache.size, 8)
+
+        del self.reads[:]
+        cache.get(uri1, self.read)
+        cache.get(uri3, self.read)
+        cache.get(uri2, self.read)
+        self.assertEqual(self.reads, [uri2])
+
+
+class HighlightCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testCache(self):
+        """Testing keeping highlighted lines on disk"""
+        from pygments.formatters import HtmlFormatter
+
+        cache = sbs_diff_helper.HighlightCache(self.tempdir)
+        formatter = HtmlFormatter()
+        lexer = sbs_diff_helper.get_lexer("foo.py")
+        key = cache.get_key("a = 1\n", lexer, formatter)
+        lines = [u'<span class="n">a</span>', u'', u'\xe9\n']
+
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, lines)
+        self.assertEqual(cache.get(key), lines)
+        self.assertEqual(
+            sbs_diff_helper.HighlightCache(self.tempdir).get(key), lines)
+
+        self.assertNotEqual(cache.get_key("a = 2\n", lexer, formatter), key)
+        self.assertNotEqual(
+            cache.get_key("a = 1\n", sbs_diff_helper.get_lexer("foo.c"),
+                          formatter), key)
+        self.assertNotEqual(
+            cache.get_key("a = 1\n", lexer, HtmlFormatter(linenos=True)),
+            key)
+
+        # Damaged entries are dropped.
+        f = open(os.path.join(self.tempdir, key + ".hl"), "wb")
+        f.write("garbage")
+        f.close()
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def testEviction(self):
+        """Testing dropping the least recently used highlighted lines"""
+        cache = sbs_diff_helper.HighlightCache(self.tempdir)
+        lines = [u"line %d" % i for i in xrange(100)]
+        cache.put("1", lines)
+        size = os.path.getsize(os.path.join(self.tempdir, "1.hl"))
+
+        cache = sbs_diff_helper.HighlightCache(self.tempdir,
+                                               max_bytes=size * 2)
+        cache.put("2", lines)
+        os.utime(os.path.join(self.tempdir, "1.hl"), (1, 1))
+        os.utime(os.path.join(self.tempdir, "2.hl"), (2, 2))
+        cache.get("1")
+        cache.put("3", lines)
+
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ["1.hl", "3.hl"])
+
+    def testDiffItem(self):
+        """Testing highlighting diffs with a HighlightCache"""
+        old = "".join(["x%d = %d\n" % (i, i) for i in xrange(60)])
+        new = old.replace("x30 = 30", "x30 = 'thirty'")
+        filediff = make_filediff(old, new)
+
+        def render(cache):
+            item = ItemOnDisk(new, filediff, lazy_collapsed=False,
+                              highlight_cache=cache)
+            item.load_chunks()
+            return item.toHTML()
+
+        cache = sbs_diff_helper.HighlightCache(self.tempdir)
+        expected = render(None)
+        self.assertEqual(render(cache), expected)
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+        # The second time around, the lines come from the cache.
+        real_apply_pygments = sbs_diff_helper.apply_pygments
+        sbs_diff_helper.apply_pygments = None
+
+        try:
+            self.assertEqual(render(cache), expected)
+        finally:
+            sbs_diff_helper.apply_pygments = real_apply_pygments
+
+
+class HighlightBudgetTest(unittest.TestCase):
+    def render(self, old, new, **kwargs):
+        kwargs.setdefault("lazy_collapsed", False)
+        item = ItemOnDisk(new, make_filediff(old, new), **kwargs)
+        item.load_chunks()
+        return item, item.toHTML()
+
+    def testLimits(self):
+        """Testing skipping highlighting of files over the budget"""
+        old = "".join(["x%d = %d\n" % (i, i) for i in xrange(20)])
+        new = old.replace("x10 = 10", "x10 = 'ten'")
+
+        item, html = self.render(old, new)
+        self.assertFalse(item.highlight_skipped)
+        self.assertTrue('<span class="n">x10</span>' in html)
+        self.assertFalse('class="unhighlighted"' in html)
+
+        for kwargs in [dict(highlight_max_bytes=len(old) - 1),
+                       dict(highlight_max_line_length=8),
+                       dict(highlight_time_budget=0),
+                       dict(highlight_deadline=time.time() - 1)]:
+            item, html = self.render(old, new, **kwargs)
+            self.assertTrue(item.highlight_skipped)
+            self.assertFalse('<span class="n">' in html)
+            self.assertTrue('<pre>x10 = ' in html)
+            self.assertTrue('class="unhighlighted"' in html)
+
+        item, html = self.render(old, new, highlight_max_bytes=None,
+                                 highlight_max_line_length=None,
+                                 highlight_time_budget=None)
+        self.assertFalse(item.highlight_skipped)
+
+    def testBigFile(self):
+        """Testing the budget of big files highlighted as they're shown"""
+        old = "".join(["x%d = %d\n" % (i, i) for i in xrange(3000)])
+        new = "".join(["y%d = '%d'\n" % (i, i) for i in xrange(3000)])
+
+        # Every line is shown, and highlighted while the chunks are built.
+        item, html = self.render(old, new, lazy_collapsed=True,
+                                 highlight_by_region=True,
+                                 highlight_time_budget=0.05)
+        self.assertTrue(item.highlight_skipped)
+        self.assertFalse('<span class="n">' in html)
+        self.assertTrue('class="unhighlighted"' in html)
+
+        item, html = self.render(old, new, lazy_collapsed=True,
+                                 highlight_by_region=True,
+                                 highlight_time_budget=None)
+        self.assertFalse(item.highlight_skipped)
+        self.assertTrue(html.count('<span class="n">') >= 6000)
+
+        markup = sbs_diff_helper.apply_pygments(new, "foo.py",
+                                                by_region=True,
+                                                deadline=time.time() - 1)
+        self.assert_(isinstance(markup, sbs_diff_helper.HighlightedLines))
+        self.assertRaises(sbs_diff_helper.HighlightBudgetExceeded,
+                          lambda: markup[2000:2010])
+
+    def testTimeLimit(self):
+        """Testing stopping highlighting when it runs out of time"""
+        tokens = iter(xrange(5000))
+        limited = sbs_diff_helper._limit_time(tokens, time.time() - 1)
+        self.assertRaises(sbs_diff_helper.HighlightBudgetExceeded,
+                          list, limited)
+
+        limited = sbs_diff_helper._limit_time(iter(xrange(5000)),
+                                              time.time() + 60)
+        self.assertEqual(list(limited), range(5000))
+
+
+class RenderFileFragmentTest(unittest.TestCase):
+    def testMatchesTemplate(self):
+        """Testing rendering a file fragment without the template"""
+        class FakeFile(object):
+            id = 3
+            dest_file = "foo<bar>.py"
+            source_revision = "r1"
+            dest_revision = "r2"
+            approximated = True
+            highlight_skipped = True
+
+        lines = [sbs_diff_helper.diff_line(i + 1, i + 1, i + 1,
+                                           "line %d" % i, "line %d" % i,
+                                           "line &lt;%d&gt;" % i,
+                                           "line &lt;%d&gt;" % i)
+                 for i in xrange(12)]
+        replaced = sbs_diff_helper.diff_line(13, 13, 13, "x = 1", "x = 2 ",
+                                             "x = 1", "x = 2 ")
+        inserted = sbs_diff_helper.diff_line(14, '', 14, '', "y = 3",
+                                             '', "y = 3")
+
+        file = FakeFile()
+        file.chunks = [
+            sbs_diff_helper.new_chunk(lines[:10], 10, "equal", True),
+            sbs_diff_helper.new_chunk(lines[10:11], 1, "equal", True),
+            sbs_diff_helper.new_chunk(lines[11:], 1, "equal"),
+            sbs_diff_helper.new_chunk([replaced], 1, "replace"),
+            sbs_diff_helper.new_chunk([inserted, inserted], 2, "insert"),
+        ]
+
+        for newfile, binary, collapseall in [(False, False, True),
+                                             (True, False, False),
+                                             (False, True, True)]:
+            file.newfile = newfile
+            file.binary = binary
+            expected = render_to_string('diffviewer/diff_file_fragment.html',
+                                        {'file': file,
+                                         'collapseall': collapseall})
+            self.assertEqual(
+                sbs_diff_helper.render_file_fragment(file, collapseall),
+                expected)
+
+    def testMatchesTemplateForDiffs(self):
+        """Testing rendering diffed files without the template"""
+        old = "".join(['def func%d(value):\n'
+                       '    """Returns <value> & %d."""\n'
+                       '\treturn value * %d\n'
+                       '\n' % (i, i, i)
+                       for i in xrange(40)])
+        new = old.replace("value * 3\n", "value * 3 + 1\n") \
+                 .replace("def func20(", "def func20_caf\xc3\xa9(") \
+                 .replace("def func39(value):\n", "") + "# TODO: more\n"
+
+        for hl_enabled in (True, False):
+            item = ItemOnDisk(new, make_filediff(old, new),
+                              hl_enabled=hl_enabled, lazy_collapsed=False)
+            item.load_chunks()
+
+            for approximated, newfile, binary, collapseall in [
+                    (False, False, False, True),
+                    (False, False, False, False),
+                    (True, False, False, True),
+                    (False, True, False, False),
+                    (False, False, True, True)]:
+                item.approximated = item.highlight_skipped = approximated
+                item.newfile = newfile
+                item.binary = binary
+                expected = render_to_string(
+                    'diffviewer/diff_file_fragment.html',
+                    {'file': item, 'collapseall': collapseall})
+                self.assertEqual(
+                    sbs_diff_helper.render_file_fragment(item, collapseall),
+                    expected)
+
+
+class HighlightedLinesTest(unittest.TestCase):
+    def testRegions(self):
+        """Testing highlighting a file one region at a time"""
+        # The docstrings have lines in the first column, which the lexer
+        # mustn't be started over at.
+        data = "".join(['def func%d(value):\n'
+                        '    """\n'
+                        'Returns the value times %d.\n'
+                        '"""\n'
+                        '    return value * %d  # TODO\n'
+                        '\n' % (i, i, i)
+                        for i in xrange(200)])
+        whole = sbs_diff_helper.apply_pygments(data, "foo.py")
+        markup = sbs_diff_helper.apply_pygments(data, "foo.py",
+                                                by_region=True)
+
+        self.assert_(isinstance(markup, sbs_diff_helper.HighlightedLines))
+
+        for start, end in [(602, 627), (627, 640), (0, 10), (1180, 1199),
+                           (3, 30), (645, 700)]:
+            self.assertEqual(markup[start:end], whole[start:end])
+
+        self.assertEqual(markup[500], whole[500])
+
+        # They're sent back from the process that rendered the file, part
+        # way through.
+        markup = pickle.loads(pickle.dumps(markup, pickle.HIGHEST_PROTOCOL))
+
+        for start, end in [(640, 645), (700, 720), (1000, 1010)]:
+            self.assertEqual(markup[start:end], whole[start:end])
+
+        # Small files are highlighted whole.
+        markup = sbs_diff_helper.apply_pygments(data[:1000], "foo.py",
+                                                by_region=True)
+        self.assertEqual(type(markup), list)
+
+    def testLongString(self):
+        """Testing highlighting regions inside long strings and comments"""
+        data = '"""\n' + \
+               "".join(["Line %d of the docstring.\n" % i
+                        for i in xrange(80)]) + \
+               '"""\n' + \
+               "".join(["value%d = %d\n" % (i, i) for i in xrange(1200)])
+        whole = sbs_diff_helper.apply_pygments(data, "foo.py")
+        markup = sbs_diff_helper.apply_pygments(data, "foo.py",
+                                                by_region=True)
+
+        self.assert_(isinstance(markup, sbs_diff_helper.HighlightedLines))
+        self.assertEqual(markup[60:70], whole[60:70])
+        self.assertEqual(markup[1000:1010], whole[1000:1010])
+        self.assertEqual(markup[30:40], whole[30:40])
+
+        data = "/*\n" + "".join(["int x%d;\n" % i for i in xrange(100)]) + \
+               "*/\n" + "".join(["int y%d;\n" % i for i in xrange(1000)])
+        whole = sbs_diff_helper.apply_pygments(data, "foo.c")
+        markup = sbs_diff_helper.apply_pygments(data, "foo.c",
+                                                by_region=True)
+
+        self.assertEqual(markup[90:110], whole[90:110])
+        self.assertEqual(markup[50], whole[50])
+
+    def testLines(self):
+        """Testing highlighting a file into the markup of each line"""
+        import pygments
+        from pygments.formatters import HtmlFormatter
+
+        data = 'x = """a\n\n<b>"""\n\ny = 1  # &\n'
+        markup = sbs_diff_helper.apply_pygments(data, "foo.py")
+
+        self.assertEqual(len(markup), 5)
+        self.assertEqual(markup[1], "")
+        self.assertEqual(
+            pygments.highlight(data, sbs_diff_helper.get_lexer("foo.py"),
+                               HtmlFormatter()),
+            '<div class="highlight"><pre>%s\n</pre></div>\n' %
+            "\n".join(markup))
+
+    def testIncremental(self):
+        """Testing highlighting the new side from the old side"""
+        # The string at the top is never closed.
+        old = '"""\nModule docstring.\n\n' + \
+              "".join(['def func%d(value):\n'
+                       '    # Returns the value times %d.\n'
+                       '    return value * %d  # TODO\n'
+                       '\n' % (i, i, i)
+                       for i in xrange(50)])
+        old_lines = sbs_diff_helper.split_lines(old)
+        new_lines = old_lines[:]
+        # Closing the string makes it a docstring, right from its start.
+        new_lines[2] = '"""'
+        new_lines[40:42] = []
+        new_lines[100:100] = ['x = """', 'y = 1', '"""']
+        new = "\n".join(new_lines) + "\n"
+        differ = sbs_diff_helper.Differ(old_lines, new_lines)
+
+        markup_a, markup_b = sbs_diff_helper.apply_pygments_incremental(
+            old, new, "foo.py", "foo.py", list(differ.get_opcodes()))
+
+        self.assertEqual(markup_a,
+                         sbs_diff_helper.apply_pygments(old, "foo.py"))
+        self.assertEqual(markup_b,
+                         sbs_diff_helper.apply_pygments(new, "foo.py"))
+
+        # Lexers of their own can't be resumed part way.
+        self.assertEqual(sbs_diff_helper.apply_pygments_incremental(
+            "<?php $a; ?>\n", "<?php $b; ?>\n", "foo.php", "foo.php",
+            [("replace", 0, 1, 0, 1)]), None)
+
+
+class SideBySideDiffTest(unittest.TestCase):
+    def testCancel(self):
+        """Testing cancelling a side-by-side diff"""
+        kodiff = FakeKoDiff([FakeFileDiff("foo.py", [])])
+        sbsdiff = sbs_diff_helper.SideBySideDiff(kodiff,
+                                                 is_cancelled=lambda: True)
+        self.assertRaises(sbs_diff_helper.DiffCancelled, sbsdiff.toHTML)
+
+    def testProcesses(self):
+        """Testing rendering a side-by-side diff in several processes"""
+        context = [" line %d" % i for i in xrange(30)]
+        kodiff = FakeKoDiff([
+            FakeFileDiff("file%d.py" % i,
+                         [FakeHunk(context + ["-b = %d" % i,
+                                              "+b = %d" % (i + 1), " c = 3"])])
+            for i in xrange(4)])
+
+        expected = sbs_diff_helper.SideBySideDiff(kodiff)
+        sbsdiff = sbs_diff_helper.SideBySideDiff(kodiff, processes=2)
+        self.assertEqual(sbsdiff.toHTML(), expected.toHTML())
+
+        # The chunks left out come back from the pool, rather than the
+        # files being diffed again.
+        for item in sbsdiff.items:
+            self.assertNotEqual(item.chunks, None)
+
+        self.assertEqual(sbsdiff.get_chunk_html(3, 1),
+                         expected.get_chunk_html(3, 1))
+
+    def testLazyCollapsed(self):
+        """Testing leaving collapsed chunks out until they're expanded"""
+        new = "".join(["line %d\n" % i for i in xrange(1, 61)])
+        old = new.replace("line 30\n", "line thirty\n")
+        filediff = make_filediff(old, new, "foo.txt")
+
+        eager = ItemOnDisk(new, filediff, hl_enabled=False,
+                           lazy_collapsed=False)
+        eager.load_chunks()
+        lazy = ItemOnDisk(new, filediff, hl_enabled=False,
+                          lazy_collapsed=True)
+        lazy.load_chunks()
+        html = lazy.toHTML()
+
+        self.assertEqual(html.count(' class="lazy"'), 2)
+        self.assertFalse("<pre>line 5</pre>" in html)
+
+        def fill(m):
+            return m.group(0).replace(' class="lazy"', '') + \
+                   lazy.get_chunk_html(int(m.group(1)))
+
+        self.assertEqual(
+            re.sub(r'<tbody id="chunk\.1\.(\d+)" class="lazy" '
+                   r'style="display: none;">\n\n\n', fill, html),
+            eager.toHTML())
+
+    def testWriteHTML(self):
+        """Testing writing a side-by-side diff to a stream"""
+        kodiff = FakeKoDiff([
+            FakeFileDiff("file%d.py" % i,
+                         [FakeHunk([" a = 1", "-b = '\xc3\xa9'",
+                                    "+b = '\xc3\xa8'"])])
+            for i in xrange(2)])
+
+        sbsdiff = sbs_diff_helper.SideBySideDiff(kodiff)
+        stream = StringIO()
+        sbsdiff.write_html(stream)
+        self.assertEqual(stream.getvalue(), sbsdiff.toHTML().encode("utf-8"))
+        self.assertEqual(sbsdiff.files_rendered, 2)
+
+    def testReadFiles(self):
+        """Testing reading the files before rendering on another thread"""
+        tempdir = tempfile.mkdtemp()
+        reads = []
+
+        def read_uri(uri):
+            reads.append((uri, threading.currentThread()))
+            f = open(uri[len("file://"):], "rb")
+            data = f.read()
+            f.close()
+            return data
+
+        def render(sbsdiff):
+            pieces.extend(sbsdiff.iter_html())
+
+        file_diffs = []
+        for i in xrange(3):
+            path = os.path.join(tempdir, "file%d.py" % i)
+            f = open(path, "wb")
+            f.write("a = 1\nb = %d\n" % (i + 1))
+            f.close()
+            filediff = make_filediff("a = 1\nb = %d\n" % i,
+                                     "a = 1\nb = %d\n" % (i + 1), path)
+            filediff.best_path = lambda cwd, path=path: "file://" + path
+            file_diffs.append(filediff)
+
+        old_read_uri = sbs_diff_helper.read_uri
+        sbs_diff_helper.read_uri = read_uri
+        sbs_diff_helper.file_contents_cache.clear()
+        try:
+            for processes in (1, 2):
+                del reads[:]
+                pieces = []
+                sbsdiff = sbs_diff_helper.SideBySideDiff(
+                            FakeKoDiff(file_diffs), cwd=tempdir,
+                            processes=processes)
+                sbsdiff.read_files()
+                thread = threading.Thread(target=render, args=(sbsdiff, ))
+                thread.start()
+                thread.join()
+
+                self.assertEqual(len(pieces), 7)
+                self.assertTrue('<span class="hl">3</span>' in pieces[-1])
+                self.assertEqual([thread for uri, thread in reads],
+                                 [threading.currentThread()] * 3)
+                sbs_diff_helper.file_contents_cache.clear()
+        finally:
+            sbs_diff_helper.read_uri = old_read_uri
+            sbs_diff_helper.file_contents_cache.clear()
+            shutil.rmtree(tempdir)
+
+
+class ColdStartTest(unittest.TestCase):
+    # Seconds that importing sbs_diff_helper may take in a fresh
+    # interpreter. It takes well under a tenth of that on a quiet machine;
+    # the slack is for loaded test machines. See tools/bench_import.py for
+    # where the time goes.
+    IMPORT_TIME_BUDGET = 1.0
+
+    SCRIPT = r"""
+import sys
+import time
+
+start = time.time()
+import sbs_diff_helper
+import_time = time.time() - start
+imported = [name for name in ("pygments", "django.template",
+                              "reviewboard.diffviewer.myersdiff")
+            if name in sys.modules]
+
+class FileDiff(object):
+    paths = {"---": "foo.py", "+++": "foo.py"}
+    hunks = []
+    diff = "--- foo.py\n+++ foo.py\n@@ -1,2 +1,2 @@\n a = 1\n-b = 2\n+b = 3\n"
+
+    def best_path(self, cwd):
+        return "file:///foo.py"
+
+# This module can't import ItemOnDisk without importing what it checks for.
+item = sbs_diff_helper.DiffItem("1", FileDiff(), cwd="/", hl_enabled=False)
+item.get_patched_file = lambda allow_patching=True: "a = 1\nb = 3\n"
+item.load_chunks()
+item.toHTML()
+print repr((import_time, imported, "pygments" in sys.modules))
+"""
+
+    def testColdStart(self):
+        """Testing the imports of the first side-by-side diff"""
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        p = subprocess.Popen([sys.executable, "-c", self.SCRIPT], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        self.assertEqual(p.returncode, 0, stderr)
+
+        import_time, imported, rendered_with_pygments = eval(stdout)
+        self.assertEqual(imported, [])
+        self.assertFalse(rendered_with_pygments)
+        self.assertTrue(import_time < self.IMPORT_TIME_BUDGET,
+                        "importing sbs_diff_helper took %.3fs" % import_time)
+
+
+class DiffWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.env = dict(os.environ)
+        self.env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.close()
+
+    def get_worker(self, processes=None):
+        worker = sbs_diff_worker.DiffWorker(processes=processes)
+        self.workers.append(worker)
+        return worker
+
+    def get_kodiff(self):
+        context = [" line %d" % i for i in xrange(30)]
+        return FakeKoDiff([
+            FakeFileDiff("file%d.py" % i,
+                [FakeHunk(
+                    context + ["-b = %d" % i, "+b = %d" % (i + 1),
+                               " c = 3"])])
+            for i in xrange(3)])
+
+    def testProtocol(self):
+        """Testing the diff worker's framed requests and replies"""
+        script = os.path.splitext(sbs_diff_worker.__file__)[0] + ".py"
+        p = subprocess.Popen([sys.executable, script], env=self.env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def request(*args):
+            sbs_diff_worker.write_frame(p.stdin, args)
+            return sbs_diff_worker.read_frame(p.stdout)
+
+        self.assertEqual(request(1, "ping"), (1, "ok", p.pid))
+        self.assertEqual(request(2, "next", 1),
+                         (2, "error", "KeyError: 1"))
+        self.assertEqual(request(3, "bogus")[:2], (3, "error"))
+        self.assertEqual(request(4, "shutdown"), (4, "ok", None))
+        self.assertEqual(sbs_diff_worker.read_frame(p.stdout), None)
+        self.assertEqual(p.wait(), 0)
+
+        stream = StringIO()
+        sbs_diff_worker.write_frame(stream, (1, "ping"))
+        self.assertRaises(EOFError, sbs_diff_worker.read_frame,
+                          StringIO(stream.getvalue()[:-1]))
+
+    def testChunkWhileRendering(self):
+        """Testing the diff worker answers chunk requests while rendering"""
+        new = "a = 1\nb = 2\n"
+        filediff = make_filediff("a = 1\n", new)
+        items = [SlowItem(new, filediff, hl_enabled=False)
+                 for i in xrange(2)]
+        requests_in, requests_out = [os.fdopen(fd, mode) for fd, mode in
+                                     zip(os.pipe(), ("rb", "wb"))]
+        replies_in, replies_out = [os.fdopen(fd, mode) for fd, mode in
+                                   zip(os.pipe(), ("rb", "wb"))]
+        server = sbs_diff_worker.WorkerServer()
+        thread = threading.Thread(target=server.serve,
+                                  args=(requests_in, replies_out))
+        thread.start()
+
+        try:
+            def send(*requests):
+                for request in requests:
+                    sbs_diff_worker.write_frame(requests_out, request)
+
+                return [sbs_diff_worker.read_frame(replies_in)
+                        for request in requests]
+
+            send((1, "render", 1, items), (2, "next", 1))
+            replies = send((3, "next", 1), (4, "chunk", 1, 1, 1))
+            # The chunk of the first file isn't held up by the second file,
+            # which is still being rendered.
+            self.assertEqual([reply[0] for reply in replies], [4, 3])
+            self.assertEqual(replies[0][1:],
+                             ("ok", items[0].get_chunk_html(1)))
+        finally:
+            sbs_diff_worker.write_frame(requests_out, (5, "shutdown"))
+            thread.join()
+            for stream in (requests_in, requests_out, replies_in,
+                           replies_out):
+                stream.close()
+
+    def testRender(self):
+        """Testing rendering a side-by-side diff in the diff worker"""
+        kodiff = self.get_kodiff()
+        expected = sbs_diff_helper.SideBySideDiff(kodiff)
+        html = expected.toHTML()
+        self.assertEqual(html.count(' class="lazy"'), 3)
+
+        for processes in (None, 2):
+            sbsdiff = sbs_diff_helper.SideBySideDiff(
+                kodiff, worker=self.get_worker(processes))
+            self.assertEqual(sbsdiff.toHTML(), html)
+            self.assertEqual(sbsdiff.get_chunk_html(2, 1),
+                             expected.get_chunk_html(2, 1))
+
+    def testWorkerGoneAway(self):
+        """Testing rendering after the diff worker has exited"""
+        kodiff = self.get_kodiff()
+        expected = sbs_diff_helper.SideBySideDiff(kodiff)
+        html = expected.toHTML()
+        worker = self.get_worker()
+        sbsdiff = sbs_diff_helper.SideBySideDiff(kodiff, worker=worker)
+        self.assertEqual(sbsdiff.toHTML(), html)
+        pid = worker.ping()
+        worker.close()
+
+        # The chunks are diffed again in this process, and the next request
+        # starts a new worker.
+        self.assertEqual(sbsdiff.get_chunk_html(1, 1),
+                         expected.get_chunk_html(1, 1))
+        self.assertNotEqual(worker.ping(), pid)
+
+    def testForget(self):
+        """Testing the diff worker stops rendering a diff it forgets"""
+        new = "a = 1\nb = 2\n"
+        filediff = make_filediff("a = 1\n", new)
+        items = [SlowItem(new, filediff, hl_enabled=False)
+                 for i in xrange(10)]
+        server = sbs_diff_worker.WorkerServer(processes=2)
+
+        try:
+            self.assertEqual(server.do_render(1, items), 10)
+            # Only enough files to keep the pool busy are handed to it.
+            rendering = server._diffs[1][2]
+            self.assertEqual(len(rendering._results), 4)
+            pool = server._pool
+            server.do_next(1)
+            server.do_forget(1)
+            # The files handed to the pool are left to finish, and no more
+            # are handed to it.
+            self.assertFalse(1 in server._diffs)
+            self.assertEqual(len(rendering._results), 4)
+            self.assertTrue(server._pool is pool)
+
+            server.do_render(2, items[:2])
+            self.assertEqual(server.do_next(2),
+                             sbs_diff_helper.render_diff_item(items[0])[0])
+        finally:
+            if server._pool is not None:
+                server._stop_pool()
+
+
+class LexerLookupTest(unittest.TestCase):
+    def testSameAsLinearScan(self):
+        """Testing get_lexer_for_filename against trying every pattern"""
+        import fnmatch
+        from pygments.lexers import get_lexer_for_filename, LEXERS
+        from pygments.util import ClassNotFound
+
+        filenames = ["Makefile", "README", "foo.PY", "x.tar.gz", ".bashrc",
+                     "foo.py.orig", "a.", ""]
+
+        for modname, name, aliases, patterns, mimetypes in LEXERS.values():
+            for pattern in patterns:
+                for part in ["", "foo", "a.b"]:
+                    filenames.append(pattern.replace("*", part)
+                                            .replace("?", "x")
+                                            .replace("[345]", "4"))
+
+        for filename in filenames:
+            expected = None
+
+            for modname, name, aliases, patterns, mimetypes in \
+                LEXERS.itervalues():
+                matches = [pattern for pattern in patterns
+                           if fnmatch.fnmatch(filename, pattern)]
+
+                if matches:
+                    expected = name
+                    break
+
+            try:
+                found = get_lexer_for_filename(filename).name
+            except ClassNotFound:
+                found = None
+
+            self.assertEqual(found, expected, filename)
+
+
+class LexerPoolTest(unittest.TestCase):
+    def testShared(self):
+        """Testing sharing lexers between the files of a diff"""
+        from pygments.lexers import JavascriptLexer, PythonLexer
+
+        pool = sbs_diff_helper.lexer_pool
+        pool.clear()
+
+        lexers = [sbs_diff_helper.get_lexer("src/module%d.%s" % (i, ext))
+                  for i in xrange(500) for ext in ("py", "js")]
+
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(set([type(lexer) for lexer in lexers]),
+                         set([JavascriptLexer, PythonLexer]))
+        self.assert_(lexers[0] is lexers[-2])
+        self.assertEqual(lexers[0].options, {"stripnl": False})
+        self.assertEqual(len(lexers[0].filters), 1)
+
+        self.assert_(pool.get(PythonLexer, stripnl=False) is lexers[0])
+        self.assert_(pool.get(PythonLexer) is not lexers[0])
+
+    def testNotShared(self):
+        """Testing lexers with state of their own aren't shared"""
+        from pygments.lexers import PhpLexer
+
+        pool = sbs_diff_helper.lexer_pool
+        pool.clear()
+
+        first = sbs_diff_helper.get_lexer("index.php")
+        second = sbs_diff_helper.get_lexer("index.php")
+
+        self.assert_(isinstance(first, PhpLexer))
+        self.assert_(first is not second)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(len(first.filters), 1)
+
+
+class LexerDispatchTest(unittest.TestCase):
+    def testSameAsTryingEveryRule(self):
+        """Testing lexing with the rules dispatched on the next character"""
+        from pygments.lexers import get_lexer_by_name
+
+        text = u"\n".join([
+            u"#include <stdio.h>",
+            u"/* caf\xe9 \u212a */ int main(void) { return 0x1F; }",
+            u"def f(a, *b, **c):",
+            u"    '''doc''' + r\"raw\\\" % 3.5e-2 # comment",
+            u'<?xml version="1.0"?><a b="c">&amp;<!-- x --><![CDATA[<y>]]></a>',
+            u"@decorator  \t`weird`\x00$ \xa0 end",
+        ]) + u"\n"
+
+        for name in ("python", "c", "xml"):
+            lexer = get_lexer_by_name(name, stripnl=False)
+            dispatched = list(lexer.get_tokens_unprocessed(text))
+            tables = []
+
+            # Without the tables, every rule is tried.
+            for state_tokens in lexer._tokens.values():
+                tables.append((state_tokens, state_tokens.table))
+                state_tokens.table = {}
+
+            try:
+                self.assertEqual(list(lexer.get_tokens_unprocessed(text)),
+                                 dispatched, name)
+            finally:
+                for state_tokens, table in tables:
+                    state_tokens.table = table
+
+
+if __name__ == "__main__":
+    unittest.main()
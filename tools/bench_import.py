@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Reports what the first side-by-side diff of a session spends importing.
+
+Run from the top of the source tree:
+
+    python tools/bench_import.py [--highlight]
+
+Imports sbs_diff_helper and renders a one file diff, without syntax
+highlighting unless --highlight is given, timing every module imported
+along the way. Prints a line per module, the way python -X importtime
+does on newer Pythons: the microseconds spent in the module itself, those
+spent in it and the modules it imported, and its name, indented by how
+deeply it was imported. Then prints the totals for the import and for
+the first render.
+"""
+
+import __builtin__
+import os
+import sys
+import time
+
+PYLIB_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                         os.path.abspath(__file__))), "pylib")
+sys.path.insert(0, PYLIB_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+
+class ImportTimer(object):
+    """
+    Times the imports made while it's installed. The modules are kept in
+    ``timings``, in the order their imports finished, as
+    ``(name, depth, self_seconds, cumulative_seconds)``.
+    """
+    def __init__(self):
+        self.timings = []
+        self._real_import = __builtin__.__import__
+        self._depth = 0
+        # The seconds spent in the nested imports of each import under way,
+        # and the modules they loaded.
+        self._nested = []
+        self._loaded = []
+
+    def install(self):
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._real_import
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        before = set(sys.modules)
+        self._depth += 1
+        self._nested.append(0.0)
+        self._loaded.append(set())
+        start = time.time()
+
+        try:
+            return self._real_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            loaded = set(sys.modules) - before
+            new = [module_name
+                   for module_name in loaded - self._loaded.pop()
+                   if sys.modules[module_name] is not None]
+            self._depth -= 1
+
+            if self._nested:
+                self._nested[-1] += elapsed
+                self._loaded[-1].update(loaded)
+
+            if new:
+                # A single import can bring in a package and its parents;
+                # the longest name is the one that was asked for.
+                new.sort(key=len)
+                self.timings.append((new[-1], self._depth + 1,
+                                     elapsed - nested, elapsed))
+
+
+class FileDiff(object):
+    paths = {"---": "foo.py", "+++": "foo.py"}
+    hunks = []
+    diff = "--- foo.py\n+++ foo.py\n@@ -1,2 +1,2 @@\n a = 1\n-b = 2\n+b = 3\n"
+
+    def best_path(self, cwd):
+        return "file:///" + self.paths["+++"]
+
+
+def main(args):
+    highlight = "--highlight" in args
+    timer = ImportTimer()
+    timer.install()
+
+    try:
+        start = time.time()
+        import sbs_diff_helper
+        import_time = time.time() - start
+
+        class ItemOnDisk(sbs_diff_helper.DiffItem):
+            def get_patched_file(self, allow_patching=True):
+                return "a = 1\nb = 3\n"
+
+        start = time.time()
+        item = ItemOnDisk("1", FileDiff(), cwd="/", hl_enabled=highlight)
+        item.load_chunks()
+        item.toHTML()
+        render_time = time.time() - start
+    finally:
+        timer.uninstall()
+
+    print "import time: self [us] | cumulative | imported package"
+
+    for name, depth, self_time, cumulative in timer.timings:
+        print "import time: %9d | %10d | %s%s" % (
+            self_time * 1e6, cumulative * 1e6, "  " * (depth - 1), name)
+
+    print
+    print "%d modules, importing sbs_diff_helper %.3fs, first render " \
+          "%.3fs" % (len(timer.timings), import_time, render_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the lexing throughput of the RegexLexers used to highlight
+diffs.
+
+Run from the top of the source tree:
+
+    python tools/bench_lexers.py [size_kb]
+
+Lexes Python (pygments' own lexers), C and XML sources of about size_kb
+each with the Python, C and XML lexers, trying only the rules that can
+match the next character (the default), and trying every rule of the
+state at every position, the way RegexLexer used to. Prints the
+throughput of each and checks that the tokens are the same.
+"""
+
+import os
+import sys
+import time
+
+PYLIB_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                         os.path.abspath(__file__))), "pylib")
+sys.path.insert(0, PYLIB_DIR)
+
+from pygments.lexers import get_lexer_by_name
+
+
+C_FUNCTION = """\
+/*
+ * Copies at most %(n)d bytes of src into dst.
+ */
+static int copy_%(n)d(char *dst, const char *src, size_t len)
+{
+    size_t i;
+#ifdef DEBUG
+    fprintf(stderr, "copy_%(n)d: %%lu\\n", (unsigned long)len);
+#endif
+    for (i = 0; i < len && i < %(n)d; i++) {
+        if (src[i] == '\\0')
+            break;
+        dst[i] = src[i] ^ 0x%(n)x;  // flip the bits
+    }
+    return (int)i * 2.5e0;
+}
+
+"""
+
+XML_ELEMENT = """\
+  <menuitem id="sbsdiff-item-%(n)d" label="&sbsdiff.item%(n)d.label;"
+            accesskey="%(key)s" oncommand="sbsdiff_open(%(n)d, 'side');">
+    <!-- Opens diff number %(n)d side by side -->
+    <observes element="cmd_sbsdiff" attribute="disabled"/>
+    <description><![CDATA[Shows <diff> %(n)d]]> &amp; more</description>
+  </menuitem>
+"""
+
+
+def python_source(size):
+    lexers_dir = os.path.join(PYLIB_DIR, "pygments", "lexers")
+    pieces = []
+    total = 0
+
+    while total < size:
+        for name in sorted(os.listdir(lexers_dir)):
+            if name.endswith(".py"):
+                f = open(os.path.join(lexers_dir, name), "rb")
+                data = f.read().decode("utf-8")
+                f.close()
+                pieces.append(data)
+                total += len(data)
+
+                if total >= size:
+                    break
+
+    return u"".join(pieces)
+
+
+def repeated_source(template, size, header=u"", footer=u""):
+    pieces = [header]
+    total = 0
+    n = 0
+
+    while total < size:
+        piece = template % {"n": n, "key": chr(ord("a") + n % 26)}
+        pieces.append(piece)
+        total += len(piece)
+        n += 1
+
+    pieces.append(footer)
+    return u"".join(pieces)
+
+
+def lex(lexer, text):
+    return list(lexer.get_tokens_unprocessed(text))
+
+
+def without_dispatch(lexer):
+    """
+    Empties the dispatch tables of the lexer's states, so that every rule
+    is tried at every position. Returns a function that puts them back.
+    """
+    saved = []
+
+    for state_tokens in lexer._tokens.values():
+        saved.append((state_tokens, state_tokens.table))
+        state_tokens.table = {}
+
+    def restore():
+        for state_tokens, table in saved:
+            state_tokens.table = table
+
+    return restore
+
+
+def main(args):
+    size = int(args and args[0] or 256) * 1024
+    sources = [
+        ("python", python_source(size)),
+        ("c", repeated_source(C_FUNCTION, size, u"#include <stdio.h>\n\n")),
+        ("xml", repeated_source(XML_ELEMENT, size,
+                                u'<?xml version="1.0"?>\n<menupopup>\n',
+                                u"</menupopup>\n")),
+    ]
+
+    for name, text in sources:
+        lexer = get_lexer_by_name(name, stripnl=False)
+        results = {}
+        times = {}
+
+        for mode in ("all rules", "dispatch"):
+            restore = None
+
+            if mode == "all rules":
+                restore = without_dispatch(lexer)
+
+            try:
+                best = None
+
+                for i in xrange(3):
+                    start = time.time()
+                    results[mode] = lex(lexer, text)
+                    elapsed = time.time() - start
+                    best = min(best or elapsed, elapsed)
+            finally:
+                if restore is not None:
+                    restore()
+
+            times[mode] = best
+
+        print "%-7s %7d chars %7d tokens  all rules %6.0f kB/s  " \
+              "dispatch %6.0f kB/s  (%.2fx)" % (
+                  name, len(text), len(results["dispatch"]),
+                  len(text) / 1024.0 / times["all rules"],
+                  len(text) / 1024.0 / times["dispatch"],
+                  times["all rules"] / times["dispatch"])
+
+        assert results["all rules"] == results["dispatch"]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the MyersDiffer used by the side-by-side diff view.
+
+Run from the top of the source tree:
+
+    python tools/bench_myersdiff.py storage [num_lines]
+    python tools/bench_myersdiff.py adversarial [num_lines]
+    python tools/bench_myersdiff.py engines [num_functions]
+    python tools/bench_myersdiff.py regions [num_tables]
+    python tools/bench_myersdiff.py sharing [num_files]
+
+"storage" compares the DiffData representations on a large, lightly
+edited file. "adversarial" diffs a file against a shuffled copy of itself,
+which is the worst case for the O(ND) search, and shows how the
+approximate modes bound the latency. "engines" runs MyersDiffer and
+PatienceDiffer side by side on the testdata sources and on a synthetic
+refactor of a large source file. "regions" diffs a large SQL dump in one
+piece and split on unique lines with AnchoredDiffer, serially and across
+all CPUs. "sharing" diffs a changeset of files with a common license header
+and imports, with a line code table per file and with one shared table.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))), "pylib"))
+
+from reviewboard.diffviewer.anchoreddiff import AnchoredDiffer
+from reviewboard.diffviewer.myersdiff import LineCodeTable, MyersDiffer
+from reviewboard.diffviewer.patiencediff import PatienceDiffer
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))),
+                            "pylib", "diffviewer", "testdata")
+
+
+class _LegacyFlags(dict):
+    """The dict-of-flags representation MyersDiffer used to keep."""
+    def __missing__(self, line):
+        return False
+
+
+class LegacyMyersDiffer(MyersDiffer):
+    """MyersDiffer with the old dict/list backed DiffData."""
+    class DiffData(MyersDiffer.DiffData):
+        def __init__(self, data):
+            MyersDiffer.DiffData.__init__(self, data)
+            self.modified = _LegacyFlags()
+
+    def _discard_confusing_lines(self):
+        MyersDiffer._discard_confusing_lines(self)
+        for data in (self.a_data, self.b_data):
+            data.undiscarded = list(data.undiscarded)
+            data.real_indexes = list(data.real_indexes)
+
+
+def gen_lines(num_lines, seed=0):
+    """Generates a file that looks vaguely like generated source."""
+    rand = random.Random(seed)
+    lines = []
+    for i in xrange(num_lines):
+        if i % 7 == 0:
+            lines.append("")
+        else:
+            lines.append("    value_%d = compute(%d, %d)" %
+                         (rand.randint(0, num_lines), i % 13, i % 17))
+    return lines
+
+
+def mutate(lines, num_changes, seed=1):
+    rand = random.Random(seed)
+    lines = list(lines)
+    for i in xrange(num_changes):
+        pos = rand.randint(0, len(lines) - 1)
+        action = rand.random()
+        if action < 0.3:
+            del lines[pos]
+        elif action < 0.6:
+            lines.insert(pos, "    inserted_%d = None" % i)
+        else:
+            lines[pos] = "    changed_%d = None" % i
+    return lines
+
+
+def footprint(differ):
+    """Returns the bytes held by the per-line state of both DiffData."""
+    total = 0
+    for data in (differ.a_data, differ.b_data):
+        total += sys.getsizeof(data.modified)
+        for seq in (data.undiscarded, data.real_indexes):
+            total += sys.getsizeof(seq)
+            if isinstance(seq, list):
+                # Ints beyond the small int cache are separate objects.
+                total += sum([sys.getsizeof(x) for x in seq if x > 256])
+    return total
+
+
+def run(differ_class, a, b):
+    start = time.time()
+    differ = differ_class(a, b)
+    opcodes = list(differ.get_opcodes())
+    return time.time() - start, footprint(differ), opcodes
+
+
+def check_opcodes(a, b, opcodes):
+    """Returns whether the opcodes are a valid diff of a against b."""
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if (i1, j1) != (i, j):
+            return False
+        if tag == "equal" and a[i1:i2] != b[j1:j2]:
+            return False
+        i, j = i2, j2
+    return (i, j) == (len(a), len(b))
+
+
+def bench_storage(num_lines=200000):
+    a = gen_lines(num_lines)
+    b = mutate(a, max(1, num_lines / 100))
+
+    print "Diffing %d lines against %d lines" % (len(a), len(b))
+
+    results = []
+    for name, differ_class in (("dict/list DiffData", LegacyMyersDiffer),
+                               ("array DiffData", MyersDiffer)):
+        elapsed, size, opcodes = run(differ_class, a, b)
+        results.append(opcodes)
+        print "  %-20s %8.2fs  %10.1f KB" % (name, elapsed, size / 1024.0)
+
+    if results[0] != results[1]:
+        print "ERROR: opcodes differ between implementations"
+        return 1
+    return 0
+
+
+def bench_adversarial(num_lines=20000):
+    a = ["line_%d = %d" % (i, i) for i in xrange(num_lines)]
+    b = list(a)
+    random.Random(0).shuffle(b)
+
+    print "Diffing %d lines against a shuffled copy" % num_lines
+
+    modes = [
+        ("time_budget=1.0", {"time_budget": 1.0}),
+        ("max_cost=64", {"max_cost": 64}),
+        ("fast_approximate", {"fast_approximate": True}),
+    ]
+
+    # The exact search is quadratic here, so only run it where it finishes
+    # in a reasonable time.
+    if num_lines <= 5000:
+        modes.insert(0, ("exact", {}))
+
+    status = 0
+    for name, kwargs in modes:
+        start = time.time()
+        differ = MyersDiffer(a, b, **kwargs)
+        opcodes = list(differ.get_opcodes())
+        elapsed = time.time() - start
+        print "  %-20s %8.2fs  %6d opcodes  approximated=%s" % \
+              (name, elapsed, len(opcodes), differ.approximated)
+
+        if not check_opcodes(a, b, opcodes):
+            print "ERROR: invalid opcodes for %s" % name
+            status = 1
+    return status
+
+
+def gen_refactor(num_functions, seed=2):
+    """
+    Generates a module full of small functions, and a refactored copy with
+    functions moved around, renamed and edited.
+    """
+    rand = random.Random(seed)
+    functions = []
+    for i in xrange(num_functions):
+        body = ["def function_%d(self, value):" % i,
+                "    if value is None:",
+                "        return None",
+                ""]
+        for k in xrange(rand.randint(2, 8)):
+            body.append("    value = helper_%d(value, %d)" %
+                        (rand.randint(0, 50), k))
+        body += ["    return value", "", ""]
+        functions.append(body)
+
+    refactored = [list(body) for body in functions]
+
+    # Move blocks of functions around.
+    for i in xrange(num_functions / 20):
+        start = rand.randint(0, len(refactored) - 10)
+        block = refactored[start:start + 10]
+        del refactored[start:start + 10]
+        dest = rand.randint(0, len(refactored))
+        refactored[dest:dest] = block
+
+    # Edit some of them.
+    for body in rand.sample(refactored, num_functions / 10):
+        body[rand.randint(4, len(body) - 4)] = "    value = changed(value)"
+
+    def flatten(bodies):
+        return [line for body in bodies for line in body]
+
+    return flatten(functions), flatten(refactored)
+
+
+def time_engines(a, b):
+    for name, differ_class in (("MyersDiffer", MyersDiffer),
+                               ("PatienceDiffer", PatienceDiffer)):
+        start = time.time()
+        opcodes = list(differ_class(a, b).get_opcodes())
+        elapsed = time.time() - start
+        changed = sum([max(i2 - i1, j2 - j1)
+                       for tag, i1, i2, j1, j2 in opcodes if tag != "equal"])
+
+        print "  %-20s %8.3fs  %6d opcodes  %6d changed lines" % \
+              (name, elapsed, len(opcodes), changed)
+
+        if not check_opcodes(a, b, opcodes):
+            print "ERROR: invalid opcodes for %s" % name
+            return 1
+    return 0
+
+
+def bench_engines(num_functions=1000):
+    status = 0
+    orig_dir = os.path.join(TESTDATA_DIR, "orig_src")
+    new_dir = os.path.join(TESTDATA_DIR, "new_src")
+
+    for filename in sorted(os.listdir(orig_dir)):
+        new_path = os.path.join(new_dir, filename)
+        if not os.path.exists(new_path):
+            continue
+
+        a = open(os.path.join(orig_dir, filename)).read().splitlines()
+        b = open(new_path).read().splitlines()
+        print "testdata/%s (%d vs %d lines)" % (filename, len(a), len(b))
+        status |= time_engines(a, b)
+
+    a, b = gen_refactor(num_functions)
+    print "Synthetic refactor (%d vs %d lines)" % (len(a), len(b))
+    status |= time_engines(a, b)
+
+    return status
+
+
+def gen_sql_dump(num_tables, seed=3):
+    rand = random.Random(seed)
+    lines = []
+    for table in xrange(num_tables):
+        lines.append("CREATE TABLE table_%d (" % table)
+        for column in xrange(rand.randint(5, 20)):
+            lines.append("  column_%d VARCHAR(%d)," %
+                         (column, rand.choice([32, 64, 255])))
+        lines.append(");")
+        for row in xrange(rand.randint(20, 150)):
+            lines.append("INSERT INTO table_%d VALUES (%d, 'value');" %
+                         (table, rand.randint(0, 1000000)))
+
+    changed = list(lines)
+    for i in xrange(len(lines) / 15):
+        changed[rand.randint(0, len(changed) - 1)] = \
+            lines[rand.randint(0, len(lines) - 1)]
+
+    return lines, changed
+
+
+def bench_regions(num_tables=500):
+    import multiprocessing
+
+    a, b = gen_sql_dump(num_tables)
+    cpus = multiprocessing.cpu_count()
+
+    print "Diffing a %d line SQL dump (%d CPUs)" % (len(a), cpus)
+
+    status = 0
+    for name, make_differ in (
+        ("MyersDiffer", lambda: MyersDiffer(a, b)),
+        ("Anchored, 1 process", lambda: AnchoredDiffer(a, b, processes=1)),
+        ("Anchored, %d processes" % cpus,
+         lambda: AnchoredDiffer(a, b, processes=cpus))):
+        start = time.time()
+        opcodes = list(make_differ().get_opcodes())
+        elapsed = time.time() - start
+        print "  %-24s %8.2fs  %6d opcodes" % (name, elapsed, len(opcodes))
+
+        if not check_opcodes(a, b, opcodes):
+            print "ERROR: invalid opcodes for %s" % name
+            status = 1
+    return status
+
+
+def gen_changeset(num_files, seed=4):
+    """
+    Generates a list of (old, new) files that all start with the same
+    license header and imports.
+    """
+    rand = random.Random(seed)
+    header = ["# Copyright line %d of the project license." % i
+              for i in xrange(30)]
+    header += ["import module_%d" % i for i in xrange(40)]
+
+    files = []
+    for i in xrange(num_files):
+        a = header + gen_lines(rand.randint(100, 600), seed=i)
+        files.append((a, mutate(a, 10, seed=i)))
+    return files
+
+
+def bench_sharing(num_files=500):
+    files = gen_changeset(num_files)
+    num_lines = sum([len(a) + len(b) for a, b in files])
+
+    print "Diffing %d files (%d lines)" % (len(files), num_lines)
+
+    status = 0
+    for name, shared in (("table per file", False),
+                         ("shared table", True)):
+        code_table = LineCodeTable()
+        stored = 0
+        start = time.time()
+
+        for a, b in files:
+            if not shared:
+                code_table = LineCodeTable()
+
+            opcodes = list(MyersDiffer(a, b,
+                                       code_table=code_table).get_opcodes())
+
+            if not shared:
+                stored += len(code_table)
+
+            if not check_opcodes(a, b, opcodes):
+                print "ERROR: invalid opcodes for %s" % name
+                status = 1
+
+        elapsed = time.time() - start
+
+        if shared:
+            stored = len(code_table)
+
+        print "  %-20s %8.2fs  %8d lines stored" % (name, elapsed, stored)
+    return status
+
+
+def main(argv):
+    benchmarks = {
+        "storage": bench_storage,
+        "adversarial": bench_adversarial,
+        "engines": bench_engines,
+        "regions": bench_regions,
+        "sharing": bench_sharing,
+    }
+
+    if len(argv) < 2 or argv[1] not in benchmarks:
+        print "usage: %s (%s) [size]" % (argv[0],
+                                            "|".join(sorted(benchmarks)))
+        return 2
+
+    args = [int(arg) for arg in argv[2:3]]
+    return benchmarks[argv[1]](*args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
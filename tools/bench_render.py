@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks rendering the side-by-side table of a diff.
+
+Run from the top of the source tree:
+
+    python tools/bench_render.py [num_files] [lines_per_file]
+
+Renders a changeset of synthetic files, each with a mix of collapsed
+context, replaced lines and inserted lines, the way DiffItem.toHTML used
+to (setting up Django and rendering diff_file_fragment.html per file) and
+with render_file_fragment, and prints the time per 10k lines for each.
+"""
+
+import os
+import sys
+import time
+
+PYLIB_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                         os.path.abspath(__file__))), "pylib")
+sys.path.insert(0, PYLIB_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+import sbs_diff_helper
+
+
+class BenchFile(object):
+    def __init__(self, file_id, num_lines):
+        self.id = file_id
+        self.dest_file = "src/module%d.py" % file_id
+        self.source_revision = "Revision 1"
+        self.dest_revision = "Working copy"
+        self.chunks = []
+
+        line_num = 0
+
+        while line_num < num_lines:
+            lines = []
+
+            for i in xrange(line_num, line_num + 20):
+                text = "    value_%d = compute(item, %d)  " % (i, i)
+                lines.append(sbs_diff_helper.diff_line(
+                    i + 1, i + 1, i + 1, text, text,
+                    text.replace("(", "<span>(</span>"),
+                    text.replace("(", "<span>(</span>")))
+
+            self.chunks.append(sbs_diff_helper.new_chunk(lines, 20,
+                                                         "equal", True))
+
+            old = "    total += value_%d" % line_num
+            new = "    total -= value_%d * 2" % line_num
+            self.chunks.append(sbs_diff_helper.new_chunk(
+                [sbs_diff_helper.diff_line(line_num + 21, line_num + 21,
+                                           line_num + 21, old, new,
+                                           old, new)], 1, "replace"))
+            self.chunks.append(sbs_diff_helper.new_chunk(
+                [sbs_diff_helper.diff_line(line_num + 22, '', line_num + 22,
+                                           '', new, '', new)], 1, "insert"))
+            line_num += 22
+
+        self.num_lines = sum([chunk['numlines'] for chunk in self.chunks])
+
+
+def render_with_template(file):
+    import reviewboard.settings
+    from django.core.management import setup_environ
+    from django.template.loader import render_to_string
+    setup_environ(reviewboard.settings)
+    return render_to_string('diffviewer/diff_file_fragment.html',
+                            {'file': file, 'collapseall': True})
+
+
+def render_direct(file):
+    return sbs_diff_helper.render_file_fragment(file, collapseall=True)
+
+
+def main(args):
+    num_files = int(args and args[0] or 50)
+    lines_per_file = int(args[1:] and args[1] or 400)
+    files = [BenchFile(i + 1, lines_per_file) for i in xrange(num_files)]
+    total_lines = sum([file.num_lines for file in files])
+
+    print "%d files, %d lines" % (num_files, total_lines)
+
+    results = {}
+
+    for name, render in [("template", render_with_template),
+                         ("direct", render_direct)]:
+        best = None
+
+        for i in xrange(3):
+            start = time.time()
+            results[name] = [render(file) for file in files]
+            elapsed = time.time() - start
+            best = min(best or elapsed, elapsed)
+
+        print "%-10s %.3fs per 10k lines" % (name,
+                                            best * 10000 / total_lines)
+
+    assert results["template"] == results["direct"]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks generating side-by-side diffs one after another in a Komodo
+session, with sbs_diff_helper kept loaded between them (the default) and
+reloaded for every diff (SBSDIFF_RELOAD_HELPER).
+
+Run from the top of the source tree:
+
+    python tools/bench_session.py [num_files] [lines_per_file] [repeats]
+
+Writes a changeset of synthetic Python files to a temporary directory.
+Then, in a fresh interpreter for each mode (three times each, as the
+first diff of a session is the noisiest), generates its highlighted diff
+repeats + 1 times the way the sbsDiff component does, with the files read
+from disk in place of koFileEx. Prints the processor time of the first
+generation, which includes importing the helper and everything it
+imports, the median, fastest and slowest of the repeats, and how many
+files each generation read from disk rather than from FileContentsCache.
+"""
+
+import difflib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+PYLIB_DIR = os.path.join(os.path.dirname(os.path.dirname(
+                         os.path.abspath(__file__))), "pylib")
+sys.path.insert(0, PYLIB_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+RUNS = 3
+
+
+def cpu_time():
+    # The processor time of this process, which unlike the time on the
+    # clock doesn't depend on what else the machine is doing.
+    user, system = os.times()[:2]
+    return user + system
+
+
+class Hunk(object):
+    def __init__(self):
+        self.lines = []
+
+
+class FileDiff(object):
+    def __init__(self, path, diff):
+        self.paths = {"---": path, "+++": path}
+        self.diff = diff
+        self.hunks = []
+
+        for line in diff.splitlines()[2:]:
+            if line.startswith("@@"):
+                self.hunks.append(Hunk())
+            else:
+                self.hunks[-1].lines.append(line)
+
+    def best_path(self, cwd):
+        return "file://" + os.path.join(cwd, self.paths["+++"])
+
+
+class KoDiff(object):
+    def __init__(self, file_diffs):
+        class DiffEx(object):
+            pass
+
+        self.diffex = DiffEx()
+        self.diffex.file_diffs = file_diffs
+
+
+def write_changeset(directory, num_files, lines_per_file):
+    """
+    Writes the new versions of the files to directory, and returns the
+    unified diff of each from its old version.
+    """
+    diffs = []
+
+    for n in xrange(num_files):
+        old = []
+
+        for i in xrange(lines_per_file):
+            if i % 10 == 0:
+                old.append("def function_%d(item, count=%d):\n" % (i, i))
+            else:
+                old.append("    value_%d = compute(item, %d) + 'x' * %d\n"
+                           % (i, i, n))
+
+        new = list(old)
+
+        for i in xrange(5, lines_per_file, 40):
+            new[i] = new[i].replace("compute", "recompute")
+
+        path = "module%d.py" % n
+        f = open(os.path.join(directory, path), "wb")
+        f.write("".join(new))
+        f.close()
+        diffs.append((path, "".join(difflib.unified_diff(old, new, path,
+                                                         path))))
+
+    return diffs
+
+
+def run(mode, directory, repeats):
+    """
+    Generates the diff of the changeset in directory repeats + 1 times in
+    this interpreter, and prints the seconds taken and files read by each.
+    """
+    import pickle
+    reads = []
+
+    def read_uri(uri):
+        reads.append(uri)
+        f = open(uri[len("file://"):], "rb")
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    f = open(os.path.join(directory, "diffs.pickle"), "rb")
+    kodiff = KoDiff([FileDiff(path, diff) for path, diff in pickle.load(f)])
+    f.close()
+    results = []
+
+    for i in xrange(repeats + 1):
+        del reads[:]
+        start = cpu_time()
+        # What the component does for each diff.
+        import sbs_diff_helper
+
+        if mode == "reload":
+            reload(sbs_diff_helper)
+
+        sbs_diff_helper.read_uri = read_uri
+        sbsdiff = sbs_diff_helper.SideBySideDiff(kodiff, directory, True)
+        sbsdiff.toHTML()
+        results.append((cpu_time() - start, len(reads)))
+
+    print repr(results)
+
+
+def main(args):
+    if args[:1] == ["--run"]:
+        run(args[1], args[2], int(args[3]))
+        return
+
+    import pickle
+    num_files = int(args and args[0] or 10)
+    lines_per_file = int(args[1:] and args[1] or 400)
+    repeats = int(args[2:] and args[2] or 5)
+    directory = tempfile.mkdtemp(prefix="bench_session-")
+
+    try:
+        f = open(os.path.join(directory, "diffs.pickle"), "wb")
+        pickle.dump(write_changeset(directory, num_files, lines_per_file), f)
+        f.close()
+
+        print "%d files of %d lines, %d repeats" % (num_files,
+                                                    lines_per_file, repeats)
+
+        for mode in ("kept", "reload"):
+            for i in xrange(RUNS):
+                p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                      "--run", mode, directory, str(repeats)],
+                                     stdout=subprocess.PIPE)
+                results = eval(p.communicate()[0].splitlines()[-1])
+                repeat_times = sorted([elapsed for elapsed, read
+                                       in results[1:]])
+                print "%-7s first %.3fs (%d read), repeat median %.3fs, " \
+                      "%.3f-%.3fs (%d read)" % (
+                          mode, results[0][0], results[0][1],
+                          repeat_times[len(repeat_times) // 2],
+                          repeat_times[0], repeat_times[-1],
+                          max([read for elapsed, read in results[1:]]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])